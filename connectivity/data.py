@@ -1,9 +1,14 @@
 # import libraries and packages
 import os
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import deepdish as dd
 import scipy
+import scipy.sparse
+from scipy.stats import mode
 import h5py
 from SUITPy import flatmap
 import nibabel as nib
@@ -13,6 +18,7 @@ import connectivity.constants as const
 import connectivity.io as cio
 import connectivity.matrix as matrix
 import connectivity.nib_utils as nio
+import connectivity.instrument as instrument
 
 """Main module for getting data to be used for running connectivity models.
 
@@ -54,6 +60,7 @@ class Dataset:
         self.subj_id = subj_id
         self.data = None
 
+    @instrument.timed("load_mat", attrs=["exp", "roi", "subj_id"], arrays=["data"])
     def load_mat(self):
         """Reads a data set from the Y_info file and corresponding GLM file from matlab."""
         dirs = const.Dirs(exp_name=self.exp, glm=self.glm)
@@ -90,6 +97,28 @@ class Dataset:
             self.data = self.data.reshape(d.shape)
         return self
 
+    def fingerprint(self):
+        """Returns a short hash identifying the source files of the data set.
+
+        Uses path, size and modification time of the matlab files, so the data
+        do not need to be loaded to check whether they have changed.
+
+        Returns:
+            fingerprint (str): hex digest
+        """
+        dirs = const.Dirs(exp_name=self.exp, glm=self.glm)
+        fname = "Y_" + self.glm + "_" + self.roi + ".mat"
+        if type(self.subj_id) is not list:
+            subj_id = [self.subj_id]
+        else:
+            subj_id = self.subj_id
+        h = hashlib.sha1()
+        for s in subj_id:
+            fpath = dirs.beta_reg_dir / s / fname
+            stat = os.stat(fpath)
+            h.update(f"{fpath}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return h.hexdigest()
+
     def load_h5(self):
         """
             Load the content of a data set object from a hpf5 file.
@@ -174,6 +203,7 @@ class Dataset:
         info = self.get_info()
         return info[info.run == 1]
 
+    @instrument.timed("get_data", attrs=["exp", "roi", "subj_id"])
     def get_data(self, averaging="sess", weighting=True, subset=None):
         """Get the data using a specific aggregation.
 
@@ -236,6 +266,40 @@ class Dataset:
 
         return data, data_info
 
+def prefetch(load, keys, depth=1):
+    """
+    Iterates over the keys (e.g. subjects), loading the data of the next `depth` keys
+    in a background thread while the current one is processed.
+
+    At most `depth` keys are loaded ahead, which caps the memory. Errors of `load`
+    are raised when its key is reached. `load` should only read with h5py (e.g. Dataset.load_mat),
+    whose calls are serialized by its own lock, not with deepdish.
+    Args:
+        load (callable): load(key) returns the data of key (e.g. lambda subj: run._get_XYdata(config, exp, subj))
+        keys (list): keys in processing order
+        depth (int): number of keys loaded ahead, 0 loads each key when it is reached. default is 1
+    Yields:
+        key, data
+    """
+    keys = list(keys)
+    if depth < 1:
+        for key in keys:
+            yield key, load(key)
+        return
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+    futures = deque()
+    try:
+        for i, key in enumerate(keys):
+            # the current key and up to `depth` keys ahead
+            while len(futures) < depth + 1 and i + len(futures) < len(keys):
+                futures.append(executor.submit(load, keys[i + len(futures)]))
+            yield key, futures.popleft().result()
+    finally:
+        # stop loading if the loop was left early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
 def convert_to_vol(
     data, 
     xyz, 
@@ -270,37 +334,276 @@ def convert_to_vol(
     nib_obj = nib.Nifti1Image(vol_data, mat)
     return nib_obj
 
+@instrument.timed()
 def convert_cerebellum_to_nifti(
-    data
+    data,
+    stack=False
     ):
     """
+    All images are filled with one fancy-indexed assignment into a 4D array.
     Args:
         data (np-arrray): N x 6937 length data array
         or 1-d (6937,) array
+        stack (bool): return a single 4D image instead of a list. default is False
     Returns:
-        nifti (List of nifti1image): N output images
+        nifti (List of nifti1image): N output images (or one 4D image if `stack`)
+    """
+    geometry = get_suit_geometry()
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    elif data.ndim != 2:
+        raise(NameError('data needs to be 1 or 2-dimensional'))
+
+    # Map the data
+    i, j, k = geometry["ijk"]
+    vol_data = np.zeros((data.shape[0],) + geometry["shape"])
+    vol_data[:, i, j, k] = data
+    if stack:
+        return nib.Nifti1Image(np.moveaxis(vol_data, 0, -1), geometry["affine"])
+    return [nib.Nifti1Image(vol, geometry["affine"]) for vol in vol_data]
+
+_suit_geometry = {}
+
+def get_suit_geometry():
+    """
+    Returns the voxel geometry of the cerebellum in SUIT space (cached).
+
+    The cache is keyed by size and modification time of regions_cerebellum_suit.mat
+    and cerebellarGreySUIT3mm.nii, so it is reloaded when one of them changes.
+    Returns:
+        geometry (dict)
+            coord: P x 3 array of world coordinates of the voxels
+            ijk: 3 x P array of voxel indices in the SUIT template
+            affine: affine of the SUIT template
+            shape: shape of the SUIT template
+            ijk_by_volume: ijk indices for other volume definitions (see get_suit_index)
     """
-    # Load the region file
     dirs = const.Dirs(exp_name="sc1")
     group_dir = os.path.join(dirs.reg_dir, 'data','group')
     reg_file = os.path.join(group_dir,'regions_cerebellum_suit.mat')
-    region = cio.read_mat_as_hdf5(fpath=reg_file)["R"]
-
-    # NII File for volume definition
     suit_file = os.path.join(group_dir,'cerebellarGreySUIT3mm.nii')
-    nii_suit = nib.load(suit_file)
+    key = ";".join(f"{f}:{os.stat(f).st_size}:{os.stat(f).st_mtime_ns}" for f in [reg_file, suit_file])
 
-    # Map the data
-    nii_mapped = []
-    if data.ndim == 2:
-        for i in range(data.shape[0]):
-            nii_mapped.append(convert_to_vol(data[i],region.data.T,nii_suit))
-    elif data.ndim ==1:
-        nii_mapped.append(convert_to_vol(data,region.data.T,nii_suit))
+    if key not in _suit_geometry:
+        region = cio.read_mat_as_hdf5(fpath=reg_file)["R"]
+        nii_suit = nib.load(suit_file)
+        coord = np.asarray(region.data)
+        _suit_geometry.clear()
+        _suit_geometry[key] = {
+            "coord": coord,
+            "ijk": flatmap.coords_to_voxelidxs(coord.T, nii_suit).astype(int),
+            "affine": nii_suit.affine,
+            "shape": tuple(nii_suit.shape[:3]),
+            "ijk_by_volume": {},
+            }
+    return _suit_geometry[key]
+
+def get_suit_index(vol_def):
+    """
+    Returns the voxel indices of the cerebellar voxels in `vol_def` (cached per affine and shape)
+    Args:
+        vol_def (nib obj): volume with affine
+    Returns:
+        ijk (np.ndarray): 3 x P array of voxel indices
+    """
+    geometry = get_suit_geometry()
+    key = (np.asarray(vol_def.affine).tobytes(), tuple(vol_def.shape[:3]))
+    if key not in geometry["ijk_by_volume"]:
+        geometry["ijk_by_volume"][key] = flatmap.coords_to_voxelidxs(geometry["coord"].T, vol_def).astype(int)
+    return geometry["ijk_by_volume"][key]
+
+_flatmap_projection = {}
+
+def get_flatmap_projection(depths=[0,0.2,0.4,0.6,0.8,1.0]):
+    """
+    Returns the projection of the SUIT voxels to the vertices of the cerebellar flatmap (cached).
+
+    Same sampling as flatmap.vol_to_surf: every vertex samples the volume at `depths`
+    between the pial and white SUIT surfaces. Entry (vertex, voxel) counts the samples
+    of the vertex that fall into the voxel; samples outside the cerebellar voxels read 0.
+    The matrix is cached in memory and on disk (RegionOfInterest/data/group/geometry).
+    Args:
+        depths (list): depths of points between the surfaces (0=pial, 1=white)
+    Returns:
+        projection (scipy.sparse.csr_matrix): vertices x voxels
+    """
+    geometry = get_suit_geometry()
+    surf_dir = os.path.join(os.path.dirname(flatmap.__file__), 'surfaces')
+    surf_files = [os.path.join(surf_dir, 'PIAL_SUIT.surf.gii'), os.path.join(surf_dir, 'WHITE_SUIT.surf.gii')]
+
+    h = hashlib.sha1()
+    h.update(geometry["ijk"].tobytes())
+    h.update(np.asarray(geometry["affine"]).tobytes())
+    h.update(str((geometry["shape"], list(depths))).encode())
+    for fpath in surf_files:
+        h.update(f"{fpath}:{os.stat(fpath).st_size}:{os.stat(fpath).st_mtime_ns};".encode())
+    key = h.hexdigest()[:16]
+    if key in _flatmap_projection:
+        return _flatmap_projection[key]
+
+    dirs = const.Dirs(exp_name="sc1")
+    cache_file = os.path.join(dirs.reg_dir, 'data', 'group', 'geometry', f'flatmap_{key}.npz')
+    if os.path.isfile(cache_file):
+        projection = scipy.sparse.load_npz(cache_file)
     else:
-        raise(NameError('data needs to be 1 or 2-dimensional'))
-    return nii_mapped
+        c1 = nib.load(surf_files[0]).darrays[0].data
+        c2 = nib.load(surf_files[1]).darrays[0].data
+        num_verts = c1.shape[0]
+        num_vox = geometry["ijk"].shape[1]
+        vol_def = nib.Nifti1Image(np.zeros(geometry["shape"]), geometry["affine"])
+
+        # voxel number of each location in the volume (-1 outside of the cerebellum)
+        vol_index = np.full(geometry["shape"], -1)
+        vol_index[tuple(geometry["ijk"])] = np.arange(num_vox)
+
+        rows, cols = [], []
+        for d in depths:
+            c = (1-d)*c1.T+d*c2.T
+            ijk = flatmap.coords_to_voxelidxs(c, vol_def).astype(int)
+            vox = vol_index[ijk[0], ijk[1], ijk[2]]
+            rows.append(np.where(vox >= 0)[0])
+            cols.append(vox[vox >= 0])
+        rows = np.concatenate(rows)
+        projection = scipy.sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, np.concatenate(cols))), shape=(num_verts, num_vox))
+        projection.sum_duplicates()
+
+        cio.make_dirs(os.path.dirname(cache_file))
+        tmp_file = os.path.join(os.path.dirname(cache_file), f'.flatmap_{key}.tmp.npz')
+        scipy.sparse.save_npz(tmp_file, projection)
+        os.replace(tmp_file, cache_file)
+
+    _flatmap_projection[key] = projection
+    return projection
+
+@instrument.timed()
+def project_to_flatmap(data, stats='nanmean', depths=[0,0.2,0.4,0.6,0.8,1.0]):
+    """
+    Maps SUIT voxel data to the flatmap vertices (see get_flatmap_projection)
+    Args:
+        data (np-array): N x 6937 or 1-d (6937,) array
+        stats (str): 'nanmean' (functional data) or 'mode' (label data)
+        depths (list): depths of points between the surfaces (0=pial, 1=white)
+    Returns:
+        surf_data (np-array): vertices x N
+    """
+    projection = get_flatmap_projection(depths=depths)
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    num_samples = len(depths)
+
+    if stats=='nanmean':
+        # samples outside the cerebellum count as 0, nan voxels are ignored
+        is_nan = np.isnan(data)
+        sum_surf = projection @ np.where(is_nan, 0, data).T
+        count_surf = num_samples - projection @ is_nan.T.astype(float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return sum_surf / count_surf
+    elif stats=='mode':
+        # count the samples of each label per vertex (label 0 for samples outside the cerebellum)
+        outside = num_samples - np.asarray(projection.sum(axis=1)).reshape(-1)
+        surf_data = np.zeros((projection.shape[0], data.shape[0]))
+        for i, row in enumerate(data):
+            labels, label_index = np.unique(np.r_[np.nan_to_num(row), 0], return_inverse=True)
+            one_hot = scipy.sparse.csr_matrix(
+                (np.ones(len(row)), (np.arange(len(row)), label_index[:-1])), shape=(len(row), len(labels)))
+            counts = (projection @ one_hot).toarray()
+            counts[:, label_index[-1]] += outside
+            # ties go to the smallest label (as scipy.stats.mode)
+            surf_data[:, i] = labels[np.argmax(counts, axis=1)]
+        return surf_data
+    raise NameError('stats needs to be "nanmean" or "mode"')
+
+@instrument.timed()
+def save_maps_cerebellum(
+    data,
+    fpath='/',
+    group='nanmean',
+    group_average=True,
+    gifti=True,
+    nifti=False,
+    column_names=[],
+    label_RGBA=[],
+    label_names=[],
+    ):
+    """Takes data (np array), averages along first dimension
+    saves gifti (and optionally nifti) map to disk
+
+    The maps are projected to the flatmap with one sparse product (see project_to_flatmap),
+    so no volume is built unless `nifti` is True.
+
+    Args:
+        data (np array): np array of shape (N x 6937) or (6937,)
+        fpath (str): save path for output file (without extension)
+        group (str): default is 'nanmean' (for func data), other option is 'mode' (for label data)
+        group_average (bool): average (or mode) over the N rows. If False, every row is a column of the gifti
+        gifti (bool): default is True, saves gifti to fpath
+        nifti (bool): default is False, saves nifti (4D if more than one column) to fpath
+        column_names (list):
+        label_RGBA (list):
+        label_names (list):
+    Returns:
+        saves nifti and/or gifti image to disk, returns gifti
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+
+    # get mean or mode of data along first dim (first dim is usually subjects)
+    if group_average:
+        if group=='nanmean':
+            data = np.nanmean(data, axis=0).reshape(1, -1)
+        elif group=='mode':
+            data = mode(data, axis=0)[0].reshape(1, -1)
+        else:
+            print('need to group data by passing "nanmean" or "mode"')
+
+    # save nifti to disk
+    if nifti:
+        nib_obj = convert_cerebellum_to_nifti(data=data, stack=data.shape[0] > 1)
+        if isinstance(nib_obj, list):
+            nib_obj = nib_obj[0]
+        nib.save(nib_obj, fpath + '.nii')
+
+    # map voxels to surface
+    surf_data = project_to_flatmap(data, stats=group)
+
+    # make and save gifti image
+    if group=='nanmean':
+        gii_img = flatmap.make_func_gifti(data=surf_data, column_names=column_names)
+        out_name = 'func'
+    elif group=='mode':
+        gii_img = flatmap.make_label_gifti(data=surf_data, label_names=label_names, column_names=column_names, label_RGBA=label_RGBA)
+        out_name = 'label'
+    if gifti:
+        nib.save(gii_img, fpath + f'.{out_name}.gii')
+
+    return gii_img
+
+_atlas_labels = {}
+
+def get_atlas_labels(atlas, hem):
+    """
+    Returns the parcel label of every vertex of a cortical atlas.
 
+    Labels are cached in memory under a key that includes size and modification
+    time of the label gifti, so it is only read again when it changes.
+    Args:
+        atlas (str): cortical atlas name (e.g. tessels0162)
+        hem (str): 'L' or 'R'
+    Returns:
+        labels (np-array): 1d (vertices,) of 1-based parcel numbers (0 is the medial wall)
+    """
+    dirs = const.Dirs()
+    gii_path = os.path.join(dirs.reg_dir, 'data', 'group', f'{atlas}.{hem}.label.gii')
+    stat = os.stat(gii_path)
+    key = (gii_path, stat.st_size, stat.st_mtime_ns)
+    if key not in _atlas_labels:
+        _atlas_labels[key] = nib.load(gii_path).darrays[0].data.astype(int)
+    return _atlas_labels[key]
+
+@instrument.timed()
 def convert_cortex_to_gifti(
     data, 
     atlas,
@@ -312,7 +615,7 @@ def convert_cortex_to_gifti(
     ):
     """
     Args:
-        data (np-array): 1d- (cortical regions,). must correspond to `hem_names`
+        data (np-array): 1d- (cortical regions,) or 2d- (cortical regions x columns). must correspond to `hem_names`
         atlas (str): cortical atlas name (e.g. tessels0162)
         data_type (str): 'func' or 'label'. default is 'func'
         column_names (list or None): default is None
@@ -323,40 +626,78 @@ def convert_cortex_to_gifti(
         List of gifti-img (left + right hemisphere)
         anatomical_structure (list of hemisphere names)
     """
-    dirs = const.Dirs()
-    anatomical_struct = ['CortexLeft','CortexRight']
+    anatomical_struct = {'L': 'CortexLeft', 'R': 'CortexRight'}
+
+    # ensure that data is float
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data.reshape(-1,1)
+    # Fastest way: prepend a NaN for ROI 0 (medial wall)
+    c_data = np.insert(data, 0, np.nan, axis=0)
+
     # get texture
     gifti_img = []
-    for h,(hem,struct) in enumerate(zip(hem_names, anatomical_struct)):
-        # Load the labels (roi-numbers) from the label.gii files
-        gii_path = os.path.join(dirs.reg_dir, 'data', 'group', f'{atlas}.{hem}.label.gii')
-        gii_data = nib.load(gii_path)
-        labels = gii_data.darrays[0].data[:]
-
-        # ensure that data is float
-        data = data.astype(float)
-
-        if data.ndim == 1:
-            data = data.reshape(-1,1)
-        c_data = np.insert(data, 0, np.nan,axis =0)
-        # Fastest way: prepend a NaN for ROI 0 (medial wall)
+    for hem in hem_names:
+        # labels (roi-numbers) from the label.gii files (cached, see get_atlas_labels)
+        labels = get_atlas_labels(atlas, hem)
         mapped_data = c_data[labels, :]
 
         if data_type=='func':
             gii = nio.make_func_gifti_cortex(
                 data=mapped_data,
-                anatomical_struct=struct,
+                anatomical_struct=anatomical_struct[hem],
                 column_names=column_names)
         elif data_type=='label':
             gii = nio.make_label_gifti_cortex(
                 data=mapped_data,
-                anatomical_struct=struct,
+                anatomical_struct=anatomical_struct[hem],
                 label_names=label_names,
+                column_names=column_names,
                 label_RGBA=label_RGBA)
         gifti_img.append(gii)
         
     return gifti_img, hem_names
 
+@instrument.timed()
+def save_maps_cortex(
+    data,
+    fpath,
+    atlas,
+    data_type='func',
+    column_names=None,
+    label_names=None,
+    label_RGBA=None,
+    hem_names=['L', 'R']
+    ):
+    """Saves every row of `data` as a column of one gifti per hemisphere
+
+    Args:
+        data (np array): (columns x cortical regions) or (cortical regions,)
+        fpath (str): save path for output files (without hemisphere and extension)
+        atlas (str): cortical atlas name (e.g. tessels0162)
+        data_type (str): 'func' or 'label'. default is 'func'
+        column_names (list or None): one name per row of `data`
+        label_names (list or None): default is None
+        label_RGBA (list or None): default is None
+        hem_names (list of str): default is ['L', 'R']
+    Returns:
+        saves `{fpath}.{hem}.{data_type}.gii` to disk, returns list of giftis
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    giis, hem_names = convert_cortex_to_gifti(
+        data=data.T,
+        atlas=atlas,
+        data_type=data_type,
+        column_names=column_names,
+        label_names=label_names,
+        label_RGBA=label_RGBA,
+        hem_names=hem_names)
+    for gii, hem in zip(giis, hem_names):
+        nib.save(gii, f'{fpath}.{hem}.{data_type}.gii')
+    return giis
+
 def get_distance_matrix(roi):
     """
     Args:
@@ -366,49 +707,96 @@ def get_distance_matrix(roi):
         distance (numpy.ndarray)
             PxP array of distance between different ROIs / voxels
     """
-    dirs = const.Dirs(exp_name="sc1")
-    group_dir = os.path.join(dirs.reg_dir, 'data','group')
     if (roi=='cerebellum_suit'):
-        reg_file = os.path.join(group_dir,'regions_cerebellum_suit.mat')
-        region = cio.read_mat_as_hdf5(fpath=reg_file)["R"]
-        coord = region.data
+        coord = get_suit_geometry()["coord"].copy()
+        Dist = eucl_distance(coord)
     else:
-        coordHem = []
-        parcels = []
-        for h,hem in enumerate(['L','R']):
-            # Load the corresponding label file
-            label_file = os.path.join(group_dir,roi + '.' + hem + '.label.gii')
-            labels = nib.load(label_file)
-            roi_label = labels.darrays[0].data
-
-            # Load the spherical gifti
-            sphere_file = os.path.join(group_dir,'fs_LR.32k.' + hem + '.sphere.surf.gii')
-            sphere = nib.load(sphere_file)
-            vertex = sphere.darrays[0].data
-
-            # To achieve a large seperation between the hemispheres, just move the hemispheres apart 50 cm in the x-coordinate
-            vertex[:,0] = vertex[:,0]+(h*2-1)*500
-
-            # Loop over the regions > 0 and find the average coordinate
-            parcels.append(np.unique(roi_label[roi_label>0]))
-            num_parcels = parcels[h].shape[0]
-            coordHem.append(np.zeros((num_parcels,3)))
-            for i,par in enumerate(parcels[h]):
-                coordHem[h][i,:] = vertex[roi_label==par,:].mean(axis=0)
-
-        # Concatinate these to a full matrix
-        num_regions = max(map(np.max,parcels))
-        coord = np.zeros((num_regions,3))
-        # Assign the coordinates - note that the
-        # Indices in the label files are 1-based [Matlab-style]
-        # 0-label is the medial wall and ignored!
-        coord[parcels[0]-1,:]=coordHem[0]
-        coord[parcels[1]-1,:]=coordHem[1]
-
-    # Now get the distances from the coordinates and return
-    Dist = eucl_distance(coord)
+        # cortical parcels: centroids and distances are cached (see get_cortex_geometry)
+        geometry = get_cortex_geometry(roi)
+        coord = geometry["coord"].copy()
+        Dist = geometry["distance"].copy()
     return Dist, coord
 
+_cortex_geometry = {}
+
+def get_cortex_geometry(roi):
+    """
+    Returns the geometry of the parcels of a cortical atlas.
+
+    The geometry is cached in memory and on disk (RegionOfInterest/data/group/geometry),
+    under a key that includes size and modification time of the label and sphere
+    giftis, so it is recomputed when one of them changes.
+    Args:
+        roi (string)
+            cortical atlas ('tessels0042','yeo7')
+    Returns
+        geometry (dict)
+            coord: Px3 array of parcel centroids on the sphere (hemispheres moved apart by 50 cm)
+            distance: PxP array of distances between parcels
+            labels_L, labels_R: 0-based indices of the parcels of each hemisphere
+    """
+    dirs = const.Dirs(exp_name="sc1")
+    group_dir = os.path.join(dirs.reg_dir, 'data','group')
+    files = []
+    for hem in ['L','R']:
+        files.append(os.path.join(group_dir, roi + '.' + hem + '.label.gii'))
+        files.append(os.path.join(group_dir, 'fs_LR.32k.' + hem + '.sphere.surf.gii'))
+    h = hashlib.sha1()
+    for fpath in files:
+        stat = os.stat(fpath)
+        h.update(f"{fpath}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    key = f"{roi}_{h.hexdigest()[:16]}"
+
+    if key in _cortex_geometry:
+        return _cortex_geometry[key]
+
+    cache_file = os.path.join(group_dir, 'geometry', f'{key}.npz')
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as f:
+            geometry = dict(f)
+    else:
+        geometry = _make_cortex_geometry(*files)
+        cio.make_dirs(os.path.dirname(cache_file))
+        tmp_file = os.path.join(os.path.dirname(cache_file), f'.{key}.tmp.npz')
+        np.savez(tmp_file, **geometry)
+        os.replace(tmp_file, cache_file)
+    _cortex_geometry[key] = geometry
+    return geometry
+
+def _make_cortex_geometry(label_L, sphere_L, label_R, sphere_R):
+    """centroids (via np.bincount over the labels), distances and hemisphere label ranges"""
+    geometry = {}
+    coordHem = []
+    parcels = []
+    for h,(hem,label_file,sphere_file) in enumerate(zip(['L','R'], [label_L, label_R], [sphere_L, sphere_R])):
+        roi_label = nib.load(label_file).darrays[0].data.astype(int)
+        vertex = nib.load(sphere_file).darrays[0].data.astype(float)
+
+        # To achieve a large seperation between the hemispheres, just move the hemispheres apart 50 cm in the x-coordinate
+        vertex[:,0] = vertex[:,0]+(h*2-1)*500
+
+        # Average coordinate of the regions > 0
+        count = np.bincount(roi_label)
+        coord_sum = np.stack([np.bincount(roi_label, weights=vertex[:,i]) for i in range(3)], axis=1)
+        parcels.append(np.nonzero(count[1:])[0] + 1)
+        coordHem.append(coord_sum[parcels[h]] / count[parcels[h]].reshape(-1,1))
+
+        # labels per hemisphere (see weights.get_labels_hemisphere)
+        geometry[f'labels_{hem}'] = np.arange(parcels[h].min()-1, parcels[h].max())
+
+    # Concatinate these to a full matrix
+    num_regions = max(map(np.max,parcels))
+    coord = np.zeros((num_regions,3))
+    # Assign the coordinates - note that the
+    # Indices in the label files are 1-based [Matlab-style]
+    # 0-label is the medial wall and ignored!
+    coord[parcels[0]-1,:]=coordHem[0]
+    coord[parcels[1]-1,:]=coordHem[1]
+
+    geometry['coord'] = coord
+    geometry['distance'] = eucl_distance(coord)
+    return geometry
+
 def eucl_distance(coord):
     """
     Calculates euclediand distances over some cooordinates
@@ -433,64 +821,75 @@ def read_suit_nii(nii_file):
     Returns:
         region_number_suit - values from parcellation file in suit space
     """
-
-    # Load the region file for cerebellum in suit space
-    dirs = const.Dirs(exp_name="sc1")
-    group_dir = os.path.join(dirs.reg_dir, 'data','group')
-    reg_file = os.path.join(group_dir,'regions_cerebellum_suit.mat')
-    region = cio.read_mat_as_hdf5(fpath=reg_file)["R"]
-
-    # get the coordinates of the cerebellum suit
-    coords = region.data.T
-
     # load in the vol for the atlas file
     vol_def = nib.load(nii_file)
 
-    # convert to voxel space
-    ijk = flatmap.coords_to_voxelidxs(coords,vol_def).astype(int)
-
-    indices = ijk.T
-
-    # get the volume data
-    vol_data = vol_def.get_fdata()
+    # voxel indices of the cerebellum suit coordinates (cached)
+    i, j, k = get_suit_index(vol_def)
 
     # use indices to sample from vol_data
-    data = vol_data[indices[:, 0], indices[:, 1], indices[:, 2]]
+    vol_data = vol_def.get_fdata()
+    data = vol_data[i, j, k]
     return data
 
+_roi_operator_cache = {}
+
+def get_roi_operator(region_number_suit):
+    """
+    Returns the sparse averaging operator for a parcellation in suit space (cached)
+    Args:
+        region_number_suit  - parcel vector in suit space (np.ndarray) or nifti filename of the atlas
+    Returns:
+        operator            - sparse (voxels x regions) matrix with a one for the region of each voxel
+        region_numbers      - region number of each column (np.unique of the parcel vector)
+    """
+    if isinstance(region_number_suit, (str, os.PathLike)):
+        stat = os.stat(region_number_suit)
+        key = f"{os.path.abspath(region_number_suit)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if key not in _roi_operator_cache:
+            _roi_operator_cache[key] = _make_roi_operator(read_suit_nii(region_number_suit))
+    else:
+        region_number_suit = np.asarray(region_number_suit).astype("int")
+        key = hashlib.sha1(region_number_suit.tobytes()).hexdigest()
+        if key not in _roi_operator_cache:
+            _roi_operator_cache[key] = _make_roi_operator(region_number_suit)
+    return _roi_operator_cache[key]
+
+def _make_roi_operator(region_number_suit):
+    region_numbers, region_index = np.unique(region_number_suit.astype("int"), return_inverse=True)
+    num_vox = len(region_index)
+    operator = scipy.sparse.csr_matrix(
+        (np.ones(num_vox), (np.arange(num_vox), region_index)),
+        shape=(num_vox, len(region_numbers)))
+    return operator, region_numbers
+
 def average_by_roi(data, region_number_suit):
     """
     Takes in a matrix containing voxels in suit space and the value of the parcel (output from read_suit_nii)
     and calculate the average for each roi
+
+    The nan-aware mean over all N maps is computed with two sparse products
+    (sum of the values and number of non-nan values per region).
     Args:
         data                - data in suit space (NxP)
-        region_number_suit  - parcel vector in suit space (np.ndarray)
+        region_number_suit  - parcel vector in suit space (np.ndarray) or nifti filename of the atlas
     Returns:
         data_mean_roi       - numpy array with mean within each roi (to be used as input to convert_cerebellum_to_nifti)
+        region_numbers      - region number of each column of data_mean_roi
     """
 
     # reshape data into NxP dims
-    try: 
-        num_cols, num_vox = data.shape
-    except: 
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
         data = np.reshape(data, (1, len(data)))
 
-    # find region numbers
-    region_number_suit = region_number_suit.astype("int")
-    region_numbers = np.unique(region_number_suit)
-    num_reg = len(region_numbers)
-    # loop over regions and calculate mean for each
-    # initialize the data array
-
-    data_mean_roi = np.zeros((data.shape[0],num_reg))
-    for r in range(num_reg):
-        # get the indices of voxels in suit space
-        reg_index = region_number_suit == region_numbers[r]
-
-        # get data for the region
-        reg_data = np.nanmean(data[:,reg_index], axis=1) # was np.mean
+    operator, region_numbers = get_roi_operator(region_number_suit)
 
-        # fill in data_roi
-        data_mean_roi[:, r] = reg_data
+    # sum and count of non-nan values within each region
+    is_valid = ~np.isnan(data)
+    sum_roi = (operator.T @ np.where(is_valid, data, 0).T).T
+    count_roi = (operator.T @ is_valid.T.astype(float)).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        data_mean_roi = sum_roi / count_roi # regions without data are nan (as np.nanmean)
 
     return data_mean_roi, region_numbers
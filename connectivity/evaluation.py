@@ -10,6 +10,9 @@ import numpy as np
 def calculate_R(Y, Y_pred):
     """Calculates correlation between Y and Y_pred without subtracting the mean.
 
+    Y and Y_pred can also be stacked over subjects (subjects x N x voxels),
+    then R and R_vox have a leading subject dimension.
+
     Args:
         Y (nd-array):
         Y_pred (nd-array):
@@ -17,11 +20,11 @@ def calculate_R(Y, Y_pred):
         R (scalar): Correlation between Y and Y_pred
         R_vox (1d-array): Correlation per voxel between Y and Y_pred
     """
-    SYP = np.nansum(Y * Y_pred, axis=0)
-    SPP = np.nansum(Y_pred * Y_pred, axis=0)
-    SST = np.sum(Y ** 2, axis=0)  # use np.nanmean(Y) here?
+    SYP = np.nansum(Y * Y_pred, axis=-2)
+    SPP = np.nansum(Y_pred * Y_pred, axis=-2)
+    SST = np.sum(Y ** 2, axis=-2)  # use np.nanmean(Y) here?
 
-    R = np.nansum(SYP) / np.sqrt(np.nansum(SST) * np.nansum(SPP))
+    R = np.nansum(SYP, axis=-1) / np.sqrt(np.nansum(SST, axis=-1) * np.nansum(SPP, axis=-1))
     R_vox = SYP / np.sqrt(SST * SPP)  # per voxel
 
     return R, R_vox
@@ -48,6 +51,8 @@ def calculate_R_cv(model, X, Y):
 def calculate_R2(Y, Y_pred):
     """Calculates squared correlation between Y and Y_pred without subtracting the mean.
 
+    Y and Y_pred can also be stacked over subjects (subjects x N x voxels).
+
     Args:
         Y (nd-array):
         Y_pred (nd-array):
@@ -58,11 +63,11 @@ def calculate_R2(Y, Y_pred):
     res = Y - Y_pred
 
     SSR = np.nansum(
-        res ** 2, axis=0
+        res ** 2, axis=-2
     )  # remember: without setting the axis, it just "flats" out the whole array and sum over all
-    SST = np.sum(Y ** 2, axis=0)  # use np.nanmean(Y) here??
+    SST = np.sum(Y ** 2, axis=-2)  # use np.nanmean(Y) here??
 
-    R2 = 1 - (np.nansum(SSR) / np.nansum(SST))
+    R2 = 1 - (np.nansum(SSR, axis=-1) / np.nansum(SST, axis=-1))
     R2_vox = 1 - (SSR / SST)
 
     return R2, R2_vox
@@ -71,6 +76,7 @@ def calculate_reliability(Y, dataframe):
     """Calculates reliability of Y data across sessions.
 
     Data for session need to have same structure and length.
+    Y can also be stacked over subjects (subjects x N x voxels) if all subjects have the same session structure.
     Args:
         Y (nd-array)
         dataframe (pandas dataframe): dataframe with session info
@@ -80,8 +86,148 @@ def calculate_reliability(Y, dataframe):
         R2 (scalar): Squared correlation
         R2_vox (1d-array): Squared correlation per voxel
     """
-    Y_flip = np.r_[Y[dataframe["sess"] == 2, :], Y[dataframe["sess"] == 1, :]]
+    Y_flip = np.take(Y, _flip_index(dataframe["sess"]), axis=-2)
 
     R, R_vox = calculate_R(Y, Y_flip)
     R2, R2_vox = calculate_R2(Y, Y_flip)
     return R, R_vox, R2, R2_vox
+
+def calculate_noiseceiling(noise_Y_R, noise_X_R):
+    """Noise ceiling of R given the reliabilities of the data and the prediction.
+
+    Used for the noise-ceiling-corrected R (R / noiseceiling), see visualize.get_summary.
+    Args:
+        noise_Y_R (scalar or nd-array): reliability of the evaluation data (Y)
+        noise_X_R (scalar or nd-array): reliability of the prediction (X)
+    Returns:
+        noiseceiling (scalar or nd-array)
+    """
+    return np.sqrt(noise_Y_R * noise_X_R)
+
+def calculate_metrics(Y, Y_pred, Y_sess=None, X_sess=None, block_size=1024):
+    """Calculates R, R2, rmse and the session-flipped reliabilities in one pass over column blocks.
+
+    Gives the same results as calculate_R, calculate_R2 and calculate_reliability,
+    but only allocates temporaries of size (N x block_size), so memory beyond the
+    inputs is O(voxels). Y and Y_pred can also be stacked over subjects
+    (subjects x N x voxels): all metrics then get a leading subject dimension.
+
+    Args:
+        Y (nd-array): observed data (N x voxels) or (subjects x N x voxels)
+        Y_pred (nd-array): predicted data, same shape as Y
+        Y_sess (1d-array or None): session of each row of Y. If given, the reliability of Y is returned (noise_Y_*)
+        X_sess (1d-array or None): session of each row of Y_pred. If given, the reliability of Y_pred is returned (noise_X_*)
+        block_size (int): number of columns per block
+    Returns:
+        dict with keys rmse, R_eval, R_vox, R2, R2_vox and optionally
+        noise_Y_R, noise_Y_R_vox, noise_Y_R2, noise_Y_R2_vox, noise_X_R, noise_X_R_vox, noise_X_R2, noise_X_R2_vox
+    """
+    N, P = Y.shape[-2:]
+    shape = Y.shape[:-2] + (P,)
+    sums = {k: np.zeros(shape) for k in ["SYP", "SPP", "SST", "SSR", "SSR_all", "SPP_all"]}
+    flips = {}
+    if Y_sess is not None:
+        flips["noise_Y"] = (_flip_index(Y_sess), "Y")
+    if X_sess is not None:
+        flips["noise_X"] = (_flip_index(X_sess), "Y_pred")
+    for name in flips:
+        for k in ["SYF", "SFF", "SSRF"]:
+            sums[f"{name}_{k}"] = np.zeros(shape)
+
+    for j in range(0, P, block_size):
+        cols = slice(j, min(j + block_size, P))
+        y = Y[..., cols]
+        yp = Y_pred[..., cols]
+
+        prod = y * yp
+        sums["SYP"][..., cols] = np.nansum(prod, axis=-2)
+        np.multiply(yp, yp, out=prod)
+        sums["SPP"][..., cols] = np.nansum(prod, axis=-2)
+        sums["SPP_all"][..., cols] = np.sum(prod, axis=-2)
+        np.multiply(y, y, out=prod)
+        sums["SST"][..., cols] = np.sum(prod, axis=-2)
+        np.subtract(y, yp, out=prod)
+        np.multiply(prod, prod, out=prod)
+        sums["SSR"][..., cols] = np.nansum(prod, axis=-2)
+        sums["SSR_all"][..., cols] = np.sum(prod, axis=-2)
+
+        # reliability: data against itself with the sessions flipped
+        for name, (idx, data) in flips.items():
+            d = y if data == "Y" else yp
+            f = d[..., idx, :]
+            np.multiply(d, f, out=prod)
+            sums[f"{name}_SYF"][..., cols] = np.nansum(prod, axis=-2)
+            np.multiply(f, f, out=prod)
+            sums[f"{name}_SFF"][..., cols] = np.nansum(prod, axis=-2)
+            np.subtract(d, f, out=prod)
+            np.multiply(prod, prod, out=prod)
+            sums[f"{name}_SSRF"][..., cols] = np.nansum(prod, axis=-2)
+
+    data = {"rmse": np.mean(np.sqrt(sums["SSR_all"] / N), axis=-1)}
+    data["R_eval"], data["R_vox"] = _R_from_sums(sums["SYP"], sums["SST"], sums["SPP"])
+    data["R2"], data["R2_vox"] = _R2_from_sums(sums["SSR"], sums["SST"])
+    for name, (idx, data_name) in flips.items():
+        SST = sums["SST"] if data_name == "Y" else sums["SPP_all"]
+        data[f"{name}_R"], data[f"{name}_R_vox"] = _R_from_sums(sums[f"{name}_SYF"], SST, sums[f"{name}_SFF"])
+        data[f"{name}_R2"], data[f"{name}_R2_vox"] = _R2_from_sums(sums[f"{name}_SSRF"], SST)
+    return data
+
+def stack_models(models):
+    """Stacks the weights of fitted linear models (one per subject) for `predict`.
+
+    Works for all models that predict as (X / scale_) @ coef_.T (e.g. L2regression, WTA, NNLS).
+
+    Args:
+        models (list of fitted models): all with the same number of voxels and regions
+    Returns:
+        coef (nd-array): subjects x voxels x regions
+        scale (nd-array): subjects x regions
+    """
+    coef = np.stack([np.asarray(m.coef_) for m in models])
+    scale = np.stack([np.asarray(m.scale_) for m in models])
+    return coef, scale
+
+def predict(X, coef, scale):
+    """Predictions of stacked models (see stack_models) for stacked data.
+
+    Args:
+        X (nd-array): subjects x N x regions (or N x regions, used for all subjects)
+        coef (nd-array): subjects x voxels x regions
+        scale (nd-array): subjects x regions
+    Returns:
+        Y_pred (nd-array): subjects x N x voxels
+    """
+    Xs = np.nan_to_num(X / scale[:, np.newaxis, :]) # there are 0 values after scaling
+    return Xs @ np.swapaxes(coef, 1, 2)
+
+def calculate_group_metrics(Y, X, models, Y_sess=None, X_sess=None):
+    """Evaluates the models of all subjects in one call.
+
+    Args:
+        Y (nd-array): subjects x N x voxels
+        X (nd-array): subjects x N x regions
+        models (list of fitted models or tuple): one model per subject or output of stack_models
+        Y_sess, X_sess (1d-array or None): session of each row (see calculate_metrics)
+    Returns:
+        data (dict): metrics per subject (leading subject dimension)
+        group (dict): metrics averaged over subjects (nanmean)
+    """
+    coef, scale = models if isinstance(models, tuple) else stack_models(models)
+    data = calculate_metrics(Y, predict(X, coef, scale), Y_sess=Y_sess, X_sess=X_sess)
+    group = {k: np.nanmean(v, axis=0) for k, v in data.items()}
+    return data, group
+
+def _flip_index(sess):
+    """row index that swaps session 1 and 2 (see calculate_reliability)"""
+    sess = np.asarray(sess)
+    return np.r_[np.where(sess == 2)[0], np.where(sess == 1)[0]]
+
+def _R_from_sums(SYP, SST, SPP):
+    R = np.nansum(SYP, axis=-1) / np.sqrt(np.nansum(SST, axis=-1) * np.nansum(SPP, axis=-1))
+    R_vox = SYP / np.sqrt(SST * SPP)
+    return R, R_vox
+
+def _R2_from_sums(SSR, SST):
+    R2 = 1 - (np.nansum(SSR, axis=-1) / np.nansum(SST, axis=-1))
+    R2_vox = 1 - (SSR / SST)
+    return R2, R2_vox
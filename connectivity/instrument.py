@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import glob
+import functools
+import threading
+import contextlib
+import cProfile
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is not recorded
+    resource = None
+
+"""Timing and memory instrumentation of the train and eval stages.
+
+   Stages (load_mat, get_data, fit, cv, predict, evaluation, save, maps) are
+   wrapped in `stage` (or decorated with `timed`). Each stage records wall time,
+   CPU time of the process, peak RSS and the sizes of its arrays. If a log file
+   is configured (`configure` or the environment variable CONNECTIVITY_PERF_LOG),
+   every record is appended to it as one JSON line, together with the fields of
+   the enclosing `context` (e.g. model name) and the stage (e.g. subject).
+   Stages can also be profiled with cProfile or pyinstrument. `report`
+   summarizes where a sweep spent its time.
+
+   @authors: Maedbh King, Ladan Shahshahani, Jörn Diedrichsen
+
+  Typical usage example:
+
+  configure("perf.jsonl", profile="cprofile", profile_stages=["fit"])
+  with context(model="ridge_tessels0162_alpha_8"):
+      with stage("fit", subj="s02") as record:
+          fitted_model.fit(X, Y)
+          record["arrays"] = array_sizes(X=X, Y=Y)
+  df = report("perf.jsonl", by=["stage", "model"])
+"""
+
+_config = {"fname": os.environ.get("CONNECTIVITY_PERF_LOG"), "profile": None, "profile_stages": None, "profile_dir": None}
+_local = threading.local()
+_lock = threading.Lock()
+_profiling = threading.Event()
+_count = [0]
+
+def configure(fname=None, profile=None, profile_stages=None, profile_dir=None):
+    """Sets the log file and profiler (None switches them off)
+
+    Args:
+        fname (str or None): JSONL file the records are appended to
+        profile (str or None): 'cprofile' or 'pyinstrument'
+        profile_stages (list of str or None): stages to profile (None profiles all)
+        profile_dir (str or None): directory of the profiles, default is `{fname}_profiles`
+    """
+    if profile not in [None, "cprofile", "pyinstrument"]:
+        raise NameError("profile needs to be None, cprofile or pyinstrument")
+    if profile is not None and profile_dir is None:
+        profile_dir = f"{os.path.splitext(fname or 'perf')[0]}_profiles"
+    _config.update(fname=fname, profile=profile, profile_stages=profile_stages, profile_dir=profile_dir)
+
+def is_enabled():
+    return _config["fname"] is not None
+
+@contextlib.contextmanager
+def context(**fields):
+    """Adds `fields` (e.g. model name, exp) to all records of the stages inside (in this thread)"""
+    contexts = _contexts()
+    contexts.append(fields)
+    try:
+        yield
+    finally:
+        contexts.remove(fields)
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Measures the code inside as stage `name`
+
+    Args:
+        name (str): stage name, e.g. 'fit'
+        fields: added to the record (e.g. subj)
+    Yields:
+        record (dict): filled in when the stage ends (wall_s, cpu_s, rss_peak_mb, ...).
+            Add `arrays` (see array_sizes) or other fields inside the stage.
+    """
+    record = {"stage": name}
+    for c in list(_contexts()):
+        record.update(c)
+    record.update(fields)
+    stack = _stack()
+    record["parent"] = stack[-1] if stack else None
+    stack.append(name)
+
+    profiler = _start_profiler(name)
+    rss = _peak_rss()
+    start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        record["start"] = start
+        if rss is not None:
+            record["rss_peak_mb"] = _peak_rss()
+            record["rss_rise_mb"] = record["rss_peak_mb"] - rss
+        record["pid"] = os.getpid()
+        record["thread"] = threading.current_thread().name
+        stack.pop()
+        if profiler is not None:
+            record["profile"] = _stop_profiler(profiler, name)
+        _write(record)
+
+def timed(name=None, attrs=[], arrays=[]):
+    """Decorator, runs the function as a stage (default name is the function name)
+
+    Sizes of the arrays returned by the function are recorded as `result`. For methods,
+    `attrs` of the object (e.g. subj_id) are added to the record, and the sizes of
+    its `arrays` (e.g. data) after the call.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            fields = {k: getattr(args[0], k, None) for k in attrs}
+            with stage(name or func.__name__, **fields) as record:
+                result = func(*args, **kwargs)
+                values = result if isinstance(result, tuple) else (result,)
+                sizes = {f"result{i}": v for i, v in enumerate(values) if isinstance(v, np.ndarray)}
+                sizes.update({k: getattr(args[0], k, None) for k in arrays})
+                record["arrays"] = array_sizes(**sizes)
+            return result
+        return wrapper
+    return decorator
+
+def array_sizes(**arrays):
+    """returns shape and size in MB of each array (None is skipped)"""
+    sizes = {}
+    for k, v in arrays.items():
+        if v is not None:
+            v = np.asarray(v)
+            sizes[k] = {"shape": list(v.shape), "mb": v.nbytes / 2**20}
+    return sizes
+
+def read_log(fname):
+    """Reads the records of one or more log files
+
+    Args:
+        fname (str or list of str): JSONL files (glob patterns are expanded)
+    Returns:
+        pandas dataframe, one row per record
+    """
+    fnames = [fname] if isinstance(fname, (str, os.PathLike)) else fname
+    records = []
+    for pattern in fnames:
+        for f in sorted(glob.glob(str(pattern))):
+            with open(f) as file:
+                records.extend(json.loads(line) for line in file if line.strip())
+    return pd.DataFrame.from_records(records)
+
+def report(fname, by=["stage"], stages=None):
+    """Summarizes where a sweep spent its time
+
+    Args:
+        fname (str or list of str): JSONL files (glob patterns are expanded)
+        by (list of str): record fields to group by (e.g. ['stage', 'model'])
+        stages (list of str or None): only these stages
+    Returns:
+        pandas dataframe with count, wall time (total, mean, max), cpu time, peak RSS and
+        share of the elapsed time of the sweep (summed over processes), sorted by wall time
+    """
+    df = read_log(fname)
+    if df.empty:
+        return df
+    # stages of one process overlap (nested stages, prefetch thread)
+    end = df["start"] + df["wall_s"]
+    total = (end.groupby(df["pid"]).max() - df["start"].groupby(df["pid"]).min()).sum()
+    if stages is not None:
+        df = df[df["stage"].isin(stages)]
+    if "rss_peak_mb" not in df:
+        df["rss_peak_mb"] = np.nan
+    # records without a field (e.g. no model) form their own group
+    df[by] = df[by].fillna("")
+    summary = df.groupby(by).agg(
+        count=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        wall_mean_s=("wall_s", "mean"),
+        wall_max_s=("wall_s", "max"),
+        cpu_s=("cpu_s", "sum"),
+        rss_peak_mb=("rss_peak_mb", "max"))
+    summary["share"] = summary["wall_s"] / total if total > 0 else np.nan
+    return summary.sort_values("wall_s", ascending=False).reset_index()
+
+def _stack():
+    """names of the open stages of this thread"""
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def _contexts():
+    """fields of the open contexts of this thread"""
+    if not hasattr(_local, "contexts"):
+        _local.contexts = []
+    return _local.contexts
+
+def _peak_rss():
+    """peak resident set size of the process in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def _write(record):
+    if _config["fname"] is None:
+        return
+    line = json.dumps(record, default=_to_builtin) + "\n"
+    with _lock:
+        with open(_config["fname"], "a") as file:
+            file.write(line)
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def _start_profiler(name):
+    """starts the profiler for stage `name` (only one stage of the process is profiled at a time)"""
+    if _config["profile"] is None or (_config["profile_stages"] is not None and name not in _config["profile_stages"]):
+        return None
+    with _lock:
+        if _profiling.is_set():
+            return None
+        _profiling.set()
+    if _config["profile"] == "pyinstrument":
+        # optional dependency, only needed for this profiler
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+def _stop_profiler(profiler, name):
+    """stops the profiler and saves the profile, returns its filename"""
+    with _lock:
+        _count[0] += 1
+        n = _count[0]
+    os.makedirs(_config["profile_dir"], exist_ok=True)
+    fname = os.path.join(_config["profile_dir"], f"{name}_{os.getpid()}_{n}")
+    if _config["profile"] == "pyinstrument":
+        profiler.stop()
+        fname += ".html"
+        with open(fname, "w") as file:
+            file.write(profiler.output_html())
+    else:
+        profiler.disable()
+        fname += ".prof"
+        profiler.dump_stats(fname)
+    _profiling.clear()
+    return fname
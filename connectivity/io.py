@@ -123,3 +123,104 @@ def make_dirs(fpath):
     if not os.path.exists(fpath):
         print(f"creating {fpath}")
         os.makedirs(fpath)
+
+
+class VoxelMaps:
+    """Per-voxel maps (subjects x voxels) for several metrics, streamed to disk.
+
+    Each metric is a preallocated .npy file that is memory-mapped, so a subject's
+    row is written as soon as it is finished and nothing is kept in memory. The
+    index (`index.json`) records finished subjects and their summary rows, so a
+    crashed run can be resumed. If `key` differs from the stored key, the maps
+    are started from scratch. A subject is also evaluated again if the fingerprint
+    of its inputs (e.g. the trained model file) has changed.
+
+    Attributes:
+        fpath (str): directory holding `<metric>.npy` and `index.json`
+        subjects (list of str): row order of the maps
+        key (str or None): identifies the run (e.g. a config hash)
+        updated (list of str): subjects written by this instance
+    """
+
+    def __init__(self, fpath, subjects, key=None):
+        """Inits VoxelMaps, resuming from `fpath` if it holds maps with the same key and subjects."""
+        self.fpath = str(fpath)
+        self.subjects = list(subjects)
+        self.key = key
+        self.updated = []
+        make_dirs(self.fpath)
+        self.index = {"key": key, "subjects": self.subjects, "done": {}, "fingerprints": {}, "metrics": []}
+        fname = os.path.join(self.fpath, "index.json")
+        if os.path.isfile(fname):
+            index = read_json(fname)
+            if index["key"] == key and index["subjects"] == self.subjects:
+                self.index = index
+                self.index.setdefault("fingerprints", {})
+
+    def is_done(self, subj, fingerprint=None):
+        """True if `subj` is finished (with the same input fingerprint, if given)"""
+        if subj not in self.index["done"]:
+            return False
+        return fingerprint is None or self.index["fingerprints"].get(subj) == fingerprint
+
+    def summary(self, subj):
+        """returns summary row saved with the maps of `subj`"""
+        return self.index["done"][subj]
+
+    def metrics(self):
+        return list(self.index["metrics"])
+
+    def write(self, subj, voxels, summary=None, fingerprint=None):
+        """Writes the maps of one subject and marks it as done
+
+        Args:
+            subj (str): subject id (must be in `subjects`)
+            voxels (dict): metric -> 1d array (voxels,)
+            summary (dict or None): summary row saved in the index (scalars only)
+            fingerprint (str or None): fingerprint of the inputs of `subj` (see is_done)
+        """
+        row = self.subjects.index(subj)
+        for metric, values in voxels.items():
+            data = self.load(metric, mmap_mode="r+", num_vox=len(values))
+            data[row, :] = values
+            data.flush()
+            del data
+            if metric not in self.index["metrics"]:
+                self.index["metrics"].append(metric)
+        summary = summary or {}
+        self.index["done"][subj] = {k: (v.item() if isinstance(v, np.generic) else v) for k, v in summary.items()}
+        self.index["fingerprints"][subj] = fingerprint
+        self._save_index()
+        if subj not in self.updated:
+            self.updated.append(subj)
+
+    def load(self, metric, mmap_mode="r", num_vox=None):
+        """Returns memory-mapped array (subjects x voxels) of `metric` (rows not yet written are NaN)"""
+        fname = os.path.join(self.fpath, f"{metric}.npy")
+        if not os.path.isfile(fname) or (metric not in self.index["metrics"] and num_vox is not None):
+            data = np.lib.format.open_memmap(fname, mode="w+", dtype=float, shape=(len(self.subjects), num_vox))
+            data[:] = np.nan
+            data.flush()
+            del data
+        return np.load(fname, mmap_mode=mmap_mode)
+
+    def group_mean(self, metric):
+        """NaN-mean over subjects, accumulated one subject at a time
+
+        Returns:
+            mean (1d array): (voxels,)
+        """
+        data = self.load(metric)
+        total = np.zeros(data.shape[1])
+        count = np.zeros(data.shape[1])
+        for row in range(data.shape[0]):
+            values = np.asarray(data[row])
+            valid = ~np.isnan(values)
+            total[valid] += values[valid]
+            count += valid
+        return total / count
+
+    def _save_index(self):
+        fname = os.path.join(self.fpath, "index.json")
+        save_dict_as_JSON(fname + ".tmp", self.index)
+        os.replace(fname + ".tmp", fname)
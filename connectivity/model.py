@@ -1,8 +1,13 @@
 from operator import index
 import os
+import sys
+import json
 import time
+import h5py
+import deepdish as dd
 import numpy as np
 import pandas as pd
+import sklearn
 # import quadprog as qp
 # import cvxopt
 from scipy import sparse
@@ -68,6 +73,231 @@ class L2regression(Ridge, ModelMixin):
         Xs = np.nan_to_num(Xs) # there are 0 values after scaling
         return Xs @ self.coef_.T  # weights need to be transposed (throws error otherwise)
 
+def fit_ridge_batched(X, Y, alpha=1):
+    """
+    Fits one L2regression model per subject for subjects that share the same design
+
+    All subjects are solved together with batched np.linalg.solve: in the primal form
+    (Xs'Xs + alpha*I) if there are fewer regressors than conditions, otherwise in the
+    dual form (Xs Xs' + alpha*I), as the cholesky solver of Ridge does.
+    Args:
+        X (np-array): subjects x N x P (cortical data)
+        Y (np-array): subjects x N x Q (cerebellar data)
+        alpha (float): regularization parameter
+    Returns:
+        models (list): fitted L2regression models (one per subject), identical to L2regression(alpha).fit(X[s], Y[s])
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    num_subj, N, P = X.shape
+
+    scale = np.sqrt(np.nansum(X ** 2, 1) / N)
+    Xs = np.nan_to_num(X / scale[:, np.newaxis, :]) # there are 0 values after scaling
+    XsT = Xs.transpose(0, 2, 1)
+    if P > N:
+        K = Xs @ XsT
+        K[:, np.arange(N), np.arange(N)] += alpha
+        coef = XsT @ np.linalg.solve(K, Y)
+    else:
+        A = XsT @ Xs
+        A[:, np.arange(P), np.arange(P)] += alpha
+        coef = np.linalg.solve(A, XsT @ Y)
+
+    models = []
+    for s in range(num_subj):
+        new_model = L2regression(alpha=alpha)
+        new_model.scale_ = scale[s]
+        new_model.coef_ = np.ascontiguousarray(coef[s].T)
+        new_model.intercept_ = 0.0
+        new_model.n_features_in_ = P
+        models.append(new_model)
+    return models
+
+class ReducedRankRidge(BaseEstimator, ModelMixin):
+    """
+    Reduced-rank ridge connectivity model
+
+    Fits ridge regression like L2regression (scaling by stdev, no intercept) and keeps the
+    projection onto the `rank` principal directions of the fitted cerebellar data. The
+    weights are stored in factored form coef_ = U_ @ V_.T, with U_ (voxels x rank) and
+    V_ (regions x rank), and predictions are computed as (Xs @ V_) @ U_.T.
+    """
+
+    def __init__(self, alpha=1, rank=10):
+        self.alpha = alpha
+        self.rank = rank
+
+    def fit(self, X, Y):
+        self.scale_ = np.sqrt(np.nansum(X ** 2, 0) / X.shape[0])
+        Xs = X / self.scale_
+        Xs = np.nan_to_num(Xs) # there are 0 values after scaling
+        B = Ridge(alpha=self.alpha, fit_intercept=False).fit(Xs, Y).coef_.T
+        # principal directions of the fitted data
+        _, _, Vt = np.linalg.svd(Xs @ B, full_matrices=False)
+        self.U_ = np.ascontiguousarray(Vt[:self.rank].T)
+        self.V_ = B @ self.U_
+        return self
+
+    @property
+    def coef_(self):
+        return self.U_ @ self.V_.T
+
+    def predict(self, X):
+        Xs = X / self.scale_
+        Xs = np.nan_to_num(Xs) # there are 0 values after scaling
+        return (Xs @ self.V_) @ self.U_.T
+
+class IncrementalRidge(BaseEstimator, ModelMixin):
+    """
+    Ridge (alpha > 0) or OLS (alpha = 0) regression from accumulated cross-products X'X and X'Y
+
+    Data (e.g. subjects or sessions) can be added with partial_fit and removed again with
+    remove, so group models and leave-one-subject-out models need one update per subject
+    instead of a refit. Like L2regression, the regressors are scaled by their root mean
+    square (over all added data) and there is no intercept. The eigendecomposition of the
+    scaled X'X is cached, so coefficients for any alpha only cost one matrix product.
+    """
+
+    def __init__(self, alpha=1):
+        self.alpha = alpha
+
+    def fit(self, X, Y):
+        for attr in ["XtX_", "XtY_", "n_"]:
+            self.__dict__.pop(attr, None)
+        return self.partial_fit(X, Y)
+
+    def partial_fit(self, X, Y):
+        """adds the contribution of X (N x P) and Y (N x Q)"""
+        return self._update(X, Y, 1)
+
+    def remove(self, X, Y):
+        """removes the contribution of X and Y (added before with partial_fit)"""
+        return self._update(X, Y, -1)
+
+    @property
+    def scale_(self):
+        with np.errstate(invalid="ignore"):
+            return np.sqrt(np.diag(self.XtX_) / self.n_)
+
+    @property
+    def coef_(self):
+        return self.get_coef()
+
+    def get_coef(self, alpha=None):
+        """
+        Returns coef_ (Q x P, for the scaled regressors as in L2regression) for `alpha` (default: self.alpha)
+        """
+        alpha = self.alpha if alpha is None else alpha
+        if getattr(self, "_eig", None) is None:
+            scale = self.scale_
+            inv_scale = np.divide(1, scale, out=np.zeros_like(scale), where=scale > 0)
+            XstXs = self.XtX_ * np.outer(inv_scale, inv_scale)
+            evals, evecs = np.linalg.eigh(XstXs)
+            self._eig = (evals, evecs, evecs.T @ (self.XtY_ * inv_scale.reshape(-1, 1)))
+        evals, evecs, VtXY = self._eig
+        denom = evals + alpha
+        # for OLS (alpha=0) directions without variance are dropped (pseudo-inverse)
+        tol = max(evals.max(), 0) * len(evals) * np.finfo(float).eps
+        inv = np.divide(1, denom, out=np.zeros_like(denom), where=denom > tol)
+        return (evecs @ (inv.reshape(-1, 1) * VtXY)).T
+
+    def get_model(self, alpha=None):
+        """Returns an L2regression model with the coefficients for `alpha` (e.g. to save with save_model)"""
+        alpha = self.alpha if alpha is None else alpha
+        new_model = L2regression(alpha=alpha)
+        new_model.scale_ = self.scale_
+        new_model.coef_ = self.get_coef(alpha)
+        new_model.intercept_ = 0.0
+        new_model.n_features_in_ = self.XtX_.shape[0]
+        return new_model
+
+    def predict(self, X, alpha=None):
+        Xs = X / self.scale_
+        Xs = np.nan_to_num(Xs) # there are 0 values after scaling
+        return Xs @ self.get_coef(alpha).T
+
+    def _update(self, X, Y, sign):
+        X = np.nan_to_num(np.asarray(X, dtype=float))
+        Y = np.asarray(Y, dtype=float)
+        if not hasattr(self, "XtX_"):
+            self.XtX_ = np.zeros((X.shape[1], X.shape[1]))
+            self.XtY_ = np.zeros((X.shape[1], Y.shape[1]))
+            self.n_ = 0
+        self.XtX_ += sign * (X.T @ X)
+        self.XtY_ += sign * (X.T @ Y)
+        self.n_ += sign * X.shape[0]
+        self._eig = None
+        return self
+
+def leave_one_subject_out(X, Y, alphas):
+    """
+    Group ridge models fitted without each subject, for several alphas
+
+    Costs one update per subject (plus one per left-out subject) and one
+    eigendecomposition per left-out subject, instead of a refit per subject and alpha.
+    Args:
+        X (list or np-array): subjects x N x P (cortical data)
+        Y (list or np-array): subjects x N x Q (cerebellar data)
+        alphas (list): regularization parameters
+    Returns:
+        models (dict): alpha -> list of L2regression models (the s-th model leaves out subject s)
+    """
+    group_model = IncrementalRidge()
+    for X_subj, Y_subj in zip(X, Y):
+        group_model.partial_fit(X_subj, Y_subj)
+
+    models = {alpha: [] for alpha in alphas}
+    for X_subj, Y_subj in zip(X, Y):
+        group_model.remove(X_subj, Y_subj)
+        for alpha in alphas:
+            models[alpha].append(group_model.get_model(alpha))
+        group_model.partial_fit(X_subj, Y_subj)
+    return models
+
+class RidgePath:
+    """
+    L2regression solutions for any alpha from one eigendecomposition of the kernel Xs Xs'
+
+    With the kernel K = Xs Xs' = W diag(evals) W', the ridge coefficients are
+    coef_ = (Xs' W diag(1 / (evals + alpha)) W' Y)', so after the decomposition every
+    alpha (> 0) only costs matrix products of size N. Predictions for held-out data
+    (e.g. a CV fold) are cached in the same form.
+
+    Attributes:
+        scale_ (np-array): scale of the regressors (as L2regression)
+        Y (np-array): training data (N x Q)
+        Y_test (np-array or None): held-out data
+    """
+
+    def __init__(self, X, Y, X_test=None, Y_test=None):
+        self.scale_ = np.sqrt(np.nansum(X ** 2, 0) / X.shape[0])
+        self._Xs = np.nan_to_num(X / self.scale_) # there are 0 values after scaling
+        self.evals, self._W = np.linalg.eigh(self._Xs @ self._Xs.T)
+        self.Y = Y
+        self._WtY = self._W.T @ Y
+        self.Y_test = Y_test
+        self._G = None
+        if X_test is not None:
+            Xs_test = np.nan_to_num(X_test / self.scale_)
+            self._G = Xs_test @ self._Xs.T @ self._W
+
+    def get_model(self, alpha):
+        """Returns the fitted L2regression model for `alpha`"""
+        new_model = L2regression(alpha=alpha)
+        new_model.scale_ = self.scale_
+        new_model.coef_ = np.ascontiguousarray((self._Xs.T @ (self._W / (self.evals + alpha))) @ self._WtY).T
+        new_model.intercept_ = 0.0
+        new_model.n_features_in_ = self._Xs.shape[1]
+        return new_model
+
+    def predict_train(self, alpha):
+        """Predictions for the training data"""
+        return self._W @ ((self.evals / (self.evals + alpha)).reshape(-1, 1) * self._WtY)
+
+    def predict_test(self, alpha):
+        """Predictions for the held-out data"""
+        return self._G @ (self._WtY / (self.evals + alpha).reshape(-1, 1))
+
 class LASSO(Lasso, ModelMixin):
     """
     L2 regularized connectivity model
@@ -394,3 +624,190 @@ class WNTA(Ridge, ModelMixin):
         Xs = X / self.scale_
         Xs = np.nan_to_num(Xs) # there are 0 values after scaling
         return Xs @ self.coef_.T  # weights need to be transposed (throws error otherwise)
+
+
+ARTIFACT_FORMAT = "connectivity-model"
+ARTIFACT_VERSION = 1
+METRICS = ["rmse_train", "R_train", "rmse_cv", "R_cv"]
+
+def save_model(fname, fitted_model, config_hash=None, data_hash=None):
+    """
+    Saves a fitted model as model artifact (HDF5 file with plain datasets and attributes)
+
+    Fitted arrays (coef_, scale_, ...) are stored as uncompressed, contiguous datasets,
+    so coef_ can be memory-mapped (see load_model). Model class, parameters, metrics,
+    hashes and library versions are stored as attributes. Models with attributes that
+    are not arrays or scalars (e.g. nested estimators) are pickled with deepdish as before.
+    The file is written under a temporary name and renamed.
+    Args:
+        fname (str): path of the .h5 file
+        fitted_model (model instance): fitted connectivity model
+        config_hash (str or None): hash of the training config
+        data_hash (str or None): fingerprint of the training data
+    """
+    params = fitted_model.get_params() if hasattr(fitted_model, "get_params") else {}
+    arrays, scalars, metrics = {}, {}, {}
+    is_plain = _is_json(params)
+    for key, value in vars(fitted_model).items():
+        if key in params or key in ["config_hash_", "data_hash_"]:
+            continue
+        if key in METRICS:
+            metrics[key] = _to_builtin(value)
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            arrays[key] = value
+        elif _is_json(_to_builtin(value)):
+            scalars[key] = _to_builtin(value)
+        else:
+            is_plain = False
+
+    tmp_name = os.path.join(os.path.dirname(fname), "." + os.path.basename(fname) + ".tmp")
+    if not is_plain:
+        dd.io.save(tmp_name, fitted_model, compression=None)
+        os.replace(tmp_name, fname)
+        return
+
+    with h5py.File(tmp_name, "w") as f:
+        f.attrs["format"] = ARTIFACT_FORMAT
+        f.attrs["format_version"] = ARTIFACT_VERSION
+        f.attrs["model_class"] = type(fitted_model).__name__
+        f.attrs["params"] = json.dumps(params)
+        f.attrs["scalars"] = json.dumps(scalars)
+        f.attrs["metrics"] = json.dumps(metrics)
+        f.attrs["config_hash"] = config_hash or ""
+        f.attrs["data_hash"] = data_hash or ""
+        f.attrs["versions"] = json.dumps({
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "sklearn": sklearn.__version__,
+            "h5py": h5py.__version__})
+        for key, value in arrays.items():
+            f.create_dataset(key, data=np.ascontiguousarray(value))
+    os.replace(tmp_name, fname)
+
+def load_model(fname):
+    """
+    Loads a fitted model saved with save_model (or pickled with deepdish)
+    Args:
+        fname (str): path of the .h5 file
+    Returns:
+        ModelArtifact (or the unpickled model for deepdish files)
+    """
+    if is_artifact(fname):
+        return ModelArtifact(fname)
+    return dd.io.load(fname)
+
+def load_coef(fname):
+    """
+    Returns coef_ (voxels x regions) of a saved model, memory-mapped for model artifacts
+    (computed from the factors for reduced-rank models)
+    """
+    return load_model(fname).coef_
+
+def load_factors(fname):
+    """
+    Returns the factors (U_, V_) of a saved reduced-rank model (coef_ = U_ @ V_.T), or None for other models
+    """
+    fitted_model = load_model(fname)
+    if isinstance(fitted_model, ModelArtifact):
+        if "U_" not in fitted_model._array_names:
+            return None
+    elif not hasattr(fitted_model, "U_"):
+        return None
+    return np.asarray(fitted_model.U_), np.asarray(fitted_model.V_)
+
+def is_factored(fname):
+    """checks whether `fname` is a reduced-rank model artifact (reads the HDF5 header only)"""
+    with h5py.File(fname, "r") as f:
+        return f.attrs.get("format") == ARTIFACT_FORMAT and "U_" in f
+
+def is_artifact(fname):
+    """checks whether `fname` is a model artifact (see save_model)"""
+    with h5py.File(fname, "r") as f:
+        return f.attrs.get("format") == ARTIFACT_FORMAT
+
+class ModelArtifact:
+    """
+    Fitted model read from a model artifact (see save_model)
+
+    Arrays are read on first access; coef_ is memory-mapped. The estimator is only
+    rebuilt (model class + parameters + fitted arrays) when `predict` is called.
+    Attributes:
+        fname (str): path of the .h5 file
+        model_class (str): name of the class in model.py
+        params (dict): parameters of the model constructor
+        metrics (dict): training metrics (rmse_train, R_train, rmse_cv, R_cv)
+        config_hash_, data_hash_ (str): hashes of the training config and data
+        versions (dict): library versions used for training
+    """
+
+    def __init__(self, fname):
+        self.fname = str(fname)
+        with h5py.File(self.fname, "r") as f:
+            if f.attrs["format_version"] > ARTIFACT_VERSION:
+                raise ValueError(f"{fname} has format version {f.attrs['format_version']}, newer than {ARTIFACT_VERSION}")
+            self.model_class = f.attrs["model_class"]
+            self.params = json.loads(f.attrs["params"])
+            self.metrics = json.loads(f.attrs["metrics"])
+            self.versions = json.loads(f.attrs["versions"])
+            self.config_hash_ = f.attrs["config_hash"] or None
+            self.data_hash_ = f.attrs["data_hash"] or None
+            self._scalars = json.loads(f.attrs["scalars"])
+            self._array_names = list(f.keys())
+        self._arrays = {}
+        self._estimator = None
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set in __init__
+        if name.startswith("__") or name in ["_arrays", "_array_names", "_scalars", "_estimator"]:
+            raise AttributeError(name)
+        if name in self._array_names:
+            if name not in self._arrays:
+                self._arrays[name] = self._read_array(name)
+            return self._arrays[name]
+        if name == "coef_" and "U_" in self._array_names:
+            # reduced-rank models store the factors only
+            return self.U_ @ self.V_.T
+        if name in self._scalars:
+            return self._scalars[name]
+        if name in self.metrics:
+            return self.metrics[name]
+        raise AttributeError(f"{self.model_class} artifact has no attribute {name}")
+
+    def get_params(self, deep=True):
+        return dict(self.params)
+
+    def estimator(self):
+        """Returns the rebuilt estimator (built once)"""
+        if self._estimator is None:
+            new_model = globals()[self.model_class](**self.params)
+            for name in self._array_names:
+                setattr(new_model, name, np.asarray(getattr(self, name)))
+            for name, value in {**self._scalars, **self.metrics}.items():
+                setattr(new_model, name, value)
+            self._estimator = new_model
+        return self._estimator
+
+    def predict(self, X):
+        return self.estimator().predict(X)
+
+    def _read_array(self, name):
+        """memory-maps contiguous datasets (coef_), reads all others"""
+        with h5py.File(self.fname, "r") as f:
+            dataset = f[name]
+            offset = dataset.id.get_offset()
+            if name == "coef_" and offset is not None and dataset.chunks is None:
+                return np.memmap(self.fname, mode="r", dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+            return dataset[()]
+
+def _to_builtin(value):
+    """converts numpy scalars to python builtins (for JSON)"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _is_json(value):
+    try:
+        json.dumps(value)
+    except TypeError:
+        return False
+    return True
@@ -0,0 +1,220 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
+
+import connectivity.model as model
+import connectivity.evaluation as ev
+import connectivity.shared as cshared
+
+"""Permutation and bootstrap tests for connectivity model evaluation.
+
+   Null distributions are built by permuting the rows (conditions) of the
+   training targets, refitting the model and evaluating it on the evaluation
+   data. For L2regression the fit is linear in the targets, so the predictions
+   for a whole batch of permutations are one matmul of the hat matrix with the
+   stacked permuted targets. All other models are refitted in a process pool;
+   the data are put in shared memory once (python >= 3.8), so the tasks only carry
+   the permutations.
+
+   @authors: Maedbh King, Ladan Shahshahani, Jörn Diedrichsen
+
+  Typical usage example:
+
+  result = permutation_test(model.L2regression(alpha=1), X, Y, X_eval, Y_eval, Y_sess=sess, X_sess=sess, n_perm=5000)
+  low, high = bootstrap_ci(R_vox_subjects, n_boot=10000)
+"""
+
+def permutation_indices(n, n_perm, batch_size=100, groups=None, random_state=None):
+    """Generates batches of row permutations.
+
+    Args:
+        n (int): number of rows
+        n_perm (int): total number of permutations
+        batch_size (int): permutations per batch
+        groups (1d-array or None): if given, rows are only permuted within groups (e.g. sessions)
+        random_state (int or None): seed
+    Yields:
+        perms (nd-array): batch x n array of row indices
+    """
+    rng = np.random.default_rng(random_state)
+    for start in range(0, n_perm, batch_size):
+        b = min(batch_size, n_perm - start)
+        perms = np.tile(np.arange(n), (b, 1))
+        if groups is None:
+            perms = rng.permuted(perms, axis=1)
+        else:
+            groups = np.asarray(groups)
+            for g in np.unique(groups):
+                idx = np.where(groups == g)[0]
+                perms[:, idx] = rng.permuted(perms[:, idx], axis=1)
+        yield perms
+
+def permutation_test(
+    estimator,
+    X,
+    Y,
+    X_eval,
+    Y_eval,
+    Y_sess=None,
+    X_sess=None,
+    pred_index=None,
+    n_perm=1000,
+    batch_size=50,
+    groups=None,
+    workers=1,
+    random_state=None
+    ):
+    """Permutation test for the evaluation of a connectivity model.
+
+    The observed model is fitted on (X, Y), the null models on (X, Y[perm]).
+
+    Args:
+        estimator (model instance): connectivity model (see model.py), fitted or not
+        X, Y (nd-array): training data (Y already crossed if mode is 'crossed')
+        X_eval, Y_eval (nd-array): evaluation data
+        Y_sess, X_sess (1d-array or None): sessions of the evaluation data. Needed for the
+            noise-ceiling-corrected R (R_nc)
+        pred_index (1d-array or None): row order of the predictions (e.g. flipped sessions for 'crossed')
+        n_perm (int): number of permutations
+        batch_size (int): permutations evaluated together
+        groups (1d-array or None): permute only within groups of training rows
+        workers (int): worker processes for models that are not linear in Y
+        random_state (int or None): seed
+    Returns:
+        result (dict): with keys
+            observed (dict): R_eval, R_vox (and R_nc, R_nc_vox)
+            null (dict): R_eval, R_vox_max (and R_nc, R_nc_vox_max), one value per permutation
+            p (dict): p-values for R_eval and R_nc, and per voxel (uncorrected and corrected by the max statistic)
+    """
+    Y_noise = _noise_Y(Y_eval, Y_sess)
+    observed = _evaluate(estimator, X, Y, X_eval, Y_eval, np.arange(Y.shape[0])[np.newaxis], Y_noise, X_sess, pred_index)
+    observed = {k: v[0] for k, v in observed.items()}
+
+    null = {k: [] for k in observed if "vox" not in k}
+    null.update({f"{k}_max": [] for k in observed if "vox" in k})
+    count = {k: np.zeros(v.shape) for k, v in observed.items() if "vox" in k}
+
+    batches = permutation_indices(Y.shape[0], n_perm, batch_size=batch_size, groups=groups, random_state=random_state)
+    args = (X, Y, X_eval, Y_eval)
+    kwargs = {"Y_noise": Y_noise, "X_sess": X_sess, "pred_index": pred_index}
+    if _is_linear(estimator) or workers <= 1:
+        results = (_evaluate(estimator, *args, perms, **kwargs) for perms in batches)
+        _collect(results, observed, null, count)
+    elif not cshared.is_available():
+        # every task gets a copy of the data
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_evaluate, estimator, *args, perms, **kwargs) for perms in batches]
+            _collect((f.result() for f in futures), observed, null, count)
+    else:
+        with cshared.SharedArrays() as arrays, ProcessPoolExecutor(max_workers=workers) as executor:
+            for key, array in zip(["X", "Y", "X_eval", "Y_eval"], args):
+                arrays.put(key, array)
+            futures = [executor.submit(_evaluate_shared, estimator, arrays.registry, perms, **kwargs) for perms in batches]
+            _collect((f.result() for f in futures), observed, null, count)
+
+    null = {k: np.concatenate(v) for k, v in null.items()}
+    p = {}
+    for k, v in observed.items():
+        if "vox" in k:
+            p[k] = (1 + count[k]) / (1 + n_perm)
+            p[f"{k}_fwe"] = (1 + np.sum(null[f"{k}_max"][:, np.newaxis] >= v, axis=0)) / (1 + n_perm)
+        else:
+            p[k] = (1 + np.sum(null[k] >= v)) / (1 + n_perm)
+    return {"observed": observed, "null": null, "p": p}
+
+def bootstrap_ci(values, n_boot=10000, ci=95, batch_size=1000, random_state=None):
+    """Bootstrap confidence interval of the mean over the first axis (e.g. subjects).
+
+    Args:
+        values (nd-array): subjects or subjects x voxels (nans are ignored)
+        n_boot (int): number of bootstrap samples
+        ci (float): size of the confidence interval in percent
+        batch_size (int): bootstrap samples drawn together
+        random_state (int or None): seed
+    Returns:
+        low, high (scalar or 1d-array): bounds of the confidence interval
+    """
+    values = np.asarray(values, dtype=float)
+    rng = np.random.default_rng(random_state)
+    n = values.shape[0]
+    means = []
+    for start in range(0, n_boot, batch_size):
+        idx = rng.integers(0, n, size=(min(batch_size, n_boot - start), n))
+        means.append(np.nanmean(values[idx], axis=1))
+    means = np.concatenate(means)
+    alpha = (100 - ci) / 2
+    low, high = np.nanpercentile(means, [alpha, 100 - alpha], axis=0)
+    return low, high
+
+def _is_linear(estimator):
+    """models whose predictions are linear in the training targets"""
+    return type(estimator) is model.L2regression
+
+def _noise_Y(Y_eval, Y_sess):
+    """reliability of the evaluation data (does not depend on the model)"""
+    if Y_sess is None:
+        return None
+    R, R_vox, _, _ = ev.calculate_reliability(Y_eval, {"sess": Y_sess})
+    return R, R_vox
+
+def _evaluate(estimator, X, Y, X_eval, Y_eval, perms, Y_noise=None, X_sess=None, pred_index=None):
+    """evaluates the models fitted to the permuted targets Y[perms]
+
+    Returns:
+        dict of R_eval (batch,), R_vox (batch x voxels), and if Y_noise is given R_nc, R_nc_vox
+    """
+    if _is_linear(estimator):
+        Y_pred = _predict_linear(estimator.alpha, X, Y, X_eval, perms)
+    else:
+        Y_pred = np.stack([_refit(estimator, X, Y[p]).predict(X_eval) for p in perms])
+    if pred_index is not None:
+        Y_pred = Y_pred[:, pred_index, :]
+
+    metrics = ev.calculate_metrics(
+        np.broadcast_to(Y_eval, Y_pred.shape),
+        Y_pred,
+        X_sess=X_sess if Y_noise is not None else None)
+    data = {"R_eval": metrics["R_eval"], "R_vox": metrics["R_vox"]}
+    if Y_noise is not None:
+        # noise-ceiling-corrected R (see visualize.get_summary)
+        noise_R, noise_R_vox = Y_noise
+        data["R_nc"] = data["R_eval"] / ev.calculate_noiseceiling(noise_R, metrics["noise_X_R"])
+        data["R_nc_vox"] = data["R_vox"] / ev.calculate_noiseceiling(noise_R_vox, metrics["noise_X_R_vox"])
+    return data
+
+def _evaluate_shared(estimator, registry, perms, **kwargs):
+    """_evaluate in a worker process, on the data shared by permutation_test"""
+    data = cshared.attach(registry)
+    return _evaluate(estimator, data["X"], data["Y"], data["X_eval"], data["Y_eval"], perms, **kwargs)
+
+def _refit(estimator, X, Y):
+    """fits a fresh copy of `estimator`"""
+    new_model = clone(estimator)
+    new_model.fit(X, Y)
+    return new_model
+
+def _predict_linear(alpha, X, Y, X_eval, perms):
+    """Predictions of L2regression models fitted to Y[perms], for all permutations at once.
+
+    With scaled regressors Xs the ridge fit is coef_.T = (Xs'Xs + alpha*I)^-1 Xs' Y,
+    so the predictions are H @ Y[perm] with the hat matrix H = Xs_eval (Xs'Xs + alpha*I)^-1 Xs'.
+    Scaling only depends on X, which is not permuted.
+    """
+    scale = np.sqrt(np.nansum(X ** 2, 0) / X.shape[0])
+    Xs = np.nan_to_num(X / scale)
+    Xs_eval = np.nan_to_num(X_eval / scale)
+    A = np.linalg.solve(Xs.T @ Xs + alpha * np.eye(Xs.shape[1]), Xs.T)
+    H = Xs_eval @ A
+    # H @ Y[p] equals H[:, inverse(p)] @ Y, which avoids stacking the permuted targets
+    inverse = np.argsort(perms, axis=1)
+    return H[:, inverse].transpose(1, 0, 2) @ Y
+
+def _collect(results, observed, null, count):
+    """accumulates null values, voxel maxima and voxel exceedance counts over batches"""
+    for data in results:
+        for k, v in data.items():
+            if "vox" in k:
+                null[f"{k}_max"].append(np.nanmax(v, axis=1))
+                count[k] += np.sum(v >= observed[k], axis=0)
+            else:
+                null[k].append(v)
@@ -0,0 +1,365 @@
+import os
+import json
+import uuid
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import connectivity.io as cio
+
+"""Task-graph runner for the connectivity pipeline (train -> select best -> eval -> maps).
+
+   Every step declares the files it reads (inputs) and writes (outputs).
+   Dependencies between steps are derived from these declarations. A step
+   is skipped when its outputs exist and the content of its inputs and
+   its arguments are unchanged since it last ran successfully.
+
+   @authors: Maedbh King, Jörn Diedrichsen
+
+  Typical usage example:
+
+  pipe = Pipeline(state_dir=dirs.conn_dir / 'pipeline')
+  pipe.add(Task('train_tessels0162', train_func, kwargs={...}, inputs=[...], outputs=[...]))
+  status = pipe.run(workers=4)        # run locally
+  pipe.to_slurm(fpath, command=...)   # or emit SLURM array jobs
+"""
+
+
+class Task:
+    """One step of the pipeline.
+
+    Attributes:
+        name (str): unique task name
+        func (callable): module-level function (must be picklable for worker processes)
+        kwargs (dict): keyword arguments passed to `func` (must be JSON-serializable)
+        inputs (list of str): files read by the task
+        outputs (list of str): files written by the task
+        after (list of str): names of additional tasks that need to finish first
+    """
+
+    def __init__(self, name, func, kwargs=None, inputs=None, outputs=None, after=None):
+        """Inits Task."""
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.inputs = [str(f) for f in (inputs or [])]
+        self.outputs = [str(f) for f in (outputs or [])]
+        self.after = list(after or [])
+
+
+class Pipeline:
+    """Graph of tasks with content-based up-to-date checks.
+
+    Attributes:
+        state_dir (str): directory that holds the task stamps and file digest cache
+        tasks (dict): tasks by name, in order of insertion
+    """
+
+    def __init__(self, state_dir):
+        """Inits Pipeline."""
+        self.state_dir = str(state_dir)
+        self.tasks = {}
+        self._digests = None
+
+    def add(self, task):
+        """Adds `task` to the graph"""
+        if task.name in self.tasks:
+            raise NameError(f"task {task.name} already exists")
+        self.tasks[task.name] = task
+        return task
+
+    def dependencies(self):
+        """Returns dict mapping each task name to the set of task names it depends on"""
+        producer = {}
+        for name, task in self.tasks.items():
+            for f in task.outputs:
+                producer[f] = name
+        deps = {}
+        for name, task in self.tasks.items():
+            deps[name] = {producer[f] for f in task.inputs if f in producer}
+            deps[name].update(task.after)
+            deps[name].discard(name)
+            missing = [d for d in deps[name] if d not in self.tasks]
+            if missing:
+                raise NameError(f"task {name} depends on unknown tasks {missing}")
+        return deps
+
+    def levels(self, names=None):
+        """Sorts tasks topologically into levels (tasks in a level are independent)
+
+        Args:
+            names (list of str or None): restrict to these tasks (default: all)
+        Returns:
+            levels (list of list of str)
+        """
+        deps = self.dependencies()
+        todo = set(self.tasks) if names is None else set(names)
+        done = set(self.tasks) - todo
+        levels = []
+        while todo:
+            level = [n for n in self.tasks if n in todo and deps[n] <= done]
+            if not level:
+                raise ValueError(f"cycle in pipeline between tasks {sorted(todo)}")
+            levels.append(level)
+            done.update(level)
+            todo.difference_update(level)
+        return levels
+
+    def downstream(self, names):
+        """Returns `names` and all tasks that (indirectly) depend on them"""
+        deps = self.dependencies()
+        result = set(names)
+        changed = True
+        while changed:
+            changed = False
+            for n, d in deps.items():
+                if n not in result and d & result:
+                    result.add(n)
+                    changed = True
+        return result
+
+    def task_hash(self, name):
+        """Returns hash over the task's arguments and the content of its inputs"""
+        task = self.tasks[name]
+        h = hashlib.sha1()
+        h.update(name.encode())
+        h.update(json.dumps(task.kwargs, sort_keys=True, default=str).encode())
+        for f in task.inputs:
+            h.update(f"{f}:{self._file_digest(f)};".encode())
+        return h.hexdigest()
+
+    def is_up_to_date(self, name):
+        """Checks whether outputs of task `name` exist and were made from the current inputs"""
+        task = self.tasks[name]
+        if not all(os.path.exists(f) for f in task.outputs):
+            return False
+        stamp = self._stamp_path(name)
+        if not os.path.isfile(stamp):
+            return False
+        return cio.read_json(stamp)["hash"] == self.task_hash(name)
+
+    def outdated(self):
+        """Returns tasks that are out-of-date, including everything downstream of them"""
+        return self.downstream([n for n in self.tasks if not self.is_up_to_date(n)])
+
+    def run(self, workers=1, targets=None, force=False):
+        """Runs out-of-date tasks locally, `workers` at a time.
+
+        A task that fails does not stop the run: its downstream tasks are
+        skipped and all independent branches still finish. If a worker dies
+        (e.g. out of memory), the tasks running in the pool fail and the pool
+        is restarted.
+
+        Args:
+            workers (int): number of worker processes. default is 1 (run in this process)
+            targets (list of str or None): only run these tasks and what they depend on
+            force (bool): rerun tasks even if they are up-to-date
+        Returns:
+            status (dict): task name -> 'done', 'up-to-date', 'failed' or 'skipped'
+        """
+        deps = self.dependencies()
+        names = set(self.tasks) if targets is None else self._upstream(targets, deps)
+        status = {}
+        pending = [n for lev in self.levels() for n in lev if n in names]
+        running = {}
+
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while pending or running:
+                # submit every task whose dependencies are resolved
+                for name in list(pending):
+                    upstream = deps[name] & names
+                    if any(status.get(d) in ("failed", "skipped") for d in upstream):
+                        status[name] = "skipped"
+                        pending.remove(name)
+                        print(f"skipping {name} (upstream task failed)")
+                    elif all(status.get(d) in ("done", "up-to-date") for d in upstream):
+                        pending.remove(name)
+                        if not force and self.is_up_to_date(name):
+                            status[name] = "up-to-date"
+                            continue
+                        print(f"running {name}")
+                        task = self.tasks[name]
+                        if executor is None:
+                            err = _call_task(task.func, task.kwargs)
+                            self._finish(name, err, status)
+                        else:
+                            running[executor.submit(_call_task, task.func, task.kwargs)] = name
+                if running:
+                    finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    broken = False
+                    for future in finished:
+                        try:
+                            err = future.result()
+                        except BrokenProcessPool:
+                            err = traceback.format_exc()
+                            broken = True
+                        self._finish(running.pop(future), err, status)
+                    if broken:
+                        # the other tasks of the pool fail as well, the next tasks run on a new pool
+                        for future in list(running):
+                            self._finish(running.pop(future), "worker process died (BrokenProcessPool)", status)
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(max_workers=workers)
+                elif pending:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self._save_digests()
+
+        for name in pending:
+            status.setdefault(name, "skipped")
+        return status
+
+    def run_task(self, name, force=False):
+        """Runs a single task (if out-of-date) in this process. Used by the SLURM backend.
+
+        Returns:
+            status (str): 'done', 'up-to-date' or 'failed'
+        """
+        status = {}
+        if not force and self.is_up_to_date(name):
+            status[name] = "up-to-date"
+        else:
+            task = self.tasks[name]
+            self._finish(name, _call_task(task.func, task.kwargs), status)
+        self._save_digests()
+        return status[name]
+
+    def to_slurm(
+        self,
+        fpath,
+        command,
+        job_name="connect",
+        account="fc_cerebellum",
+        partition="savio2",
+        qos="savio_normal",
+        time="10:00:00",
+        setup=None,
+        force=False
+        ):
+        """Writes SLURM array jobs for the out-of-date part of the graph.
+
+        One array job is written per level of the graph. Each array element
+        runs `{command} --task=<name>` for one task, and each level waits for
+        the previous one (`--dependency=afterok`). Submit with `bash {fpath}/submit.sh`.
+
+        Args:
+            fpath (str): output directory for the job scripts
+            command (str): shell command that runs a single task of this pipeline
+            job_name (str): prefix for the SLURM job names
+            account, partition, qos, time (str): SLURM settings
+            setup (list of str or None): shell lines run before the command (modules, venv)
+            force (bool): include all tasks, not only out-of-date ones
+        Returns:
+            levels (list of list of str): the tasks in each array job
+        """
+        cio.make_dirs(fpath)
+        names = set(self.tasks) if force else self.outdated()
+        levels = self.levels(names)
+        if setup is None:
+            setup = ["module load python/3.7",
+                     "source ~/.bash_profile",
+                     "source $(pipenv --venv)/bin/activate"]
+
+        submit = ["#!/bin/bash", "set -e", "jid=''"]
+        for i, level in enumerate(levels):
+            list_file = os.path.join(fpath, f"tasks_level{i}.txt")
+            with open(list_file, "w") as f:
+                f.write("\n".join(level) + "\n")
+            job_file = os.path.join(fpath, f"job_level{i}.sh")
+            lines = ["#!/bin/bash",
+                     f"#SBATCH --job-name={job_name}_{i}",
+                     f"#SBATCH --account={account}",
+                     f"#SBATCH --partition={partition}",
+                     f"#SBATCH --qos={qos}",
+                     f"#SBATCH --time={time}",
+                     f"#SBATCH --array=1-{len(level)}",
+                     ""] + setup + [
+                     "",
+                     f"task=$(sed -n \"${{SLURM_ARRAY_TASK_ID}}p\" {list_file})",
+                     f"{command} --task=${{task}}"]
+            with open(job_file, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            submit.append(
+                f"jid=$(sbatch --parsable ${{jid:+--dependency=afterok:$jid}} {job_file})")
+        with open(os.path.join(fpath, "submit.sh"), "w") as f:
+            f.write("\n".join(submit) + "\n")
+        return levels
+
+    def _finish(self, name, err, status):
+        """Records result of task `name`: writes the stamp on success"""
+        task = self.tasks[name]
+        missing = [f for f in task.outputs if not os.path.exists(f)]
+        if err is None and missing:
+            err = f"outputs were not written: {missing}"
+        if err is None:
+            cio.make_dirs(self.state_dir)
+            cio.save_dict_as_JSON(self._stamp_path(name), {"hash": self.task_hash(name), "outputs": task.outputs})
+            status[name] = "done"
+        else:
+            status[name] = "failed"
+            print(f"task {name} failed:\n{err}")
+
+    def _upstream(self, targets, deps):
+        """Returns `targets` and all tasks they (indirectly) depend on"""
+        result = set()
+        todo = list(targets)
+        while todo:
+            n = todo.pop()
+            if n not in result:
+                result.add(n)
+                todo.extend(deps[n])
+        return result
+
+    def _stamp_path(self, name):
+        return os.path.join(self.state_dir, f"{name}.json")
+
+    def _file_digest(self, fpath):
+        """Content hash of a file (or of all files in a directory).
+
+        Digests are cached by path, size and modification time, so unchanged files are only read once.
+        """
+        if self._digests is None:
+            fname = os.path.join(self.state_dir, "digests.json")
+            self._digests = cio.read_json(fname) if os.path.isfile(fname) else {}
+        if os.path.isdir(fpath):
+            h = hashlib.sha1()
+            for root, _, files in sorted(os.walk(fpath)):
+                for f in sorted(files):
+                    h.update(self._file_digest(os.path.join(root, f)).encode())
+            return h.hexdigest()
+        if not os.path.exists(fpath):
+            return "missing"
+        stat = os.stat(fpath)
+        key = f"{stat.st_size}:{stat.st_mtime_ns}"
+        cached = self._digests.get(fpath)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        h = hashlib.sha1()
+        with open(fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        self._digests[fpath] = [key, h.hexdigest()]
+        return self._digests[fpath][1]
+
+    def _save_digests(self):
+        if self._digests is None:
+            return
+        cio.make_dirs(self.state_dir)
+        fname = os.path.join(self.state_dir, "digests.json")
+        # SLURM tasks save at the same time, each writes its own temporary file
+        tmp = f"{fname}.{os.getpid()}_{uuid.uuid4().hex[:8]}.tmp"
+        cio.save_dict_as_JSON(tmp, self._digests)
+        os.replace(tmp, fname)
+
+
+def _call_task(func, kwargs):
+    """Calls `func` and returns the traceback as string on failure (None on success)"""
+    try:
+        func(**kwargs)
+    except Exception:
+        return traceback.format_exc()
+    return None
@@ -0,0 +1,196 @@
+import os
+import re
+import time
+import uuid
+import glob
+import shutil
+import pandas as pd
+
+import connectivity.constants as const
+
+"""Append-only store for train and eval summaries.
+
+   Every job writes its rows to a new file in a partition directory
+   (method / atlas / cortex / model name), so concurrent jobs never touch
+   the same file and appends do not grow with the history. Queries only
+   read the partitions that match the filters.
+
+   @authors: Maedbh King, Jörn Diedrichsen
+
+  Typical usage example:
+
+  append_results(df, summary_type='train', summary_name='ridge', exp='sc1')
+  df = query_results(summary_type='train', summary_name='ridge', exp='sc1', cortex=['tessels0162'])
+"""
+
+PARTITIONS = ["method", "atlas", "cortex", "name"]
+
+# marks a store whose legacy csv file has been imported
+SENTINEL = ".imported"
+
+def get_atlas(cortex):
+    """returns abbrev. atlas name from cortex name (e.g. 'tessels0162' -> 'tessels')"""
+    atlas = cortex.split('_')[0]
+    return ''.join(re.findall(r"[a-zA-Z]", atlas)).lower()
+
+def get_store_dir(summary_type, summary_name, exp):
+    """returns directory of the results store for `summary_type` and `summary_name`
+
+    Args:
+        summary_type (str): 'train' or 'eval'
+        summary_name (str or None): e.g. 'ridge' or 'weighted_all'
+        exp (str): 'sc1' or 'sc2'
+    Returns:
+        fpath (str)
+    """
+    dirs = const.Dirs(exp_name=exp)
+    if summary_type == 'train':
+        base_dir = dirs.conn_train_dir
+    elif summary_type == 'eval':
+        base_dir = dirs.conn_eval_dir
+    else:
+        raise NameError("summary_type needs to be train or eval")
+    return os.path.join(base_dir, 'results', summary_name or 'default')
+
+def append_results(dataframe, summary_type, summary_name, exp):
+    """Appends rows of `dataframe` to the store (one new file per partition)
+
+    Files are written under a temporary name and renamed, so readers never see partial files.
+
+    Args:
+        dataframe (pd dataframe): summary rows, must contain `name` and `X_data` columns
+        summary_type (str): 'train' or 'eval'
+        summary_name (str or None): e.g. 'ridge' or 'weighted_all'
+        exp (str): 'sc1' or 'sc2'
+    Returns:
+        fnames (list of str): files written
+    """
+    store_dir = _init_store(summary_type, summary_name, exp)
+    return _write_parts(dataframe, store_dir)
+
+def _write_parts(dataframe, store_dir):
+    """writes the rows of `dataframe` to new files in the partitions of `store_dir`"""
+    fnames = []
+    for (name, cortex), df in dataframe.groupby(['name', 'X_data'], sort=False):
+        keys = {'method': name.split('_')[0],
+                'atlas': get_atlas(cortex),
+                'cortex': cortex,
+                'name': name}
+        fdir = os.path.join(store_dir, *[f'{k}={keys[k]}' for k in PARTITIONS])
+        os.makedirs(fdir, exist_ok=True)
+        fname = os.path.join(fdir, f'part-{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}.csv')
+        tmp_name = os.path.join(fdir, '.' + os.path.basename(fname) + '.tmp')
+        df.to_csv(tmp_name, index=False)
+        os.replace(tmp_name, fname)
+        fnames.append(fname)
+    return fnames
+
+def query_results(
+    summary_type,
+    summary_name,
+    exp,
+    method=None,
+    atlas=None,
+    cortex=None,
+    name=None,
+    subj=None
+    ):
+    """Reads the rows matching the filters (None means no filter)
+
+    Legacy summary csv files (`{summary_type}_summary_{summary_name}.csv`) are imported
+    into the store the first time it is used.
+
+    Args:
+        summary_type (str): 'train' or 'eval'
+        summary_name (str or None): e.g. 'ridge' or 'weighted_all'
+        exp (str): 'sc1' or 'sc2'
+        method, atlas, cortex, name, subj (str, list of str or None): values to include
+    Returns:
+        pandas dataframe (without rows but with the columns of the store if nothing matches)
+    """
+    store_dir = _init_store(summary_type, summary_name, exp)
+
+    # select the partitions from the directory names
+    filters = {'method': method, 'atlas': atlas, 'cortex': cortex, 'name': name}
+    filters = {k: _to_list(v) for k, v in filters.items()}
+    subj = _to_list(subj)
+    pattern = os.path.join(store_dir, *[f'{k}=*' for k in PARTITIONS], 'part-*.csv')
+    all_fnames = glob.glob(pattern)
+    fnames = []
+    for fname in all_fnames:
+        parts = os.path.relpath(fname, store_dir).split(os.sep)[:-1]
+        keys = dict(p.split('=', 1) for p in parts)
+        if all(v is None or keys[k] in v for k, v in filters.items()):
+            fnames.append(fname)
+
+    if not fnames:
+        # columns of the store, so that callers can still select them
+        if all_fnames:
+            return pd.read_csv(sorted(all_fnames)[0], nrows=0)
+        return pd.DataFrame()
+    df = pd.concat([pd.read_csv(f) for f in sorted(fnames)], ignore_index=True, sort=False)
+    if subj is not None:
+        df = df[df['subj_id'].isin(subj)]
+    return df
+
+def _to_list(value):
+    """filter values as list (a string would match its substrings)"""
+    if value is None or isinstance(value, (list, tuple, set)):
+        return value
+    return [value]
+
+def _init_store(summary_type, summary_name, exp):
+    """Creates the store directory on first use and imports the legacy csv file into it
+
+    The import is written to a temporary directory, which is renamed to the store
+    together with the sentinel file. A crashed import leaves no store behind and is
+    repeated by the next call; of two concurrent imports only the first rename wins.
+    """
+    store_dir = get_store_dir(summary_type, summary_name, exp)
+    sentinel = os.path.join(store_dir, SENTINEL)
+    if os.path.isfile(sentinel):
+        return store_dir
+    if os.path.isdir(store_dir):
+        # store created before the sentinel existed, its import can not be repeated without duplicating rows
+        open(sentinel, 'w').close()
+        return store_dir
+
+    os.makedirs(os.path.dirname(store_dir), exist_ok=True)
+    tmp_dir = f'{store_dir}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    os.makedirs(tmp_dir)
+    try:
+        import_csv(summary_type, summary_name, exp, store_dir=tmp_dir)
+        open(os.path.join(tmp_dir, SENTINEL), 'w').close()
+        try:
+            os.replace(tmp_dir, store_dir)
+        except OSError:
+            # another job imported the store at the same time
+            if not os.path.isfile(sentinel):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return store_dir
+
+def import_csv(summary_type, summary_name, exp, store_dir=None):
+    """Imports a legacy summary csv file into the store (if it exists)
+
+    Args:
+        summary_type (str): 'train' or 'eval'
+        summary_name (str or None): e.g. 'ridge' or 'weighted_all'
+        exp (str): 'sc1' or 'sc2'
+        store_dir (str or None): write to this directory instead of the store (used by _init_store)
+    Returns:
+        fnames (list of str): files written
+    """
+    dirs = const.Dirs(exp_name=exp)
+    base_dir = dirs.conn_train_dir if summary_type == 'train' else dirs.conn_eval_dir
+    if summary_name:
+        fpath = os.path.join(base_dir, f'{summary_type}_summary_{summary_name}.csv')
+    else:
+        fpath = os.path.join(base_dir, f'{summary_type}_summary.csv')
+    if not os.path.isfile(fpath):
+        return []
+    print(f'importing {fpath} into results store')
+    if store_dir is not None:
+        return _write_parts(pd.read_csv(fpath), store_dir)
+    return append_results(pd.read_csv(fpath), summary_type, summary_name, exp)
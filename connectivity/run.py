@@ -2,10 +2,12 @@ import os
 import numpy as np
 import time
 import deepdish as dd
-import re
+import json
+import hashlib
+import itertools
 import pandas as pd
 from collections import defaultdict
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import cross_val_score, KFold
 from sklearn.metrics import mean_squared_error
 
 import connectivity.io as cio
@@ -13,6 +15,8 @@ from connectivity import data as cdata
 import connectivity.constants as const
 import connectivity.model as model
 import connectivity.evaluation as ev
+import connectivity.permutation as cperm
+import connectivity.instrument as instrument
 
 import warnings
 
@@ -91,56 +95,129 @@ def get_default_eval_config():
     }
     return config
 
-def train_models(config, save=False):
+def train_models(config, save=False, resume=True, warm_start=False, prefetch=1, batch_size=8):
     """Trains a specific model class on X and Y data from a specific experiment for subjects listed in config.
 
+    If `save` and `resume` are True, subjects whose saved model was trained with the
+    same config and on the same input data are skipped, and their summary is taken
+    from the run manifest (`train_manifest.json`) in the model directory. The `trained`
+    column of the summary is False for these subjects (their rows are already in the results store).
+
     Args:
         config (dict): Training configuration, returned from get_default_train_config()
         save (bool): Optional; Save fitted models automatically to disk.
+        resume (bool): Optional; Skip subjects with an up-to-date saved model. Default is True.
+        warm_start (bool): Optional; For L2regression, keep the data and kernel decompositions of
+            every subject and CV fold in memory, so training another alpha only costs matrix products
+            (see model.RidgePath and clear_ridge_paths). Default is False.
+        prefetch (int): Optional; Number of subjects whose data are loaded ahead in a background thread
+            while the current subject (or batch) is fitted (see data.prefetch). Default is 1.
+        batch_size (int): Optional; Number of subjects whose L2regression models are fitted together
+            (see model.fit_ridge_batched). Set `prefetch` to `batch_size` to load the next batch
+            while the current one is fitted. Default is 8.
     Returns:
         models (list): list of trained models for subjects listed in config.
-        train_all (pd dataframe): dataframe containing
+        train_all (pd dataframe): dataframe containing the training summary of every subject
     """
 
     dirs = const.Dirs(exp_name=config["train_exp"], glm=config["glm"])
     models = []
     train_all = defaultdict(list)
+    config_hash = _get_config_hash(config)
     # Store the training configuration in model directory
     if save:
         fpath = os.path.join(dirs.conn_train_dir, config["name"])
         cio.make_dirs(fpath)
         cio.save_dict_as_JSON(os.path.join(fpath, "train_config.json"), config)
+        manifest = _load_manifest(fpath)
+        manifest["config_hash"] = config_hash
 
-    # Loop over subjects and train
+    # Find the subjects that need training
+    fnames, data_hashes, todo = {}, {}, []
     for subj in config["subjects"]:
-        print(f"Training model on {subj}")
+        fnames[subj] = _get_model_name(train_name=config["name"], exp=config["train_exp"], subj_id=subj)
+        data_hashes[subj] = _get_data_fingerprint(config=config, exp=config["train_exp"], subj=subj)
+        if not (save and resume and _is_up_to_date(manifest, subj, fnames[subj], config_hash, data_hashes[subj])):
+            todo.append(subj)
+    if save:
+        # only subjects whose saved model matches the config and data hashes are done
+        manifest["done"] = [s for s in config["subjects"] if s not in todo]
+        manifest["pending"] = [s for s in config["subjects"] if s not in manifest["done"]]
+        _save_manifest(fpath, manifest)
 
-        # get data
-        Y, Y_info, X, X_info = _get_XYdata(config=config, exp=config["train_exp"], subj=subj)
+    # with warm_start, ridge solutions for every alpha come from cached paths (see _get_ridge_paths)
+    warm_start = warm_start and config["model"] == "L2regression"
 
-        # Generate new model and put in the list
-        new_model = getattr(model, config["model"])(**config["param"])
-        models.append(new_model)
+    # Ridge models of batches of subjects are fitted together (see model.fit_ridge_batched)
+    batched = config["model"] == "L2regression" and len(todo) > 1 and batch_size > 1 and not warm_start
+    train_data, fitted = {}, {}
 
-        # cross the sessions
-        if config["mode"] == "crossed":
-            Y = np.r_[Y[Y_info.sess == 2, :], Y[Y_info.sess == 1, :]]
+    # the data of the next subjects are loaded while the current one (or batch) is fitted
+    loader = iter([])
+    if not warm_start:
+        loader = cdata.prefetch(lambda subj: _get_train_data(config=config, subj=subj), todo, depth=prefetch)
 
-        # Fit model, get train and validate metrics
-        models[-1].fit(X, Y)
-        models[-1].rmse_train, models[-1].R_train = train_metrics(models[-1], X, Y)
+    # Loop over subjects and train
+    for subj in config["subjects"]:
+        fname = fnames[subj]
+        data_hash = data_hashes[subj]
+
+        # Skip subject if the saved model is up-to-date
+        if subj not in todo:
+            print(f"Model on {subj} is up-to-date, skipping")
+            models.append(model.load_model(fname))
+            for k, v in manifest["subjects"][subj]["summary"].items():
+                train_all[k].append(v)
+            train_all["trained"].append(False)
+            continue
+
+        print(f"Training model on {subj}")
+
+        if warm_start:
+            with instrument.stage("fit_ridge_path", model=config["name"], subj=subj):
+                models.append(_fit_ridge_path(config, subj, data_hash))
+            num_regions = models[-1].n_features_in_
+        else:
+            # the next batch of subjects starts with this one (in the order of todo)
+            if batched and subj not in train_data:
+                with instrument.stage("load", model=config["name"], subj=subj) as record:
+                    train_data = dict(itertools.islice(loader, batch_size))
+                    record["num_subjs"] = len(train_data)
+                with instrument.stage("fit_batched", model=config["name"]) as record:
+                    fitted.update(_fit_batched(config, train_data))
+                    record["num_subjs"] = len(fitted)
+
+            # get data (Y with crossed sessions if mode is 'crossed'); the stage measures the wait for the loader
+            if subj in train_data:
+                Y, Y_info, X, X_info = train_data.pop(subj)
+            else:
+                with instrument.stage("load", model=config["name"], subj=subj) as record:
+                    _, (Y, Y_info, X, X_info) = next(loader)
+                    record["arrays"] = instrument.array_sizes(X=X, Y=Y)
+            num_regions = X.shape[1]
+
+            # Fit model (or take the batched fit), get train and validate metrics
+            with instrument.stage("fit", model=config["name"], subj=subj):
+                if subj in fitted:
+                    models.append(fitted.pop(subj))
+                else:
+                    models.append(getattr(model, config["model"])(**config["param"]))
+                    models[-1].fit(X, Y)
+                models[-1].rmse_train, models[-1].R_train = train_metrics(models[-1], X, Y)
+            if config['validate_model']:
+                with instrument.stage("cv", model=config["name"], subj=subj):
+                    models[-1].rmse_cv, models[-1].R_cv = validate_metrics(models[-1], X, Y, X_info, config["cv_fold"])
 
         # collect train metrics (rmse and R)
         data = {
             "subj_id": subj,
             "rmse_train": models[-1].rmse_train,
             "R_train": models[-1].R_train,
-            "num_regions": X.shape[1]
+            "num_regions": num_regions
             }
 
-        # run cross validation and collect metrics (rmse and R)
+        # collect cross validation metrics (rmse and R)
         if config['validate_model']:
-            models[-1].rmse_cv, models[-1].R_cv = validate_metrics(models[-1], X, Y, X_info, config["cv_fold"])
             data.update({"rmse_cv": models[-1].rmse_cv,
                         "R_cv": models[-1].R_cv
                         })
@@ -152,18 +229,176 @@ def train_models(config, save=False):
 
         # Save the fitted model to disk if required
         if save:
-            fname = _get_model_name(train_name=config["name"], exp=config["train_exp"], subj_id=subj)
-            dd.io.save(fname, models[-1], compression=None)
+            with instrument.stage("save", model=config["name"], subj=subj):
+                model.save_model(fname, models[-1], config_hash=config_hash, data_hash=data_hash)
 
             # add date/timestamp to dict (to keep track of models)
             timestamp = time.ctime(os.path.getctime(fname))
             data.update({'timestamp': timestamp})
 
+            # record subject as done in the run manifest
+            manifest["subjects"][subj] = {
+                "config_hash": config_hash,
+                "data_hash": data_hash,
+                "summary": {k: _to_builtin(v) for k, v in data.items()},
+                }
+            if subj not in manifest["done"]:
+                manifest["done"].append(subj)
+            manifest["pending"] = [s for s in manifest["pending"] if s != subj]
+            _save_manifest(fpath, manifest)
+
         for k, v in data.items():
             train_all[k].append(v)
+        train_all["trained"].append(True)
 
     return models, pd.DataFrame.from_dict(train_all)
 
+def _get_train_data(config, subj):
+    """Returns Y, Y_info, X, X_info for training, with the sessions of Y crossed if config["mode"] is 'crossed'"""
+    Y, Y_info, X, X_info = _get_XYdata(config=config, exp=config["train_exp"], subj=subj)
+    if config["mode"] == "crossed":
+        Y = np.r_[Y[Y_info.sess == 2, :], Y[Y_info.sess == 1, :]]
+    return Y, Y_info, X, X_info
+
+def _fit_batched(config, train_data):
+    """Fits the L2regression models of all subjects in `train_data` at once.
+
+    Returns:
+        fitted (dict): subject -> fitted model (empty if the subjects do not share the same design shape)
+    """
+    subjs = list(train_data)
+    shapes = {(train_data[s][0].shape, train_data[s][2].shape) for s in subjs}
+    if len(shapes) > 1:
+        return {}
+    print(f"Fitting {config['model']} for {len(subjs)} subjects at once")
+    X = np.stack([train_data[s][2] for s in subjs])
+    Y = np.stack([train_data[s][0] for s in subjs])
+    return dict(zip(subjs, model.fit_ridge_batched(X, Y, **config["param"])))
+
+_ridge_paths = {}
+
+def _get_ridge_paths(config, subj, data_hash):
+    """Ridge paths (see model.RidgePath) of `subj` for the full data and every CV fold.
+
+    Paths are cached in memory (see clear_ridge_paths) under the data fingerprint and the
+    config keys that change the data or folds, so training the same data with another
+    alpha neither loads the data nor decomposes the kernels again.
+
+    Returns:
+        paths (dict): full (RidgePath), folds (list of RidgePath with held-out data)
+    """
+    keys = ["train_exp", "glm", "X_data", "Y_data", "averaging", "weighting", "incl_inst", "mode", "cv_fold"]
+    key = json.dumps([data_hash] + [config.get(k) for k in keys], default=str)
+    if key not in _ridge_paths:
+        Y, _, X, _ = _get_train_data(config=config, subj=subj)
+        folds = []
+        if config["validate_model"]:
+            # same splits as cross_val_score (KFold without shuffling, 5 folds if cv_fold is None)
+            for train, test in KFold(n_splits=config["cv_fold"] or 5).split(X):
+                folds.append(model.RidgePath(X[train], Y[train], X[test], Y[test]))
+        _ridge_paths[key] = {"full": model.RidgePath(X, Y), "folds": folds}
+    return _ridge_paths[key]
+
+def clear_ridge_paths():
+    """Empties the cache of ridge paths (e.g. after the alpha search for one atlas)"""
+    _ridge_paths.clear()
+
+def _fit_ridge_path(config, subj, data_hash):
+    """L2regression model of `subj` for config["param"]["alpha"] with train (and CV) metrics from the cached paths"""
+    paths = _get_ridge_paths(config, subj, data_hash)
+    alpha = config["param"]["alpha"]
+    fitted_model = paths["full"].get_model(alpha)
+
+    Y_pred = paths["full"].predict_train(alpha)
+    fitted_model.rmse_train = mean_squared_error(paths["full"].Y, Y_pred, squared=False)
+    fitted_model.R_train, _ = ev.calculate_R(paths["full"].Y, Y_pred)
+    if config["validate_model"]:
+        rmse_cv_all, r_cv_all = [], []
+        for fold in paths["folds"]:
+            Y_pred = fold.predict_test(alpha)
+            rmse_cv_all.append(np.sqrt(mean_squared_error(fold.Y_test, Y_pred)))
+            r_cv_all.append(ev.calculate_R(fold.Y_test, Y_pred)[0])
+        fitted_model.rmse_cv, fitted_model.R_cv = np.nanmean(rmse_cv_all), np.nanmean(r_cv_all)
+    return fitted_model
+
+def _get_config_hash(config):
+    """Returns hash of the training configuration.
+
+    The subject list is excluded, as each subject's model is checked separately.
+
+    Args:
+        config (dict): Training configuration
+    Returns:
+        config_hash (str): hex digest
+    """
+    cfg = {k: v for k, v in config.items() if k != "subjects"}
+    cfg_str = json.dumps(cfg, sort_keys=True, default=str)
+    return hashlib.sha1(cfg_str.encode()).hexdigest()
+
+def _get_data_fingerprint(config, exp, subj):
+    """Returns fingerprint of the X and Y input data for `exp` and `subj`
+
+    Args:
+        config (dict): must contain keys for glm, Y_data, X_data
+        exp (str): 'sc1' or 'sc2'
+        subj (str): subject id
+    Returns:
+        data_hash (str): hex digest
+    """
+    h = hashlib.sha1()
+    for roi in [config["Y_data"], config["X_data"]]:
+        dataset = cdata.Dataset(experiment=exp, glm=config["glm"], subj_id=subj, roi=roi)
+        h.update(dataset.fingerprint().encode())
+    return h.hexdigest()
+
+def _get_eval_fingerprint(config, subj):
+    """Returns fingerprint of the trained model file and the evaluation data of `subj`
+
+    Args:
+        config (dict): Evaluation configuration (name, train_exp, eval_exp, glm, Y_data, X_data)
+        subj (str): subject id
+    Returns:
+        fingerprint (str): hex digest
+    """
+    fname = _get_model_name(train_name=config["name"], exp=config["train_exp"], subj_id=subj)
+    h = hashlib.sha1()
+    if os.path.isfile(fname):
+        stat = os.stat(fname)
+        h.update(f"{fname}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    else:
+        h.update(f"{fname}:missing;".encode())
+    h.update(_get_data_fingerprint(config=config, exp=config["eval_exp"], subj=subj).encode())
+    return h.hexdigest()
+
+def _is_up_to_date(manifest, subj, fname, config_hash, data_hash):
+    """Checks whether the saved model for `subj` matches the config and data hashes"""
+    entry = manifest["subjects"].get(subj)
+    if entry is None or not os.path.isfile(fname):
+        return False
+    return entry["config_hash"] == config_hash and entry["data_hash"] == data_hash
+
+def _load_manifest(fpath):
+    """Loads the run manifest from model directory `fpath` (or returns an empty one)"""
+    fname = os.path.join(fpath, "train_manifest.json")
+    if os.path.isfile(fname):
+        return cio.read_json(fname)
+    return {"config_hash": None, "done": [], "pending": [], "subjects": {}}
+
+def _save_manifest(fpath, manifest):
+    """Saves the run manifest to model directory `fpath`
+
+    Written to a temporary file first, so a killed job never leaves a corrupt manifest.
+    """
+    fname = os.path.join(fpath, "train_manifest.json")
+    cio.save_dict_as_JSON(fname + ".tmp", manifest)
+    os.replace(fname + ".tmp", fname)
+
+def _to_builtin(value):
+    """Converts numpy scalars to python builtins (for JSON)"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
 def train_metrics(model, X, Y):
     """computes training metrics (rmse and R) on X and Y
 
@@ -201,115 +436,343 @@ def validate_metrics(model, X, Y, X_info, cv_fold):
 
     return np.nanmean(rmse_cv_all), np.nanmean(r_cv_all)
 
-def eval_models(config):
+def eval_models(config, maps_dir=None, prefetch=1):
     """Evaluates a specific model class on X and Y data from a specific experiment for subjects listed in config.
 
     Args:
         config (dict): Evaluation configuration, returned from get_default_eval_config()
+        maps_dir (str or None): Optional; if config["save_maps"], stream the voxel data to this directory
+            (see io.VoxelMaps). Subjects already finished there are not evaluated again, unless their
+            trained model or evaluation data have changed (see _get_eval_fingerprint).
+        prefetch (int): Optional; Number of subjects whose data are loaded ahead in a background thread
+            while the current subject is evaluated (see data.prefetch). Default is 1.
     Returns:
         models (pd dataframe): evaluation of different models on the data
+        eval_voxels (io.VoxelMaps if `maps_dir` is given, else dict of lists): voxel data
     """
 
     eval_all = defaultdict(list)
     eval_voxels = defaultdict(list)
+    maps = None
+    if config["save_maps"] and maps_dir is not None:
+        maps = cio.VoxelMaps(maps_dir, config["subjects"], key=_get_config_hash(config))
+
+    fingerprints = {}
+    if maps is not None:
+        fingerprints = {subj: _get_eval_fingerprint(config, subj) for subj in config["subjects"]}
+
+    # the data of the next subjects are loaded while the current one is evaluated
+    todo = [subj for subj in config["subjects"] if maps is None or not maps.is_done(subj, fingerprints[subj])]
+    loader = cdata.prefetch(lambda subj: _get_XYdata(config=config, exp=config["eval_exp"], subj=subj), todo, depth=prefetch)
 
     for idx, subj in enumerate(config["subjects"]):
 
-        print(f"Evaluating model on {subj}")
+        if subj not in todo:
+            print(f"Model on {subj} already evaluated")
+            data = maps.summary(subj)
+        else:
+            print(f"Evaluating model on {subj}")
 
-        # get data
-        Y, Y_info, X, X_info = _get_XYdata(config=config, exp=config["eval_exp"], subj=subj)
+            # get data (the stage measures the wait for the loader)
+            with instrument.stage("load", model=config["name"], subj=subj):
+                _, (Y, Y_info, X, X_info) = next(loader)
+            noise_Y = _get_noise_Y(config=config, subj=subj, Y=Y, Y_info=Y_info)
 
-        # Get the model from file
-        fname = _get_model_name(train_name=config["name"], exp=config["train_exp"], subj_id=subj)
-        fitted_model = dd.io.load(fname)
+            # evaluate the model of this subject
+            data, voxels = _eval_subject(config, subj, Y, Y_info, X, X_info, noise_Y)
+            _add_voxels(maps, eval_voxels, subj, voxels, data, fingerprints.get(subj))
 
-        # Get model predictions
-        Y_pred = fitted_model.predict(X)
-        if config["mode"] == "crossed":
-            Y_pred = np.r_[Y_pred[Y_info.sess == 2, :], Y_pred[Y_info.sess == 1, :]]
+        # append data for each subj
+        for k, v in data.items():
+            eval_all[k].append(v)
+
+    # Return list of models
+    return pd.DataFrame.from_dict(eval_all), (maps if maps is not None else eval_voxels)
 
-        # get rmse
-        rmse = mean_squared_error(Y, Y_pred, squared=False)
-        data = {"rmse_eval": rmse,
-                "subj_id": subj,
-                "num_regions": X.shape[1]}
+def eval_many(model_names, config, maps_dirs=None, prefetch=1):
+    """Evaluates many trained models, loading the evaluation data only once per subject and atlas.
 
-        # Copy over all scalars or strings to eval_all dataframe:
-        for key, value in config.items():
-            if type(value) is not list:
-                data.update({key: value})
+    Models are grouped by their cortical atlas (`X_data` in their train_config.json).
+    For each subject, the cerebellar data are loaded once, the cortical data once per
+    atlas, and all models of that atlas are evaluated on them.
+
+    Args:
+        model_names (list of str): names of trained models
+        config (dict): Evaluation configuration, returned from get_default_eval_config().
+            `name` and `X_data` are set from each model.
+        maps_dirs (dict or None): Optional; model name -> directory to stream voxel data to (see eval_models)
+        prefetch (int): Optional; Number of subjects whose data are loaded ahead (see eval_models). Default is 1.
+    Returns:
+        eval_all (pd dataframe): one row per model and subject
+        eval_voxels (dict): model name -> voxel data (io.VoxelMaps or dict of lists), if config["save_maps"]
+    """
+    # group models by cortical atlas
+    atlases = defaultdict(list)
+    for name in model_names:
+        atlases[_get_model_cortex(name, config)].append(name)
 
-        # add evaluation (summary)
-        evals = _get_eval(Y=Y, Y_pred=Y_pred, Y_info=Y_info, X_info=X_info)
-        data.update(evals)
+    eval_all = defaultdict(list)
+    eval_voxels = {name: defaultdict(list) for name in model_names}
+    maps, fingerprints = {}, {}
+    for cortex, names in atlases.items():
+        for name in names:
+            model_config = dict(config, X_data=cortex, name=name)
+            if config["save_maps"] and maps_dirs is not None:
+                maps[name] = cio.VoxelMaps(maps_dirs[name], config["subjects"], key=_get_config_hash(model_config))
+                eval_voxels[name] = maps[name]
+                fingerprints[name] = {subj: _get_eval_fingerprint(model_config, subj) for subj in config["subjects"]}
+
+    todo = {subj: [name for name in model_names if name not in maps or not maps[name].is_done(subj, fingerprints[name][subj])]
+            for subj in config["subjects"]}
+
+    def load(subj):
+        # cerebellar data are shared by all models, cortical data by the models of an atlas
+        Y, Y_info, subset = _get_Ydata(config=config, exp=config["eval_exp"], subj=subj)
+        X_data = {}
+        for cortex, names in atlases.items():
+            if any(name in todo[subj] for name in names):
+                X_data[cortex] = _get_Xdata(config=dict(config, X_data=cortex), exp=config["eval_exp"], subj=subj, subset=subset)
+        return Y, Y_info, X_data
+
+    # the data of the next subjects are loaded while the current one is evaluated
+    loader = cdata.prefetch(load, [subj for subj in config["subjects"] if todo[subj]], depth=prefetch)
+
+    X_data = {}
+    for subj in config["subjects"]:
+        print(f"Evaluating {len(todo[subj])} models on {subj}")
+        if todo[subj]:
+            _, (Y, Y_info, X_data) = next(loader)
+            noise_Y = _get_noise_Y(config=config, subj=subj, Y=Y, Y_info=Y_info)
+
+        for cortex, names in atlases.items():
+            atlas_config = dict(config, X_data=cortex)
+            if cortex in X_data:
+                X, X_info = X_data[cortex]
+
+            for name in names:
+                if name in todo[subj]:
+                    model_config = dict(atlas_config, name=name)
+                    data, voxels = _eval_subject(model_config, subj, Y, Y_info, X, X_info, noise_Y)
+                    _add_voxels(maps.get(name), eval_voxels[name], subj, voxels, data, fingerprints.get(name, {}).get(subj))
+                else:
+                    data = maps[name].summary(subj)
+                for k, v in data.items():
+                    eval_all[k].append(v)
 
-        # add evaluation (voxels)
-        if config["save_maps"]:
-            for k, v in data.items():
-                if "vox" in k:
-                    eval_voxels[k].append(v)
+    return pd.DataFrame.from_dict(eval_all), eval_voxels
 
-        # don't save voxel data to summary
-        data = {k: v for k, v in data.items() if "vox" not in k}
+def permute_models(config, n_perm=1000, batch_size=50, workers=1, random_state=None):
+    """Permutation test for the evaluation of model config["name"] for subjects listed in config.
 
-        # add model timestamp
-        # add date/timestamp to dict (to keep track of models)
-        timestamp = time.ctime(os.path.getctime(fname))
-        data.update({'timestamp': timestamp})
+    Every permutation refits the model (with the parameters it was trained with) on
+    permuted training conditions and evaluates it on the evaluation data (see permutation.py).
 
-        # append data for each subj
+    Args:
+        config (dict): Evaluation configuration, returned from get_default_eval_config()
+        n_perm (int): number of permutations
+        batch_size (int): permutations evaluated together
+        workers (int): worker processes for models that are not linear
+        random_state (int or None): seed
+    Returns:
+        perm_all (pd dataframe): observed R_eval and R_nc, their p-values and number of permutations per subject
+        perm_voxels (dict of lists): p-values per voxel (R_vox, R_vox_fwe, R_nc_vox, R_nc_vox_fwe)
+    """
+    dirs = const.Dirs(exp_name=config["train_exp"])
+    train_config = cio.read_json(os.path.join(dirs.conn_train_dir, config["name"], "train_config.json"))
+
+    perm_all = defaultdict(list)
+    perm_voxels = defaultdict(list)
+    for subj in config["subjects"]:
+        print(f"Permuting model on {subj}")
+
+        # training and evaluation data
+        Y, Y_info, X, _ = _get_XYdata(config=train_config, exp=config["train_exp"], subj=subj)
+        if train_config["mode"] == "crossed":
+            Y = np.r_[Y[Y_info.sess == 2, :], Y[Y_info.sess == 1, :]]
+        Y_eval, Y_eval_info, X_eval, X_eval_info = _get_XYdata(config=config, exp=config["eval_exp"], subj=subj)
+        pred_index = None
+        if config["mode"] == "crossed":
+            pred_index = np.r_[np.where(Y_eval_info.sess == 2)[0], np.where(Y_eval_info.sess == 1)[0]]
+
+        estimator = getattr(model, train_config["model"])(**train_config["param"])
+        result = cperm.permutation_test(estimator, X, Y, X_eval, Y_eval,
+                                        Y_sess=Y_eval_info["sess"],
+                                        X_sess=X_eval_info["sess"],
+                                        pred_index=pred_index,
+                                        n_perm=n_perm,
+                                        batch_size=batch_size,
+                                        workers=workers,
+                                        random_state=random_state)
+
+        data = {"subj_id": subj, "name": config["name"], "n_perm": n_perm}
+        for k in ["R_eval", "R_nc"]:
+            data[k] = result["observed"][k]
+            data[f"p_{k}"] = result["p"][k]
         for k, v in data.items():
-            eval_all[k].append(v)
+            perm_all[k].append(v)
+        for k, v in result["p"].items():
+            if "vox" in k:
+                perm_voxels[k].append(v)
 
-    # Return list of models
-    return pd.DataFrame.from_dict(eval_all), eval_voxels
+    return pd.DataFrame.from_dict(perm_all), perm_voxels
+
+def _eval_subject(config, subj, Y, Y_info, X, X_info, noise_Y):
+    """Evaluates the model config["name"] of `subj` on loaded data.
+
+    Args:
+        config (dict): Evaluation configuration
+        subj (str): subject id
+        Y, Y_info, X, X_info: evaluation data (see _get_XYdata)
+        noise_Y (dict): noise ceiling of Y (see _get_noise_Y)
+    Returns:
+        data (dict): summary row for the subject
+        voxels (dict): voxel data (empty unless config["save_maps"])
+    """
+    # Get the model from file (the estimator is rebuilt for predict)
+    fname = _get_model_name(train_name=config["name"], exp=config["train_exp"], subj_id=subj)
+    with instrument.stage("load_model", model=config["name"], subj=subj):
+        fitted_model = model.load_model(fname)
+
+    # Get model predictions
+    with instrument.stage("predict", model=config["name"], subj=subj) as record:
+        Y_pred = fitted_model.predict(X)
+        record["arrays"] = instrument.array_sizes(X=X, Y_pred=Y_pred)
+    if config["mode"] == "crossed":
+        Y_pred = np.r_[Y_pred[Y_info.sess == 2, :], Y_pred[Y_info.sess == 1, :]]
+
+    # get evaluation (summary and voxels); noise ceiling of Y depends only on the data and is cached
+    with instrument.stage("evaluation", model=config["name"], subj=subj):
+        evals = _get_eval(Y=Y, Y_pred=Y_pred, Y_info=Y_info, X_info=X_info, noise_Y=noise_Y)
 
-def _get_eval(Y, Y_pred, Y_info, X_info):
+    # get rmse
+    data = {"rmse_eval": evals.pop("rmse"),
+            "subj_id": subj,
+            "num_regions": X.shape[1]}
+
+    # Copy over all scalars or strings to eval_all dataframe:
+    for key, value in config.items():
+        if type(value) is not list:
+            data.update({key: value})
+
+    # add evaluation
+    data.update(evals)
+
+    # add evaluation (voxels)
+    voxels = {}
+    if config["save_maps"]:
+        voxels = {k: v for k, v in data.items() if "vox" in k}
+
+    # don't save voxel data to summary
+    data = {k: v for k, v in data.items() if "vox" not in k}
+
+    # add model timestamp
+    # add date/timestamp to dict (to keep track of models)
+    timestamp = time.ctime(os.path.getctime(fname))
+    data.update({'timestamp': timestamp})
+    return data, voxels
+
+def _add_voxels(maps, eval_voxels, subj, voxels, data, fingerprint=None):
+    """Streams voxel data of `subj` to `maps` (if given), otherwise appends them to `eval_voxels`"""
+    if maps is not None:
+        maps.write(subj, voxels, summary=data, fingerprint=fingerprint)
+    else:
+        for k, v in voxels.items():
+            eval_voxels[k].append(v)
+
+def _get_model_cortex(name, config):
+    """returns cortical atlas (X_data) of trained model `name` from its train_config.json"""
+    dirs = const.Dirs(exp_name=config["train_exp"])
+    fname = os.path.join(dirs.conn_train_dir, name, "train_config.json")
+    if os.path.isfile(fname):
+        return cio.read_json(fname)["X_data"]
+    return config["X_data"]
+
+def _get_eval(Y, Y_pred, Y_info, X_info, noise_Y=None):
     """Compute evaluation, returning summary and voxel data.
 
+    All metrics are computed in a single blocked pass over Y and Y_pred (see evaluation.calculate_metrics).
+
     Args:
         Y (np array):
         Y_pred (np array):
         Y_info (pd dataframe):
         X_info (pd dataframe):
+        noise_Y (dict or None): precomputed noise ceiling of Y (see _get_noise_Y)
     Returns:
-        dict containing evaluations (R, R2, noise).
+        dict containing evaluations (rmse, R, R2, noise).
     """
-    # initialise dictionary
-    data = {}
-
-    # Add the evaluation
-    data["R_eval"], data["R_vox"] = ev.calculate_R(Y=Y, Y_pred=Y_pred)
-
-    # R between predicted and observed
-    data["R2"], data["R2_vox"] = ev.calculate_R2(Y=Y, Y_pred=Y_pred)
-
-    # R2 between predicted and observed
-    (
-        data["noise_Y_R"],
-        data["noise_Y_R_vox"],
-        data["noise_Y_R2"],
-        data["noise_Y_R2_vox"],
-    ) = ev.calculate_reliability(Y=Y, dataframe=Y_info)
-
-    # Noise ceiling for cerebellum (squared)
-    (
-        data["noise_X_R"],
-        data["noise_X_R_vox"],
-        data["noise_X_R2"],
-        data["noise_X_R2_vox"],
-    ) = ev.calculate_reliability(Y=Y_pred, dataframe=X_info)
+    # R and R2 between predicted and observed, noise ceiling for cerebellum (Y)
+    # and cortex (X, from the predictions), all squared
+    metrics = ev.calculate_metrics(
+        Y=Y,
+        Y_pred=Y_pred,
+        Y_sess=Y_info["sess"] if noise_Y is None else None,
+        X_sess=X_info["sess"],
+        )
+    if noise_Y is not None:
+        metrics.update(noise_Y)
+
+    keys = ["rmse", "R_eval", "R_vox", "R2", "R2_vox",
+            "noise_Y_R", "noise_Y_R_vox", "noise_Y_R2", "noise_Y_R2_vox",
+            "noise_X_R", "noise_X_R_vox", "noise_X_R2", "noise_X_R2_vox"]
+    data = {k: metrics[k] for k in keys}
 
     # calculate noise ceiling
     data["noiseceiling_Y_R_vox"] = np.sqrt(data["noise_Y_R_vox"])
-    data["noiseceiling_XY_R_vox"] = np.sqrt(data["noise_Y_R_vox"] * np.sqrt(data["noise_X_R_vox"]))
+    data["noiseceiling_XY_R_vox"] = ev.calculate_noiseceiling(data["noise_Y_R_vox"], data["noise_X_R_vox"])
 
     # # Noise ceiling for cortex (squared)
     #     pass
 
     return data
 
+_noise_Y_cache = {}
+
+def _calc_noise_Y(Y, Y_info):
+    """Noise ceiling (reliability across sessions) of the cerebellar data
+
+    Returns:
+        dict with keys noise_Y_R, noise_Y_R_vox, noise_Y_R2, noise_Y_R2_vox
+    """
+    keys = ["noise_Y_R", "noise_Y_R_vox", "noise_Y_R2", "noise_Y_R2_vox"]
+    return dict(zip(keys, ev.calculate_reliability(Y=Y, dataframe=Y_info)))
+
+def _get_noise_Y(config, subj, Y, Y_info):
+    """Returns the noise ceiling of Y for `subj`, cached in memory and on disk.
+
+    The noise ceiling only depends on the evaluation data (not on the model), so it is
+    computed once per data key (exp, glm, subject, ROI, averaging, weighting, splitby,
+    instructions and data fingerprint) and reused for all models.
+
+    Args:
+        config (dict): Evaluation configuration
+        subj (str): subject id
+        Y (np array):
+        Y_info (pd dataframe):
+    Returns:
+        dict with keys noise_Y_R, noise_Y_R_vox, noise_Y_R2, noise_Y_R2_vox
+    """
+    Ydata = cdata.Dataset(experiment=config["eval_exp"], glm=config["glm"], subj_id=subj, roi=config["Y_data"])
+    key = {k: config.get(k) for k in ["eval_exp", "glm", "Y_data", "averaging", "weighting", "incl_inst", "splitby"]}
+    key.update({"subj": subj, "data_hash": Ydata.fingerprint()})
+    key = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    if key in _noise_Y_cache:
+        return _noise_Y_cache[key]
+
+    dirs = const.Dirs(exp_name=config["eval_exp"], glm=config["glm"])
+    fpath = os.path.join(dirs.conn_eval_dir, "noise_ceilings")
+    fname = os.path.join(fpath, f"noise_Y_{key}.h5")
+    if os.path.isfile(fname):
+        noise_Y = dd.io.load(fname)
+    else:
+        noise_Y = _calc_noise_Y(Y=Y, Y_info=Y_info)
+        cio.make_dirs(fpath)
+        dd.io.save(fname + ".tmp", noise_Y, compression=None)
+        os.replace(fname + ".tmp", fname)
+    _noise_Y_cache[key] = noise_Y
+    return noise_Y
+
 def _get_XYdata(config, exp, subj):
     """get X and Y data for exp and subj
 
@@ -320,6 +783,21 @@ def _get_XYdata(config, exp, subj):
     Returns:
         Y (nd array), Y_info (pd dataframe), X (nd array), X_info (pd dataframe)
     """
+    Y, Y_info, subset = _get_Ydata(config=config, exp=exp, subj=subj)
+    X, X_info = _get_Xdata(config=config, exp=exp, subj=subj, subset=subset)
+
+    return Y, Y_info, X, X_info
+
+def _get_Ydata(config, exp, subj):
+    """get Y (cerebellar) data for exp and subj
+
+    Args:
+        config (dict): must contain keys for glm, Y_data, averaging, weighting, incl_inst
+        exp (str): 'sc1' or 'sc2'
+        subj (str): default subjs are set in constants.py
+    Returns:
+        Y (nd array), Y_info (pd dataframe), subset (regressors used, pass on to _get_Xdata)
+    """
 
     # Get cerebellar data and load mat
     Ydata = cdata.Dataset(
@@ -333,8 +811,6 @@ def _get_XYdata(config, exp, subj):
     # get dataframe
     df = Ydata.get_info()
 
-    exp_num = int(re.findall('(\d+)', exp)[0])
-
     # figure out splitby
     subset = None
     if 'splitby' in config:
@@ -349,6 +825,19 @@ def _get_XYdata(config, exp, subj):
 
     Y, Y_info = Ydata.get_data(averaging=config["averaging"], weighting=config["weighting"], subset=subset)
 
+    return Y, Y_info, subset
+
+def _get_Xdata(config, exp, subj, subset=None):
+    """get X (cortical) data for exp and subj
+
+    Args:
+        config (dict): must contain keys for glm, X_data, averaging, weighting
+        exp (str): 'sc1' or 'sc2'
+        subj (str): default subjs are set in constants.py
+        subset (index-like or None): regressors to use (returned by _get_Ydata)
+    Returns:
+        X (nd array), X_info (pd dataframe)
+    """
     # Get cortical data and load mat
     Xdata = cdata.Dataset(
         experiment=exp,
@@ -359,7 +848,7 @@ def _get_XYdata(config, exp, subj):
     Xdata.load_mat()
     X, X_info = Xdata.get_data(averaging=config["averaging"], weighting=config["weighting"], subset=subset)
 
-    return Y, Y_info, X, X_info
+    return X, X_info
 
 def _get_model_name(train_name, exp, subj_id):
     """returns path/name for connectivity training model outputs.
@@ -3,6 +3,7 @@ import numpy as np
 import os
 import connectivity.constants as const
 import connectivity.io as cio
+from connectivity import data as cdata
 import connectivity.nib_utils as nio
 from connectivity import connect_atlas as catlas
 
@@ -26,7 +27,7 @@ def run(atlas, glm='glm7'):
     # get label colors
     rgba, _, _ = nio.get_gifti_colors(fpath=os.path.join(dirs.reg_dir, 'data', 'group', f'{atlas}.R.label.gii'))
 
-    catlas.save_maps_cerebellum(data=labels_concat, 
+    cdata.save_maps_cerebellum(data=labels_concat, 
                         fpath=os.path.join(dirs.cerebellar_atlases, f'{atlas}_wta_suit'),
                         group='mode',
                         nifti=True,
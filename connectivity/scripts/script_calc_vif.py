@@ -13,7 +13,6 @@ import connectivity.figures as fig
 import connectivity.io as cio
 from SUITPy import flatmap
 import itertools
-import nibabel as nib
 import h5py
 import deepdish as dd
 
@@ -51,18 +50,13 @@ def calc_vif(cortex = "tessels1002", logalpha = 8, sn = const.return_subjs):
     m = np.nanmean(vif,axis=1,keepdims=True)
     vif = np.concatenate([vif,m],axis=1)
 
-    # create and save the cortical map
-    func_giis, hem_names = cdata.convert_cortex_to_gifti(
-                                vif, 
-                                atlas = cortex,
-                                data_type='func',
-                                column_names=sn+['mean'],
-                                label_names=None,
-                                label_RGBA=None,
-                                hem_names=['L', 'R'])
-
-    for (func_gii, hem) in zip(func_giis, hem_names):
-        nib.save(func_gii, os.path.join(const.base_dir,f'sc1/conn_models/vif_{cortex}_logalpha{logalpha}.{hem}.func.gii'))
+    # create and save the cortical map (one column per subject + mean)
+    cdata.save_maps_cortex(
+                vif.T,
+                fpath=os.path.join(const.base_dir,f'sc1/conn_models/vif_{cortex}_logalpha{logalpha}'),
+                atlas=cortex,
+                data_type='func',
+                column_names=sn+['mean'])
     return
 
 def calc_snr(cortex = "tessels1002", sn = const.return_subjs):
@@ -74,17 +68,11 @@ def calc_snr(cortex = "tessels1002", sn = const.return_subjs):
     X, X_info = Xdata.get_data()                           
     snr = np.sqrt(np.sum(X ** 2, 0) / X.shape[0])
     # create and save the cortical map
-    func_giis, hem_names = cdata.convert_cortex_to_gifti(
-                                                            snr, 
-                                                            atlas = cortex,
-                                                            data_type='func',
-                                                            column_names=None,
-                                                            label_names=None,
-                                                            label_RGBA=None,
-                                                            hem_names=['L', 'R'])
-
-    for (func_gii, hem) in zip(func_giis, hem_names):
-        nib.save(func_gii, os.path.join(const.base_dir,f'sc1/conn_models/snr_{cortex}.{hem}.func.gii'))
+    cdata.save_maps_cortex(
+                snr,
+                fpath=os.path.join(const.base_dir,f'sc1/conn_models/snr_{cortex}'),
+                atlas=cortex,
+                data_type='func')
     return
 
 def calc_vif_lambda(cortex = "tessels0162", 
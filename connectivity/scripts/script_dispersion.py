@@ -93,28 +93,28 @@ def dispersion_voxels(
     for (best_model, cortex) in zip(models, cortex_names):
         print(f"dispersion for {best_model}")
         
-        model_data = cweights.get_model_data(best_model, train_exp=exp, average_subjs=average_subjs)
+        group_weights = cweights.get_group_weights(best_model, train_exp=exp)
 
-        if not average_subjs:
-            [num_subjs, _, _] = model_data.shape
-        else:
-            num_subjs = 1
-
-        # loop over subjects and calculate measures for each subject
-        for s in range(num_subjs):
-
-            try:
-                weight_map = model_data[s, :, :]
-            except:
-                weight_map = model_data
+        if average_subjs:
+            model_data = group_weights.nanmean()[np.newaxis]
             if method=='ridge':
-                #
-                weight_map = cweights._threshold_data(data=weight_map, threshold=weight_map.mean() + weight_map.std())
-
-            df = cweights.dispersion_cortex(roi_betas = weight_map, cortex = cortex)
-            df['w_var'] = df.Variance * df.sum_w
-            df['var_w'] = df.w_var / df.sum_w
-            subj = const.return_subjs[s]
+                threshold = model_data.mean(axis=(1,2)) + model_data.std(axis=(1,2))
+                model_data = cweights._threshold_data(data=model_data, threshold=threshold.reshape(-1,1,1))
+            subjs = const.return_subjs[:1]
+            batches = [(subjs, model_data)]
+        else:
+            # threshold each subject at mean + std of its weights
+            threshold = group_weights.thresholds() if method=='ridge' else None
+            subjs = group_weights.subjs
+            batches = group_weights.iter_subjects(batch_size=4, threshold=threshold)
+
+        # calculate measures for a few subjects at a time (the weights are memory-mapped)
+        df_all = pd.concat([cweights.dispersion_subjects(weights=w, cortex=cortex, subjs=s) for s, w in batches], ignore_index=True)
+        df_all['w_var'] = df_all.Variance * df_all.sum_w
+        df_all['var_w'] = df_all.w_var / df_all.sum_w
+
+        for subj in subjs:
+            df = df_all[df_all.subj == subj]
             print(f'- {subj}')
 
             # save giftis and niftis to disk'
@@ -127,9 +127,8 @@ def dispersion_voxels(
 
                 data_all[hem,:] = data_var_w
 
-                #get the average within each roi in atlas
-                var_w_roi, _ = cdata.average_by_roi(data_var_w, index)
-                w_var_roi, _ = cdata.average_by_roi(data_w_var, index)
+                #get the average within each roi in atlas (both maps at once)
+                var_w_roi, w_var_roi = np.split(cdata.average_by_roi(np.r_[data_var_w, data_w_var], index)[0], 2)
                 stats_df['subj']=[subj]*num_roi
                 stats_df['roi'] = np.arange(num_roi)
                 # # df_res['subj']='all-subjs'
@@ -147,7 +146,7 @@ def dispersion_voxels(
 
         # get the average across subjects and save the map
         data_group = np.concatenate(data_all_subs, axis = 0)
-        cweights.save_maps_cerebellum(np.nanmean(data_group, axis=0), fpath=os.path.join(dirs.conn_train_dir, best_model, 'group_dispersion_var_w'))
+        cdata.save_maps_cerebellum(np.nanmean(data_group, axis=0), fpath=os.path.join(dirs.conn_train_dir, best_model, 'group_dispersion_var_w'), nifti=True)
 
     # save dataframe to disk
     df = pd.concat(df_list)
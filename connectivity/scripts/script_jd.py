@@ -1,7 +1,6 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.stats import mode
 import os
 import connectivity.constants as const
 from connectivity.data import Dataset
@@ -72,65 +71,6 @@ def plot_Fig2c():
     vis.plot_eval_predictions(dataframe=df, exps=['sc2'], hue='method', ax=ax3)
     ax3.set_xticks([80, 304, 670, 1190, 1848])
 
-def save_maps_cerebellum(
-    data, 
-    fpath='/',
-    group='nanmean', 
-    gifti=True, 
-    nifti=True, 
-    column_names=[], 
-    label_RGBA=[],
-    label_names=[],
-    ):
-    """Takes data (np array), averages along first dimension
-    saves nifti and gifti map to disk
-
-    Args: 
-        data (np array): np array of shape (N x 6937)
-        fpath (str): save path for output file
-        group (bool): default is 'nanmean' (for func data), other option is 'mode' (for label data) 
-        gifti (bool): default is True, saves gifti to fpath
-        nifti (bool): default is False, saves nifti to fpath
-        column_names (list):
-        label_RGBA (list):
-        label_names (list):
-    Returns: 
-        saves nifti and/or gifti image to disk, returns gifti
-    """
-    num_cols, num_vox = data.shape
-
-    # get mean or mode of data along first dim (first dim is usually subjects)
-    if group=='nanmean':
-        data = np.nanmean(data, axis=0)
-    elif group=='mode':
-        data = mode(data, axis=0)
-        data = data.mode[0]
-    else:
-        print('need to group data by passing "nanmean" or "mode"')
-
-    # convert averaged cerebellum data array to nifti
-    nib_obj = cdata.convert_cerebellum_to_nifti(data=data)[0]
-    
-    # save nifti(s) to disk
-    if nifti:
-        nib.save(nib_obj, fpath + '.nii')
-
-    # map volume to surface
-    surf_data = flatmap.vol_to_surf([nib_obj], space="SUIT", stats=group)
-
-    # make and save gifti image
-    if group=='nanmean':
-        gii_img = flatmap.make_func_gifti(data=surf_data, column_names=column_names)
-        out_name = 'func'
-    elif group=='mode':
-        gii_img = flatmap.make_label_gifti(data=surf_data, label_names=label_names, column_names=column_names, label_RGBA=label_RGBA)
-        out_name = 'label'
-    if gifti:
-        nib.save(gii_img, fpath + f'.{out_name}.gii')
-    
-    return gii_img
-
-
 def eval_best_models(model_type=["ridge", "lasso", "WTA"],
                 save_maps=False,
                 eval_name='weighted_all',split='all',
@@ -175,8 +115,9 @@ def eval_best_models(model_type=["ridge", "lasso", "WTA"],
             # Save the whole voxel structure for later usage 
             dd.io.save(os.path.join(fpath,'voxels.h5'), voxels)
             for k, v in voxels.items():
-                save_maps_cerebellum(data=np.stack(v, axis=0),
-                                fpath=os.path.join(fpath, f'group_{k}'))
+                cdata.save_maps_cerebellum(data=np.stack(v, axis=0),
+                                fpath=os.path.join(fpath, f'group_{k}'),
+                                nifti=True)
 
         # eval summary
         if eval_name:
@@ -28,6 +28,7 @@ import connectivity.run_ls as run_wnta
 from connectivity import visualize as summary
 
 import connectivity.evaluation as ev
+import connectivity.instrument as instrument
 
 # from sklearn.cluster import KMeans
 
@@ -636,12 +637,11 @@ def select_winners(cortex = 'tessels0162',
                     Winner = dd.io.load(model_path)
                 
                 # run the current model
-                start_time = time.time()
                 print(f"started at {time.ctime()}")
-                Winner = run_wnta.select_winners(config, save=True, winner_model = Winner)
-                stop_time = time.time()
+                with instrument.stage("select_winners", model=name, exp=config["train_exp"], subj=s) as record:
+                    Winner = run_wnta.select_winners(config, save=True, winner_model = Winner)
 
-                total_time = (stop_time - start_time)/60
+                total_time = record["wall_s"]/60
                 print(f"--- took {total_time} minuites ---")
 
     return
@@ -3,15 +3,13 @@ import os, shutil
 import click
 import numpy as np
 import pandas as pd
-import nibabel as nib
-from scipy.stats import mode
 from random import seed, sample
 from pathlib import Path
-from SUITPy import flatmap
 
 import connectivity.constants as const
 import connectivity.io as cio
 from connectivity import data as cdata
+from connectivity import results as cres
 import connectivity.run as run_connect
 from connectivity import weights as cmaps
 from connectivity import visualize as summary
@@ -23,6 +21,7 @@ def train_ridge(
     cerebellum="cerebellum_suit",
     log_locally=True,
     model_ext=None,
+    warm_start=False,
     ):
     """Train model
 
@@ -37,8 +36,9 @@ def train_ridge(
         log_locally (bool): log results locally
         model_ext (str or None): add additional information to base model name
         experimenter (str or None): 'mk' or 'ls' or None
+        warm_start (bool): reuse the data and kernel decompositions across alphas (see run.train_models)
     Returns:
-        Appends summary data for each model and subject into `train_summary.csv`
+        Appends summary data for each model and subject to the results store
         Returns pandas dataframe of train_summary
     """
 
@@ -67,24 +67,73 @@ def train_ridge(
         config["hyperparameter"] = f"{param:.0f}"
 
         # train model
-        models, df = run_connect.train_models(config, save=log_locally)
+        models, df = run_connect.train_models(config, save=log_locally, warm_start=warm_start)
         df_all = pd.concat([df_all, df])
 
-
-    # save out train summary
-    dirs = const.Dirs(exp_name=train_exp)
-    fpath = os.path.join(dirs.conn_train_dir, f'train_summary_ridge.csv')
+        # append train summary to results store
+        if log_locally:
+            _save_train(df, summary_name='ridge', exp=train_exp)
 
     # save out weight maps
     if config['save_weights']:
         cmaps.weight_maps(model_name=name, cortex=cortex, train_exp=train_exp)
 
-    # concat data to model_summary (if file already exists)
-    if log_locally:
-        if os.path.isfile(fpath):
-            df_all = pd.concat([df_all, pd.read_csv(fpath)])
-        # save out train summary
-        df_all.to_csv(fpath, index=False)
+    return df_all
+
+def search_ridge(
+    train_exp="sc1",
+    cortex="tessels0642",
+    cerebellum="cerebellum_suit",
+    coarse=[-2, 2, 6, 10],
+    min_step=1,
+    log_locally=True,
+    model_ext=None,
+    ):
+    """Adaptive search for the ridge alpha of `cortex`
+
+    Trains the coarse grid of log-alphas, then halves the step around the log-alpha
+    with the highest mean R_cv (-> best +- 2, then best +- 1 for the default grid).
+    Alphas that are dominated by their neighbours are never trained. Data and kernel
+    decompositions of every subject and CV fold are reused across alphas (warm_start).
+
+    Args:
+        train_exp (str): 'sc1' or 'sc2'
+        cortex (str): cortical ROI
+        cerebellum (str): cerebellar ROI
+        coarse (list of int): evenly spaced log-alphas of the coarse grid
+        min_step (int): smallest step (log-alphas are integers, see naming convention in train_ridge)
+        log_locally (bool): log results locally
+        model_ext (str or None): add additional information to base model name
+    Returns:
+        Appends summary data for each trained model and subject to the results store
+        Returns pandas dataframe of train_summary (all evaluated alphas) and best log-alpha
+    """
+    R_cv = {}
+    df_all = pd.DataFrame()
+    params = sorted(coarse)
+    step = int(np.min(np.diff(params))) // 2
+    while params:
+        df = train_ridge(hyperparameter=params,
+                        train_exp=train_exp,
+                        cortex=cortex,
+                        cerebellum=cerebellum,
+                        log_locally=log_locally,
+                        model_ext=model_ext,
+                        warm_start=True)
+        df_all = pd.concat([df_all, df])
+        for param, df_param in df.groupby("hyperparameter"):
+            R_cv[int(param)] = df_param["R_cv"].mean()
+        best_param = max(R_cv, key=R_cv.get)
+        print(f"best log-alpha for {cortex} so far: {best_param} (R_cv={R_cv[best_param]:.3f})")
+
+        # refine around the optimum
+        params = []
+        if step >= min_step:
+            params = [p for p in [best_param - step, best_param + step] if p not in R_cv]
+            step //= 2
+
+    run_connect.clear_ridge_paths()
+    return df_all, best_param
 
 def train_WTA(
     train_exp="sc1",
@@ -108,7 +157,7 @@ def train_WTA(
         model_ext (str or None): add additional information to base model name
         experimenter (str or None): 'mk' 'sh' etc.
     Returns:
-        Appends summary data for each model and subject into `train_summary.csv`
+        Appends summary data for each model and subject to the results store
         Returns pandas dataframe of train_summary
     """
 
@@ -138,21 +187,15 @@ def train_WTA(
     models, df = run_connect.train_models(config, save=log_locally)
     df_all = pd.concat([df_all, df])
 
-
-    # save out train summary
-    dirs = const.Dirs(exp_name=train_exp)
-    fpath = os.path.join(dirs.conn_train_dir, f'train_summary_WTA.csv')
+    # append train summary to results store
+    if log_locally:
+        _save_train(df, summary_name='WTA', exp=train_exp)
 
     # save out weight maps
     if config['save_weights']:
         cmaps.weight_maps(model_name=name, cortex=cortex, train_exp=train_exp)
 
-    # concat data to model_summary (if file already exists)
-    if log_locally:
-        if os.path.isfile(fpath):
-            df_all = pd.concat([df_all, pd.read_csv(fpath)])
-        # save out train summary
-        df_all.to_csv(fpath, index=False)
+    return df_all
 
 def train_NNLS(
     alphas,
@@ -178,7 +221,7 @@ def train_NNLS(
         model_ext (str or None): add additional information to base model name
         experimenter (str or None): 'mk' or 'ls' or None
     Returns:
-        Appends summary data for each model and subject into `train_summary.csv`
+        Appends summary data for each model and subject to the results store
         Returns pandas dataframe of train_summary
     """
 
@@ -210,82 +253,15 @@ def train_NNLS(
         models, df = run_connect.train_models(config, save=log_locally)
         df_all = pd.concat([df_all, df])
 
-
-    # save out train summary
-    dirs = const.Dirs(exp_name=train_exp)
-    if experimenter:
-        fpath = os.path.join(dirs.conn_train_dir, f'train_summary_{experimenter}.csv')
-    else:
-        fpath = os.path.join(dirs.conn_train_dir, f'train_summary.csv')
+        # append train summary to results store
+        if log_locally:
+            _save_train(df, summary_name=experimenter, exp=train_exp)
 
     # save out weight maps
     if config['save_weights']:
         cmaps.weight_maps(model_name=name, cortex=cortex, train_exp=train_exp)
 
-    # concat data to model_summary (if file already exists)
-    if log_locally:
-        if os.path.isfile(fpath):
-            df_all = pd.concat([df_all, pd.read_csv(fpath)])
-        # save out train summary
-        df_all.to_csv(fpath, index=False)
-
-def save_maps_cerebellum(
-    data, 
-    fpath='/',
-    group='nanmean', 
-    gifti=True, 
-    nifti=True, 
-    column_names=[], 
-    label_RGBA=[],
-    label_names=[],
-    ):
-    """Takes data (np array), averages along first dimension
-    saves nifti and gifti map to disk
-
-    Args: 
-        data (np array): np array of shape (N x 6937)
-        fpath (str): save path for output file
-        group (bool): default is 'nanmean' (for func data), other option is 'mode' (for label data) 
-        gifti (bool): default is True, saves gifti to fpath
-        nifti (bool): default is False, saves nifti to fpath
-        column_names (list):
-        label_RGBA (list):
-        label_names (list):
-    Returns: 
-        saves nifti and/or gifti image to disk, returns gifti
-    """
-    num_cols, num_vox = data.shape
-
-    # get mean or mode of data along first dim (first dim is usually subjects)
-    if group=='nanmean':
-        data = np.nanmean(data, axis=0)
-    elif group=='mode':
-        data = mode(data, axis=0)
-        data = data.mode[0]
-    else:
-        print('need to group data by passing "nanmean" or "mode"')
-
-    # convert averaged cerebellum data array to nifti
-    nib_obj = cdata.convert_cerebellum_to_nifti(data=data)[0]
-    
-    # save nifti(s) to disk
-    if nifti:
-        nib.save(nib_obj, fpath + '.nii')
-
-    # map volume to surface
-    surf_data = flatmap.vol_to_surf([nib_obj], space="SUIT", stats=group)
-
-    # make and save gifti image
-    if group=='nanmean':
-        gii_img = flatmap.make_func_gifti(data=surf_data, column_names=column_names)
-        out_name = 'func'
-    elif group=='mode':
-        gii_img = flatmap.make_label_gifti(data=surf_data, label_names=label_names, column_names=column_names, label_RGBA=label_RGBA)
-        out_name = 'label'
-    if gifti:
-        nib.save(gii_img, fpath + f'.{out_name}.gii')
-    
-    return gii_img
+    return df_all
 
 def eval_model(
     model_name,
@@ -308,17 +284,61 @@ def eval_model(
         log_locally (bool): log results locally
         experimenter (str or None): 'mk' or 'ls' or None
     Returns:
-        Appends eval data for each model and subject into `eval_summary.csv`
+        Appends eval data for each model and subject to the results store
         Returns pandas dataframe of eval_summary
     """
-    dirs = const.Dirs(exp_name=eval_exp)
-
-    # get default eval parameters
-    config = run_connect.get_default_eval_config()
+    config = _get_eval_config(train_exp=train_exp, eval_exp=eval_exp, cerebellum=cerebellum, splitby=splitby)
 
     print(f"evaluating {model_name}")
     config["name"] = model_name
     config["X_data"] = cortex
+
+    # eval model(s); voxel data are streamed to disk
+    df, voxels = run_connect.eval_models(config, maps_dir=_get_maps_dir(config))
+
+    _save_eval(df, voxels, config, eval_name=eval_name, log_locally=log_locally)
+
+    return df
+
+def eval_models(
+    model_names,
+    train_exp="sc1",
+    eval_exp="sc2",
+    cerebellum="cerebellum_suit",
+    log_locally=True,
+    eval_name='weighted_all',
+    splitby='all'
+    ):
+    """Evaluate many models, loading the evaluation data once per subject and cortical atlas
+
+    Args:
+        model_names (list of str): names of trained models
+        train_exp (str): 'sc1' or 'sc2'
+        eval_exp (str): 'sc1' or 'sc2'
+        cerebellum (str): cerebellar ROI
+        log_locally (bool): log results locally
+        eval_name (str): name of the eval summary
+        splitby (str): 'all', 'common' or 'unique'
+    Returns:
+        Appends eval data for each model and subject to the results store
+        Returns pandas dataframe of eval_summary
+    """
+    config = _get_eval_config(train_exp=train_exp, eval_exp=eval_exp, cerebellum=cerebellum, splitby=splitby)
+
+    print(f"evaluating {len(model_names)} models")
+    maps_dirs = {name: _get_maps_dir(dict(config, name=name)) for name in model_names}
+    df, voxels = run_connect.eval_many(model_names, config, maps_dirs=maps_dirs)
+
+    for model_name in model_names:
+        model_config = dict(config, name=model_name)
+        _save_eval(df[df['name']==model_name], voxels[model_name], model_config, eval_name=eval_name, log_locally=log_locally)
+
+    return df
+
+def _get_eval_config(train_exp, eval_exp, cerebellum, splitby):
+    """eval config shared by `eval_model` and `eval_models`"""
+    # get default eval parameters
+    config = run_connect.get_default_eval_config()
     config["Y_data"] = cerebellum
     config["weighting"] = True
     config["averaging"] = "sess"
@@ -328,29 +348,41 @@ def eval_model(
     config["save_maps"] = True
     config["splitby"] = splitby
     config["incl_inst"] = True
+    return config
+
+def _get_maps_dir(config):
+    """directory the voxel data of an evaluated model are streamed to"""
+    dirs = const.Dirs(exp_name=config["eval_exp"])
+    return os.path.join(dirs.conn_eval_dir, config["name"], f'voxels_{config["splitby"]}')
 
-    # eval model(s)
-    df, voxels = run_connect.eval_models(config)
+def _save_train(df, summary_name, exp):
+    """appends the train summary of the newly trained subjects to the results store
+
+    Subjects skipped by run.train_models (up-to-date models) are already in the store.
+    """
+    df = df[df['trained']].drop(columns='trained')
+    if not df.empty:
+        cres.append_results(df, summary_type='train', summary_name=summary_name, exp=exp)
 
-    # save voxel data to gifti(only for cerebellum_suit)
+def _save_eval(df, voxels, config, eval_name, log_locally):
+    """saves voxel maps and appends eval summary of one model to the results store
+
+    Args:
+        voxels (io.VoxelMaps): voxel data (subjects x voxels) of the model
+    """
+    dirs = const.Dirs(exp_name=config["eval_exp"])
+
+    # save group voxel data to gifti(only for cerebellum_suit)
     if config["save_maps"] and config["Y_data"] == "cerebellum_suit":
-        fpath = os.path.join(dirs.conn_eval_dir, model_name)
+        fpath = os.path.join(dirs.conn_eval_dir, config["name"])
         cio.make_dirs(fpath)
-        for k, v in voxels.items():
-            save_maps_cerebellum(data=np.stack(v, axis=0), 
-                                fpath=os.path.join(fpath, f'group_{k}'))
+        # group maps are projected to the flatmap with the cached sparse projection
+        for k in voxels.metrics():
+            cdata.save_maps_cerebellum(data=voxels.group_mean(k), fpath=os.path.join(fpath, f'group_{k}'), nifti=True)
 
-    # eval summary
-    if eval_name:
-        eval_fpath = os.path.join(dirs.conn_eval_dir, f'eval_summary_{eval_name}.csv')
-    else:
-        eval_fpath = os.path.join(dirs.conn_eval_dir, f'eval_summary.csv')
-
-    # concat data to eval summary (if file already exists)
-    if log_locally:
-        if os.path.isfile(eval_fpath):
-            df = pd.concat([df, pd.read_csv(eval_fpath)])
-        df.to_csv(eval_fpath, index=False)
+    # append eval summary to results store (unless all subjects were taken from a previous run)
+    if log_locally and not (isinstance(voxels, cio.VoxelMaps) and not voxels.updated):
+        cres.append_results(df, summary_type='eval', summary_name=eval_name, exp=config["eval_exp"])
 
 def _delete_models(exp, best_model):
     dirs = const.Dirs(exp_name=exp)
@@ -399,7 +431,7 @@ def run(cortex="tessels0362",
 
     Args: 
         cortex (str): 'tesselsWB162', 'tesselsWB642' etc.
-        model_type (str): 'WTA' or 'ridge' or 'NNLS'
+        model_type (str): 'WTA' or 'ridge' or 'ridge_search' or 'NNLS'
         train_or_test (str): 'train' or 'eval'
     """
     print(f'doing model {train_or_eval}')
@@ -407,12 +439,15 @@ def run(cortex="tessels0362",
         if model_type=="ridge":
             # train ridge
             train_ridge(hyperparameter=[-2,0,2,4,6,8,10], train_exp="sc1", cortex=cortex)
+        elif model_type=="ridge_search":
+            # adaptive alpha search
+            search_ridge(train_exp="sc1", cortex=cortex)
         elif model_type=="WTA":
             train_WTA(train_exp=f"sc1", cortex=cortex)
         elif model_type=="NNLS":
             train_NNLS(alphas=[0], gammas=[0], train_exp="sc1", cortex=cortex)
         else:
-            print('please enter a model (ridge, WTA, NNLS)')
+            print('please enter a model (ridge, ridge_search, WTA, NNLS)')
 
     elif train_or_eval=="eval":
         # get best model (for each method and parcellation)
@@ -421,28 +456,24 @@ def run(cortex="tessels0362",
 
         eval_names = ['weighted_all', 'weighted_common', 'weighted_unique']
         splitby_all = ['all', 'common', 'unique']
+
+        # delete training models that are suboptimal (save space)
+        if delete_train:
+            for best_model in models:
+                _delete_models(exp="sc1", best_model=best_model)
+
+        for model in [m for m in models if 'mdtb1002' in m]:
+            print(f'{model} was not evaluated')
+        models = [m for m in models if 'mdtb1002' not in m]
+
+        # test best train models (data are loaded once per subject and atlas)
         for (eval_name, splitby) in zip(eval_names, splitby_all):
-            for (best_model, cortex) in zip(models, cortex_names):
-                
-                # should trained model be evaluated?
-                # eval = _check_eval(model_name=best_model, train_exp="sc1", eval_exp="sc2")
-                eval = True
-
-                # delete training models that are suboptimal (save space)
-                if delete_train:
-                    _delete_models(exp="sc1", best_model=best_model)
-
-                if eval and 'mdtb1002' not in best_model:
-                    # test best train model
-                    eval_model(model_name=best_model, 
-                            cortex=cortex, 
-                            train_exp="sc1", 
-                            eval_exp="sc2", 
-                            eval_name=eval_name, 
-                            splitby=splitby,
-                            )
-                else:
-                    print(f'{best_model} was not evaluated')
+            eval_models(model_names=models, 
+                    train_exp="sc1", 
+                    eval_exp="sc2", 
+                    eval_name=eval_name, 
+                    splitby=splitby,
+                    )
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,35 @@
+# import libraries
+import click
+import pandas as pd
+
+import connectivity.instrument as instrument
+
+@click.command()
+@click.argument("logs", nargs=-1, required=True)
+@click.option("--by", default="stage")
+@click.option("--stages", default=None)
+@click.option("--outfile", default=None)
+
+def run(logs, by="stage", stages=None, outfile=None):
+    """ Summarize where a sweep spent its time
+
+    Runs write their records when CONNECTIVITY_PERF_LOG is set (see instrument.py), e.g.
+    CONNECTIVITY_PERF_LOG=perf.jsonl python3 script_mk.py --cortex=tessels0162 --model_type=ridge --train_or_eval=train
+
+    Args:
+        logs (str): JSONL files or glob patterns
+        by (str): comma-separated record fields to group by (e.g. 'stage,model')
+        stages (str or None): comma-separated stages to include
+        outfile (str or None): save the summary as csv
+    """
+    df = instrument.report(list(logs), by=by.split(","), stages=stages.split(",") if stages else None)
+    if df.empty:
+        print("no records found")
+        return
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(df.to_string(index=False, float_format="{:.3f}".format))
+    if outfile is not None:
+        df.to_csv(outfile, index=False)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,173 @@
+# import libraries
+import os
+import click
+import numpy as np
+
+import connectivity.constants as const
+import connectivity.io as cio
+from connectivity import weights as cmaps
+from connectivity.pipeline import Pipeline, Task
+import connectivity.scripts.script_mk as script_mk
+import connectivity.scripts.script_surfaces as script_surfaces
+import connectivity.scripts.script_dispersion as script_dispersion
+
+ALPHAS = {"ridge": [-2, 0, 2, 4, 6, 8, 10]}
+EVALS = {"weighted_all": "all", "weighted_common": "common", "weighted_unique": "unique"}
+
+def _model_names(method, cortex):
+    """names of the models trained by `method` on `cortex` (see script_mk)"""
+    if method == "ridge":
+        return [f"ridge_{cortex}_alpha_{param:.0f}" for param in ALPHAS[method]]
+    elif method == "WTA":
+        return [f"WTA_{cortex}"]
+    raise NameError(f"no pipeline defined for method {method}")
+
+def _data_files(exp, roi, glm="glm7"):
+    """matlab files of `roi` for all subjects (inputs of train and eval)"""
+    dirs = const.Dirs(exp_name=exp, glm=glm)
+    return [dirs.beta_reg_dir / s / f"Y_{glm}_{roi}.mat" for s in const.return_subjs]
+
+def train(method, cortex, train_exp):
+    if method == "ridge":
+        script_mk.train_ridge(hyperparameter=ALPHAS[method], train_exp=train_exp, cortex=cortex)
+    elif method == "WTA":
+        script_mk.train_WTA(train_exp=train_exp, cortex=cortex)
+
+def select_best(method, cortex, train_exp, outfile):
+    """picks the model with the highest mean R_cv from the train manifests of `cortex`"""
+    dirs = const.Dirs(exp_name=train_exp)
+    best_model, best_R = None, -np.inf
+    for name in _model_names(method, cortex):
+        manifest = cio.read_json(os.path.join(dirs.conn_train_dir, name, "train_manifest.json"))
+        R_cv = np.nanmean([v["summary"].get("R_cv", np.nan) for v in manifest["subjects"].values()])
+        if R_cv > best_R:
+            best_model, best_R = name, R_cv
+    cio.save_dict_as_JSON(outfile, {"model": best_model, "cortex": cortex, "R_cv": best_R})
+
+def evaluate(best_file, train_exp, eval_exp, eval_name, splitby, outfile):
+    best = cio.read_json(best_file)
+    script_mk.eval_model(model_name=best["model"],
+                        cortex=best["cortex"],
+                        train_exp=train_exp,
+                        eval_exp=eval_exp,
+                        eval_name=eval_name,
+                        splitby=splitby)
+    cio.save_dict_as_JSON(outfile, {"model": best["model"], "eval_name": eval_name})
+
+def weight_maps(best_file, train_exp, outfile):
+    best = cio.read_json(best_file)
+    cmaps.weight_maps(model_name=best["model"], cortex=best["cortex"], train_exp=train_exp, save=True)
+    cio.save_dict_as_JSON(outfile, {"model": best["model"]})
+
+def build(
+    atlases,
+    methods=["ridge", "WTA"],
+    train_exp="sc1",
+    eval_exp="sc2",
+    maps_atlas="MDTB10"
+    ):
+    """Builds the task graph: train -> select best -> eval -> maps
+
+    Every atlas gets its own branch, so adding an atlas only adds (and runs) that branch.
+    Surface and dispersion summaries are computed over all atlases of a method.
+
+    Args:
+        atlases (list of str): cortical atlases e.g. ['tessels0042', 'yeo7']
+        methods (list of str): 'ridge' and/or 'WTA'
+        train_exp (str): default is 'sc1'
+        eval_exp (str): default is 'sc2'
+        maps_atlas (str): cerebellar atlas for the surface and dispersion summaries
+    Returns:
+        pipe (Pipeline)
+    """
+    train_dirs = const.Dirs(exp_name=train_exp)
+    eval_dirs = const.Dirs(exp_name=eval_exp)
+    pipe = Pipeline(state_dir=train_dirs.conn_dir / "pipeline")
+    best_dir = train_dirs.conn_train_dir / "pipeline"
+    done_dir = eval_dirs.conn_eval_dir / "pipeline"
+    cio.make_dirs(best_dir)
+    cio.make_dirs(done_dir)
+
+    cereb_train = _data_files(train_exp, "cerebellum_suit")
+    cereb_eval = _data_files(eval_exp, "cerebellum_suit")
+    for method in methods:
+        best_files = []
+        # the summaries read the eval and weight maps of all atlases
+        map_files = []
+        for cortex in atlases:
+            manifests = [train_dirs.conn_train_dir / name / "train_manifest.json" for name in _model_names(method, cortex)]
+            best_file = best_dir / f"best_{method}_{cortex}.json"
+            best_files.append(best_file)
+
+            pipe.add(Task(f"train_{method}_{cortex}", train,
+                    kwargs={"method": method, "cortex": cortex, "train_exp": train_exp},
+                    inputs=cereb_train + _data_files(train_exp, cortex),
+                    outputs=manifests))
+            pipe.add(Task(f"best_{method}_{cortex}", select_best,
+                    kwargs={"method": method, "cortex": cortex, "train_exp": train_exp, "outfile": str(best_file)},
+                    inputs=manifests,
+                    outputs=[best_file]))
+            for eval_name, splitby in EVALS.items():
+                outfile = done_dir / f"eval_{method}_{cortex}_{splitby}.json"
+                pipe.add(Task(f"eval_{method}_{cortex}_{splitby}", evaluate,
+                        kwargs={"best_file": str(best_file), "train_exp": train_exp, "eval_exp": eval_exp,
+                                "eval_name": eval_name, "splitby": splitby, "outfile": str(outfile)},
+                        inputs=[best_file] + cereb_eval + _data_files(eval_exp, cortex),
+                        outputs=[outfile]))
+                map_files.append(outfile)
+            outfile = best_dir / f"weights_{method}_{cortex}.json"
+            pipe.add(Task(f"weights_{method}_{cortex}", weight_maps,
+                    kwargs={"best_file": str(best_file), "train_exp": train_exp, "outfile": str(outfile)},
+                    inputs=[best_file],
+                    outputs=[outfile]))
+            map_files.append(outfile)
+
+        # summaries over all atlases of `method`
+        pipe.add(Task(f"surfaces_{method}", script_surfaces.surfaces_voxels,
+                kwargs={"atlas": maps_atlas, "method": method, "exp": train_exp},
+                inputs=best_files + map_files,
+                outputs=[train_dirs.conn_train_dir / f"cortical_surface_stats_vox_{method}_{maps_atlas}.csv"]))
+        pipe.add(Task(f"dispersion_{method}", script_dispersion.dispersion_voxels,
+                kwargs={"atlas": maps_atlas, "method": method, "exp": train_exp},
+                inputs=best_files + map_files,
+                outputs=[train_dirs.conn_train_dir / f"cortical_dispersion_stats_vox_{method}_{maps_atlas}.csv"]))
+    return pipe
+
+@click.command()
+@click.option("--atlases", default="tessels0042,tessels0162,tessels0362,tessels0642,tessels1002")
+@click.option("--methods", default="ridge,WTA")
+@click.option("--backend", default="local")
+@click.option("--workers", default=1, type=int)
+@click.option("--task", default=None)
+@click.option("--force", is_flag=True)
+
+def run(atlases, methods, backend="local", workers=1, task=None, force=False):
+    """ Run connectivity pipeline
+
+    Args:
+        atlases (str): comma-separated cortical atlases
+        methods (str): comma-separated methods ('ridge', 'WTA')
+        backend (str): 'local' (run now) or 'slurm' (write array jobs to conn_dir/pipeline/slurm)
+        workers (int): number of local worker processes
+        task (str or None): run only this task (used by the slurm jobs)
+        force (bool): rerun tasks even if they are up-to-date
+    """
+    atlases = atlases.split(",")
+    methods = methods.split(",")
+    pipe = build(atlases=atlases, methods=methods)
+    if task is not None:
+        status = pipe.run_task(task, force=force)
+        if status == "failed":
+            raise SystemExit(1)
+    elif backend == "local":
+        status = pipe.run(workers=workers, force=force)
+        for name, s in status.items():
+            print(f"{name}: {s}")
+    elif backend == "slurm":
+        fpath = os.path.join(pipe.state_dir, "slurm")
+        command = f"python3 {os.path.abspath(__file__)} --atlases={','.join(atlases)} --methods={','.join(methods)}"
+        levels = pipe.to_slurm(fpath, command=command, force=force)
+        print(f"{sum(map(len, levels))} tasks in {len(levels)} array jobs, submit with: bash {fpath}/submit.sh")
+
+if __name__ == "__main__":
+    run()
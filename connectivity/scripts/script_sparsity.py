@@ -7,8 +7,8 @@ import nibabel as nib
 from SUITPy import flatmap
 
 import connectivity.constants as const
-import connectivity.io as cio
 from connectivity import data as cdata
+from connectivity import model as cmodel
 from connectivity import weights as cweights
 from connectivity import visualize as summary
 
@@ -43,18 +43,18 @@ def run(
         dist_all = defaultdict(list)
         for model in model_fnames:
 
-            # read model data
-            data = cio.read_hdf5(model)
+            # read model weights (memory-mapped)
+            coef = cmodel.load_coef(model)
 
             # calculate geometric mean of distances
-            dist = cweights.sparsity_cortex(coef=data.coef_, roi=cortex, metric=metric)
+            dist = cweights.sparsity_cortex(coef=coef, roi=cortex, metric=metric)
 
             for k, v in dist.items():
                 dist_all[k].append(v)
 
         # save maps to disk for cerebellum
         for k,v in dist_all.items():
-            cweights.save_maps_cerebellum(data=np.stack(v, axis=0), 
+            cdata.save_maps_cerebellum(data=np.stack(v, axis=0), 
                                 fpath=os.path.join(fpath, f'group_{metric}_cerebellum_{k}'),
                                 group='nanmean',
                                 nifti=False)
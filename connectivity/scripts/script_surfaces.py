@@ -162,8 +162,7 @@ def surfaces_voxels(
             percent = df['percent'].values
             # data = np.reshape(count, (1, len(count)))
             #get the average within each roi in atlas
-            count_roi, _ = cdata.average_by_roi(count, index)
-            percent_roi, _ = cdata.average_by_roi(percent, index)
+            count_roi, percent_roi = np.split(cdata.average_by_roi(np.c_[count, percent].T, index)[0], 2)
 
             stats_df['subj']=[subj]*num_roi
             stats_df['roi'] = np.arange(num_roi)
@@ -182,9 +181,9 @@ def surfaces_voxels(
 
         # get the average across subjects and save the map
         data_group_percent = np.concatenate(data_percent_subs, axis = 0)
-        cweights.save_maps_cerebellum(np.nanmean(data_group_percent, axis=0), fpath=os.path.join(dirs.conn_train_dir, best_model, 'group_surface_percent'))
+        cdata.save_maps_cerebellum(np.nanmean(data_group_percent, axis=0), fpath=os.path.join(dirs.conn_train_dir, best_model, 'group_surface_percent'), nifti=True)
         data_group_count = np.concatenate(data_percent_subs, axis = 0)
-        cweights.save_maps_cerebellum(np.nanmean(data_group_count, axis=0), fpath=os.path.join(dirs.conn_train_dir, best_model, 'group_surface_count'))
+        cdata.save_maps_cerebellum(np.nanmean(data_group_count, axis=0), fpath=os.path.join(dirs.conn_train_dir, best_model, 'group_surface_count'), nifti=True)
 
     # save dataframe to disk
     df = pd.concat(df_list)
@@ -0,0 +1,215 @@
+import os
+import sys
+import glob
+import uuid
+import weakref
+import numpy as np
+import scipy.sparse
+
+import connectivity.data as cdata
+
+"""Shared-memory data plane for worker processes.
+
+   Arrays that every task of a process pool needs (X, Y, Dataset betas, averaging
+   operators, distance matrices) are copied once into named shared memory blocks.
+   Tasks only get the registry, a small dict of block names, shapes and dtypes, and
+   the workers attach to the blocks without copying (see attach). The process that
+   created the blocks unlinks them when the SharedArrays are closed, garbage
+   collected or the interpreter exits. Blocks left behind by killed processes are
+   removed by cleanup_stale.
+
+   @authors: Maedbh King, Ladan Shahshahani, Jörn Diedrichsen
+
+  Typical usage example:
+
+  with SharedArrays() as arrays:
+      arrays.put("X", X)
+      arrays.put_sparse("operator", cdata.get_roi_operator(region_number_suit)[0])
+      arrays.put_dataset("Y", cdata.Dataset("sc1", "glm7", "cerebellum_suit", "s02").load())
+      futures = [executor.submit(task, arrays.registry, ...) for ...]
+
+  # in the worker
+  data = attach(registry)
+  X, operator, Y = data["X"], data["operator"], data["Y"]
+"""
+
+PREFIX = "connectivity"
+
+def is_available():
+    """shared memory blocks need python >= 3.8"""
+    return sys.version_info >= (3, 8)
+
+def _shared_memory():
+    """multiprocessing.shared_memory (imported when first used, it needs python 3.8)"""
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError("shared memory blocks need python >= 3.8 (use workers=1 on older versions)")
+    return shared_memory
+
+class SharedArrays:
+    """Registry of arrays held in shared memory blocks.
+
+    Attributes:
+        name (str): prefix of the block names (includes the pid of the owner)
+        registry (dict): key -> description of the shared array, passed to attach
+    """
+
+    def __init__(self, name=None):
+        """Inits SharedArrays. Block names are `connectivity_{pid}_{name}_{key}`"""
+        self.name = f"{PREFIX}_{os.getpid()}_{name or uuid.uuid4().hex[:8]}"
+        self.registry = {}
+        self._blocks = {}
+        # unlinks the blocks if close is never called (also runs at exit)
+        self._finalizer = weakref.finalize(self, _unlink, self._blocks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self.registry
+
+    def __getitem__(self, key):
+        """returns the shared array `key` (views of the blocks of this process)"""
+        return _from_spec(self.registry[key], self._blocks.__getitem__)
+
+    def put(self, key, array):
+        """Copies `array` into a new block
+
+        Args:
+            key (str): name of the array in the registry
+            array (array-like): numeric array (memmaps are read in once)
+        Returns:
+            view (nd-array): the shared array
+        """
+        self.registry[key] = self._put_array(key, array)
+        return self[key]
+
+    def put_sparse(self, key, matrix):
+        """Copies the buffers of a sparse matrix (e.g. from data.get_roi_operator) into new blocks"""
+        matrix = scipy.sparse.csr_matrix(matrix)
+        self.registry[key] = {
+            "format": "csr",
+            "shape": matrix.shape,
+            "data": self._put_array(f"{key}.data", matrix.data),
+            "indices": self._put_array(f"{key}.indices", matrix.indices),
+            "indptr": self._put_array(f"{key}.indptr", matrix.indptr)}
+        return self[key]
+
+    def put_dataset(self, key, dataset):
+        """Shares the numeric arrays of a loaded data.Dataset (data, XX, sess, ...)
+
+        Other attributes (TN, CN, exp, ...) are small and are kept in the registry.
+        """
+        arrays, attrs = {}, {}
+        for k, v in vars(dataset).items():
+            if isinstance(v, np.ndarray) and v.dtype != object:
+                arrays[k] = self._put_array(f"{key}.{k}", v)
+            else:
+                attrs[k] = v
+        self.registry[key] = {"format": "dataset", "arrays": arrays, "attrs": attrs}
+        return self[key]
+
+    def close(self):
+        """Closes and unlinks all blocks (the registry can no longer be attached)"""
+        _unlink(self._blocks)
+        self.registry = {}
+
+    def _put_array(self, key, array):
+        array = np.ascontiguousarray(array)
+        if array.dtype == object:
+            raise ValueError(f"{key}: object arrays can not be shared")
+        # blocks can not be empty (raises FileExistsError if `key` is already shared)
+        block = _shared_memory().SharedMemory(name=f"{self.name}_{key}", create=True, size=max(array.nbytes, 1))
+        self._blocks[block.name] = block
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return {"format": "array", "block": block.name, "shape": array.shape, "dtype": array.dtype.str}
+
+_attached = {}
+
+def attach(registry):
+    """Attaches to the shared arrays of a registry (zero-copy, read-only)
+
+    Blocks stay open for the lifetime of the worker, so tasks sharing a registry
+    only attach once.
+
+    Args:
+        registry (dict): SharedArrays.registry
+    Returns:
+        data (dict): key -> nd-array, csr_matrix or data.Dataset
+    """
+    return {k: _from_spec(spec, _attach_block, read_only=True) for k, spec in registry.items()}
+
+def detach():
+    """Closes all blocks attached by this process"""
+    for block in _attached.values():
+        _close(block)
+    _attached.clear()
+
+def cleanup_stale():
+    """Unlinks blocks of processes that no longer exist (e.g. killed jobs)
+
+    Returns:
+        names (list of str): blocks removed
+    """
+    names = []
+    for fname in glob.glob(os.path.join("/dev/shm", f"{PREFIX}_*")):
+        name = os.path.basename(fname)
+        pid = name.split("_")[1]
+        if pid.isdigit() and not _is_running(int(pid)):
+            os.remove(fname)
+            names.append(name)
+    return names
+
+def _from_spec(spec, get_block, read_only=False):
+    if spec["format"] == "array":
+        array = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=get_block(spec["block"]).buf)
+        array.flags.writeable = not read_only
+        return array
+    elif spec["format"] == "csr":
+        buffers = tuple(_from_spec(spec[k], get_block, read_only) for k in ["data", "indices", "indptr"])
+        return scipy.sparse.csr_matrix(buffers, shape=spec["shape"], copy=False)
+    elif spec["format"] == "dataset":
+        dataset = cdata.Dataset.__new__(cdata.Dataset)
+        vars(dataset).update(spec["attrs"])
+        vars(dataset).update({k: _from_spec(v, get_block, read_only) for k, v in spec["arrays"].items()})
+        return dataset
+    raise NameError(f"unknown format {spec['format']}")
+
+def _attach_block(name):
+    if name not in _attached:
+        if sys.version_info >= (3, 13):
+            # only the owner unlinks the block
+            _attached[name] = _shared_memory().SharedMemory(name=name, track=False)
+        else:
+            # workers of a process pool share the resource tracker of the owner
+            _attached[name] = _shared_memory().SharedMemory(name=name)
+    return _attached[name]
+
+def _unlink(blocks):
+    for block in blocks.values():
+        _close(block)
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+    blocks.clear()
+
+def _close(block):
+    try:
+        block.close()
+    except BufferError:
+        # arrays still point into the block, the mapping is released with them
+        pass
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -18,7 +18,9 @@ import re
 from random import seed, sample
 
 import connectivity.data as cdata
+import connectivity.evaluation as ev
 import connectivity.constants as const
+import connectivity.results as cres
 import connectivity.nib_utils as nio
 
 def plotting_style():
@@ -50,7 +52,10 @@ def get_summary(
     cortex=None,
     atlas=None
     ):
-    """Appends different summary csv files (train or eval) and filters based on inputs
+    """Queries the results store for different summaries (train or eval), filtered based on inputs
+
+    Only the partitions of the store that match `method`, `cortex` and `atlas` are read.
+
     Args:
         summary_type (str): 'eval','train'
         summary_name (list of str): name of summary file
@@ -68,20 +73,13 @@ def get_summary(
     if type(exps) is not list:
         exps=[exps]*len(summary_name)
 
-    # Load and concatenate the desired summary files 
+    # Query and concatenate the desired summaries
     df_concat = pd.DataFrame()
     for exp,name in zip(exps,summary_name):
-        dirs = const.Dirs(exp_name=exp)
-        if name:
-            fname = f"{summary_type}_summary_{name}.csv"
-        else:
-            fname = f"{summary_type}_summary.csv"
-        if summary_type=="eval":
-            fpath = os.path.join(dirs.conn_eval_dir, fname)
-        elif summary_type =="train":
-            fpath = os.path.join(dirs.conn_train_dir, fname)
-        df = pd.read_csv(fpath)
+        df = cres.query_results(summary_type, name, exp, method=method, atlas=atlas, cortex=cortex)
         df_concat = pd.concat([df_concat, df])
+    if df_concat.empty:
+        return df_concat
 
     # add atlas and method
     df_concat['atlas'] = df_concat['X_data'].apply(lambda x: _add_atlas(x))
@@ -94,17 +92,11 @@ def get_summary(
     # Evaluation specific items: 
     if summary_type=='eval':
         df_concat['noiseceiling_Y']=np.sqrt(df_concat.noise_Y_R)
-        df_concat['noiseceiling_XY']=np.sqrt(df_concat.noise_Y_R * df_concat.noise_X_R)
+        df_concat['noiseceiling_XY']=ev.calculate_noiseceiling(df_concat.noise_Y_R, df_concat.noise_X_R)
 
-    # Now filter the data frame
+    # Now filter the data frame (method, atlas and cortex are already filtered by the query)
     if splitby is not None:
         df_concat = df_concat[df_concat['splitby'].isin(splitby)]
-    if method is not None:
-        df_concat = df_concat[df_concat['method'].isin(method)]
-    if atlas is not None:
-        df_concat = df_concat[df_concat['atlas'].isin(atlas)]
-    if cortex is not None:
-        df_concat = df_concat[df_concat['X_data'].isin(cortex)]
 
     return df_concat
 
@@ -327,10 +319,7 @@ def roi_summary(
 def _add_atlas(x):
     """returns abbrev. atlas name from `X_data` column
     """
-    atlas = x.split('_')[0]
-    atlas = ''.join(re.findall(r"[a-zA-Z]", atlas)).lower()
-
-    return atlas
+    return cres.get_atlas(x)
 
 def plot_train_predictions(
     dataframe,
@@ -1,8 +1,8 @@
 # import libraries
 import os
+import warnings
 from matplotlib.pyplot import get
 import numpy as np
-import nibabel as nib
 from numpy.core.fromnumeric import repeat
 import pandas as pd
 from pathlib import Path
@@ -10,11 +10,7 @@ from collections import defaultdict
 import glob
 from random import seed, sample
 import deepdish as dd
-from scipy.stats import mode
-from SUITPy import flatmap
 from SUITPy import atlas as catlas
-from nilearn.surface import load_surf_data
-from scipy.stats.mstats import gmean
 
 import connectivity.constants as const
 import connectivity.io as cio
@@ -23,68 +19,6 @@ from connectivity import data as cdata
 from connectivity import nib_utils as nio
 from connectivity import visualize as summary
 
-def save_maps_cerebellum(
-    data, 
-    fpath='/',
-    group='nanmean', 
-    gifti=True, 
-    nifti=True, 
-    column_names=[], 
-    label_RGBA=[],
-    label_names=[],
-    ):
-    """Takes data (np array), averages along first dimension
-    saves nifti and gifti map to disk
-
-    Args: 
-        data (np array): np array of shape (N x 6937)
-        fpath (str): save path for output file
-        group (bool): default is 'nanmean' (for func data), other option is 'mode' (for label data) 
-        gifti (bool): default is True, saves gifti to fpath
-        nifti (bool): default is False, saves nifti to fpath
-        column_names (list):
-        label_RGBA (list):
-        label_names (list):
-    Returns: 
-        saves nifti and/or gifti image to disk, returns gifti
-    """
-    try:
-        num_cols, num_vox = data.shape
-    except: 
-        data = np.reshape(data, (1, len(data)))
-        num_cols, num_vox = data.shape
-
-    # get mean or mode of data along first dim (first dim is usually subjects)
-    if group=='nanmean':
-        data = np.nanmean(data, axis=0)
-    elif group=='mode':
-        data = mode(data, axis=0)
-        data = data.mode[0]
-    else:
-        print('need to group data by passing "nanmean" or "mode"')
-
-    # convert averaged cerebellum data array to nifti
-    nib_obj = cdata.convert_cerebellum_to_nifti(data=data)[0]
-    
-    # save nifti(s) to disk
-    if nifti:
-        nib.save(nib_obj, fpath + '.nii')
-
-    # map volume to surface
-    surf_data = flatmap.vol_to_surf([nib_obj], space="SUIT", stats=group)
-
-    # make and save gifti image
-    if group=='nanmean':
-        gii_img = flatmap.make_func_gifti(data=surf_data, column_names=column_names)
-        out_name = 'func'
-    elif group=='mode':
-        gii_img = flatmap.make_label_gifti(data=surf_data, label_names=label_names, column_names=column_names, label_RGBA=label_RGBA)
-        out_name = 'label'
-    if gifti:
-        nib.save(gii_img, fpath + f'.{out_name}.gii')
-    
-    return gii_img
-
 def weight_maps(
     model_name, 
     cortex, 
@@ -100,37 +34,20 @@ def weight_maps(
         cortex (str): cortex model name (example: tesselsWB162)
         train_exp (str): 'sc1' or 'sc2'
     Returns: 
-        weights (n-dim np array); saves out cortex and cerebellar maps if `save` is True
+        weights (GroupWeights); saves out cortex and cerebellar maps if `save` is True
     """
     # set directory
     dirs = const.Dirs(exp_name=train_exp)
     fpath = os.path.join(dirs.conn_train_dir, model_name)
 
-    # get trained subject models
-    model_fnames = glob.glob(os.path.join(fpath, '*.h5'))
-
-    cereb_weights_all = []; cortex_weights_all = []; weights_all = []
-    for model_fname in model_fnames:
-
-        # read model data
-        data = cio.read_hdf5(model_fname)
-        
-        # append cerebellar and cortical weights
-        cereb_weights_all.append(np.nanmean(data.coef_, axis=1))
-        cortex_weights_all.append(np.nanmean(data.coef_, axis=0))
-        weights_all.append(data.coef_)
-    
-    # stack the weights
-    weights_all = np.stack(weights_all, axis=0)
+    # weights of all subjects (memory-mapped, see GroupWeights)
+    weights_all = GroupWeights(fpath)
 
     # save cortex and cerebellum weight maps to disk
     if save:
-        save_maps_cerebellum(data=np.stack(cereb_weights_all, axis=0), fpath=os.path.join(fpath, 'group_weights_cerebellum'))
+        cdata.save_maps_cerebellum(data=weights_all.voxel_means(), fpath=os.path.join(fpath, 'group_weights_cerebellum'), nifti=True)
 
-        cortex_weights_all = np.stack(cortex_weights_all, axis=0)
-        func_giis, hem_names = cdata.convert_cortex_to_gifti(data=np.nanmean(cortex_weights_all, axis=0), atlas=cortex)
-        for (func_gii, hem) in zip(func_giis, hem_names):
-            nib.save(func_gii, os.path.join(fpath, f'group_weights_cortex.{hem}.func.gii'))
+        cdata.save_maps_cortex(data=np.nanmean(weights_all.cortex_means(), axis=0), fpath=os.path.join(fpath, 'group_weights_cortex'), atlas=cortex)
         print('saving cortical and cerebellar weights to disk')
     
     return weights_all
@@ -167,9 +84,8 @@ def cortical_surface_voxels(
     subjs_all = defaultdict(list)
     for model_fname in model_fnames:
 
-        # read model data
-        data = cio.read_hdf5(model_fname)
-        betas = data.coef_
+        # read model weights (copy, as they are modified below)
+        betas = np.array(model.load_coef(model_fname))
 
         if method=='ridge':
             betas = _threshold_data(data=betas, threshold=betas.mean() + betas.std())
@@ -208,8 +124,8 @@ def cortical_surface_voxels(
     
     if save_maps:
         # save maps to disk for cerebellum
-        save_maps_cerebellum(data=np.stack(cereb_all_count, axis=0), fpath=os.path.join(fpath, f'group_{method}_count_{weights}_cerebellum'))
-        save_maps_cerebellum(data=np.stack(cereb_all_percent, axis=0), fpath=os.path.join(fpath, f'group_{method}_percent_{weights}_cerebellum'))
+        cdata.save_maps_cerebellum(data=np.stack(cereb_all_count, axis=0), fpath=os.path.join(fpath, f'group_{method}_count_{weights}_cerebellum'), nifti=True)
+        cdata.save_maps_cerebellum(data=np.stack(cereb_all_percent, axis=0), fpath=os.path.join(fpath, f'group_{method}_percent_{weights}_cerebellum'), nifti=True)
 
     return subjs_all
 
@@ -276,36 +192,260 @@ def cortical_surface_rois(
                 
     return data_all
 
-def get_model_data(
+class GroupWeights:
+    """Weights (subjects x cerebellar voxels x cortical regions) of a trained model, stored on disk.
+
+    The `coef_` of every subject model is copied once into `group_weights.npy`
+    in the model directory, one subject at a time. The tensor is memory-mapped
+    on read, and the reducers stream over blocks of voxels, so the full stack
+    is never held in memory. `group_weights.json` records size and modification
+    time of the subject models; the tensor is rewritten when one of them changes.
+
+    For reduced-rank models (model.ReducedRankRidge) the voxel and cortex means are
+    computed from the factors, and the tensor is only written when it is needed.
+
+    Attributes:
+        fpath (str): model directory
+        subjs (list of str): subjects with a trained model (first dim of the tensor)
+        chunk_size (int): number of cerebellar voxels per block
+        factored (bool): all subject models are reduced-rank models
+    """
+
+    def __init__(self, fpath, subjs=None, chunk_size=500):
+        """Inits GroupWeights, writing the tensor if it is missing or out-of-date.
+
+        If `subjs` is None, all subject models in `fpath` are used. Subjects without
+        a model file are skipped, so a partially trained model can be summarized.
+        """
+        self.fpath = str(fpath)
+        self.chunk_size = chunk_size
+        model_name = os.path.basename(os.path.normpath(self.fpath))
+        if subjs is None:
+            prefix = os.path.join(self.fpath, f'{model_name}_')
+            subjs = [fname[len(prefix):-len('.h5')] for fname in sorted(glob.glob(f'{prefix}*.h5'))]
+        self.subjs, self.model_fnames = [], []
+        for subj in subjs:
+            fname = os.path.join(self.fpath, f'{model_name}_{subj}.h5')
+            if os.path.isfile(fname):
+                self.subjs.append(subj)
+                self.model_fnames.append(fname)
+            else:
+                print(f'warning: no model for {subj} in {self.fpath}, skipping')
+        if not self.subjs:
+            raise FileNotFoundError(f'no subject models in {self.fpath}')
+        self._fname = os.path.join(self.fpath, 'group_weights.npy')
+        self._index_fname = os.path.join(self.fpath, 'group_weights.json')
+        self._data = None
+        self._factors = None
+        # only the file headers are read here, the factors when a reducer needs them
+        self.factored = all(model.is_factored(fname) for fname in self.model_fnames)
+        if not self.factored:
+            self._load()
+
+    @property
+    def factors(self):
+        """(U_, V_) of every subject for reduced-rank models, None for other models"""
+        if self.factored and self._factors is None:
+            self._factors = [model.load_factors(fname) for fname in self.model_fnames]
+        return self._factors
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._load()
+        return self._data
+
+    @property
+    def shape(self):
+        if self.factored:
+            U, V = self.factors[0]
+            return (len(self.factors), U.shape[0], V.shape[0])
+        return self.data.shape
+
+    def __len__(self):
+        return len(self.subjs)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.data, dtype=dtype)
+
+    def chunks(self):
+        """Yields (voxel slice, block) with blocks of shape (subjects x chunk_size x cortical regions)"""
+        num_vox = self.data.shape[1]
+        for start in range(0, num_vox, self.chunk_size):
+            vox = slice(start, min(start + self.chunk_size, num_vox))
+            yield vox, np.asarray(self.data[:, vox, :])
+
+    def nanmean(self):
+        """NaN-mean over subjects
+
+        Returns:
+            mean (np array): (cerebellar voxels x cortical regions)
+        """
+        mean = np.zeros(self.data.shape[1:])
+        for vox, block in self.chunks():
+            mean[vox] = np.nanmean(block, axis=0)
+        return mean
+
+    def voxel_means(self):
+        """NaN-mean over cortical regions for every subject and cerebellar voxel
+
+        Returns:
+            mean (np array): (subjects x cerebellar voxels)
+        """
+        if self.factored:
+            return np.stack([U @ V.mean(axis=0) for U, V in self.factors])
+        mean = np.zeros(self.data.shape[:2])
+        for vox, block in self.chunks():
+            mean[:, vox] = np.nanmean(block, axis=2)
+        return mean
+
+    def cortex_means(self):
+        """NaN-mean over cerebellar voxels for every subject and cortical region
+
+        Returns:
+            mean (np array): (subjects x cortical regions)
+        """
+        if self.factored:
+            return np.stack([V @ U.mean(axis=0) for U, V in self.factors])
+        total = np.zeros((self.data.shape[0], self.data.shape[2]))
+        count = np.zeros(total.shape)
+        for _, block in self.chunks():
+            valid = ~np.isnan(block)
+            total += np.where(valid, block, 0).sum(axis=1)
+            count += valid.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / count
+
+    def region_means(self, region_number_suit):
+        """NaN-mean within each cerebellar region for every subject and cortical region
+
+        Args:
+            region_number_suit (np array or str): parcel vector in suit space or nifti filename of the atlas (see data.average_by_roi)
+        Returns:
+            mean (np array): (subjects x regions x cortical regions)
+            region_numbers (np array): region number of each row
+        """
+        operator, region_numbers = cdata.get_roi_operator(region_number_suit)
+        num_subjs, _, num_cortex = self.data.shape
+        total = np.zeros((num_subjs, len(region_numbers), num_cortex))
+        count = np.zeros(total.shape)
+        for vox, block in self.chunks():
+            op = operator[vox].T
+            valid = ~np.isnan(block)
+            for s in range(num_subjs):
+                total[s] += op @ np.where(valid[s], block[s], 0)
+                count[s] += op @ valid[s].astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / count, region_numbers
+
+    def thresholds(self, num_std=1):
+        """Mean + `num_std` * std of the weights of every subject (threshold used for ridge models)
+
+        Computed in two passes over the blocks (sum, then sum of squared deviations).
+
+        Returns:
+            threshold (np array): (subjects,)
+        """
+        num_subjs, num_vox, num_cortex = self.data.shape
+        total = np.zeros(num_subjs)
+        for _, block in self.chunks():
+            total += block.sum(axis=(1,2))
+        mean = total / (num_vox * num_cortex)
+        sum_sq = np.zeros(num_subjs)
+        for _, block in self.chunks():
+            sum_sq += ((block - mean.reshape(-1,1,1)) ** 2).sum(axis=(1,2))
+        return mean + num_std * np.sqrt(sum_sq / (num_vox * num_cortex))
+
+    def iter_subjects(self, batch_size=1, threshold=None):
+        """Yields (subjs, weights) for batches of subjects
+
+        Args:
+            batch_size (int): subjects per batch
+            threshold (np array or None): (subjects,) values below the threshold of a subject are set to NaN
+        Returns:
+            generator of (list of str, np array (batch x cerebellar voxels x cortical regions))
+        """
+        for start in range(0, len(self.subjs), batch_size):
+            idx = slice(start, start + batch_size)
+            weights = np.asarray(self.data[idx])
+            if threshold is not None:
+                weights = _threshold_data(data=weights, threshold=np.asarray(threshold)[idx].reshape(-1,1,1))
+            yield self.subjs[idx], weights
+
+    def _load(self):
+        if not self._is_up_to_date():
+            self._write()
+        self._data = np.load(self._fname, mmap_mode='r')
+
+    def _sources(self):
+        sources = []
+        for fname in self.model_fnames:
+            stat = os.stat(fname)
+            sources.append([fname, stat.st_size, stat.st_mtime_ns])
+        return sources
+
+    def _is_up_to_date(self):
+        if not (os.path.isfile(self._fname) and os.path.isfile(self._index_fname)):
+            return False
+        index = cio.read_json(self._index_fname)
+        return index['subjs'] == self.subjs and index['sources'] == self._sources()
+
+    def _write(self):
+        """copies `coef_` of one subject model at a time into the memory-mapped tensor"""
+        print(f'writing group weights to {self._fname}')
+        tmp_fname = os.path.join(self.fpath, '.group_weights.tmp.npy')
+        tensor = None
+        for s, model_fname in enumerate(self.model_fnames):
+            coef = model.load_coef(model_fname)
+            if tensor is None:
+                tensor = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=coef.dtype, shape=(len(self.subjs),) + coef.shape)
+            tensor[s] = coef
+        tensor.flush()
+        del tensor
+        os.replace(tmp_fname, self._fname)
+        cio.save_dict_as_JSON(self._index_fname + '.tmp', {'subjs': self.subjs, 'sources': self._sources()})
+        os.replace(self._index_fname + '.tmp', self._index_fname)
+
+def get_group_weights(
     model_name,
     train_exp='sc1',
-    average_subjs=False
+    subjs=None
     ):
-    """save surface maps for cerebellum (count number of non-zero cortical coef)
+    """Returns the weights of all subjects for `model_name` (see GroupWeights)
 
     Args:
         model_name (str): full name of trained model. Has to follow naming convention <method>_<cortex>_alpha_<num>
         train_exp (str): 'sc1' or 'sc2'
-        weights (str): 'positive' or 'nonzero' (neg. & pos.). default is 'nonzero'
+        subjs (list of str or None): default is all subjects with a trained model
+    Returns:
+        GroupWeights
     """
-    # set directory
     dirs = const.Dirs(exp_name=train_exp)
+    return GroupWeights(os.path.join(dirs.conn_train_dir, model_name), subjs=subjs)
 
-    # get model path
-    fpath = os.path.join(dirs.conn_train_dir, model_name)
+def get_model_data(
+    model_name,
+    train_exp='sc1',
+    average_subjs=False
+    ):
+    """Get weights of trained models for all subjects
 
-    # get trained subject models
-    data_all = []
-    for subj in const.return_subjs:
-        model_fname = os.path.join(fpath, f'{model_name}_{subj}.h5')
-        # read model data
-        data = cio.read_hdf5(model_fname)
-        data_all.append(data.coef_)
-    
+    Args:
+        model_name (str): full name of trained model. Has to follow naming convention <method>_<cortex>_alpha_<num>
+        train_exp (str): 'sc1' or 'sc2'
+        average_subjs (bool): average weights across subjects? default is False
+    Returns:
+        weights (np array): read-only memory map (subjects x cerebellar voxels x cortical regions),
+            or (cerebellar voxels x cortical regions) if `average_subjs` is True
+    """
+    group_weights = get_group_weights(model_name, train_exp=train_exp)
     if average_subjs:
-        return np.nanmean(np.stack(data_all), axis=0)
+        return group_weights.nanmean()
     else:
-        return np.stack(data_all)
+        return group_weights.data
 
 def _threshold_data(
     data, 
@@ -321,7 +461,7 @@ def _threshold_data(
         data (np array); same shape as `data`. NaN replaces all data below threshold
     """
 
-    return np.where(data < threshold, np.float("nan"), data)
+    return np.where(data < threshold, np.nan, data)
 
 def average_region_data(
     subjs,
@@ -434,25 +574,9 @@ def regions_cortex(
     Returns: 
         giis (list of giftis; 'L', and 'R' hem)
     """
-    hem_names = ['L', 'R']
-
-    # optionally threshold weights based on `threshold`
-    giis_hem = []
-    for hem in hem_names:
+    # one gifti per hemisphere, every cerebellar region is a column
+    giis_hem, _ = cdata.convert_cortex_to_gifti(data=roi_betas.T, atlas=cortex, column_names=reg_names, data_type='func')
 
-        labels = get_labels_hemisphere(roi=cortex, hemisphere=hem)
-        roi_mean_hem = roi_betas[:,labels]
-
-        # loop over columns
-        giis = []
-        for dd in roi_mean_hem:
-            gii, _ = cdata.convert_cortex_to_gifti(data=dd, atlas=cortex, column_names=reg_names, data_type='func', hem_names=[hem])
-            giis.append(gii[0].darrays[0].data)
-
-        # make gifti
-        gii_hem = nio.make_func_gifti_cortex(np.vstack(giis).T, column_names=reg_names, anatomical_struct=hem)
-        giis_hem.append(gii_hem)
-    
     return giis_hem
 
 def distances_cortex(
@@ -530,38 +654,28 @@ def _sparsity_cortex(
     # get distances between cortical regions; shape (num_reg x num_reg)
     distances = cdata.get_distance_matrix(roi)[0]
 
+    # binary support of the coefficients (nan counts as zero)
+    support = (np.nan_to_num(coef) != 0).astype(float)
+
     data = {}
     for hem in hem_names:
 
         labels = get_labels_hemisphere(roi, hemisphere=hem)
 
         # index by `hem`
-        coef_hem = coef
+        support_hem = support
         if coef.shape[1]==distances.shape[0]:
-            coef_hem = coef[:, labels]
-        
-        dist_hem = distances[labels,:][:,labels]
-
-        # get shape of coefficients
-        regs, _ = coef_hem.shape
-
-        # loop over voxels
-        nonzero_dist = np.zeros((regs, ))
-        for reg in np.arange(regs):
-
-            coef_hem = np.nan_to_num(coef_hem)
-            labels_arr = np.nonzero(coef_hem[reg,:])[0]
+            support_hem = support[:, labels]
 
-            # pairwise distances for nonzero `labels`
-            dist_mat = dist_hem[labels_arr,:][:,labels_arr]
-            dist_labels = dist_mat[np.triu_indices_from(dist_mat, k=1)]
+        dist_hem = distances[labels,:][:,labels]
 
-            if metric=='gmean':
-                nonzero_dist[reg] = gmean(dist_labels)
-            elif metric=='nanmean':
-                nonzero_dist[reg] = np.nanmean(dist_labels)
-            elif metric=='nanmedian':
-                nonzero_dist[reg] = np.nanmedian(dist_labels)
+        # pairwise distances between nonzero labels, for all voxels at once
+        if metric=='gmean':
+            nonzero_dist = np.exp(_pairwise_mean(support_hem, dist_hem, log=True))
+        elif metric=='nanmean':
+            nonzero_dist = _pairwise_mean(support_hem, dist_hem)
+        elif metric=='nanmedian':
+            nonzero_dist = _pairwise_median(support_hem, dist_hem)
 
         # add to dict
         data.update({hem: nonzero_dist})
@@ -572,6 +686,64 @@ def _sparsity_cortex(
 
     return data
 
+def _pairwise_mean(support, dist, log=False):
+    """Mean of `dist` over all pairs of nonzero labels, for every row of `support`
+
+    For a binary support vector b, the sum over pairs is the quadratic form b'Db / 2,
+    so all rows are computed with one matrix product. nan distances are ignored.
+    Args:
+        support (np array): binary support (shape; n_cerebellar_regs (or voxels) x n_labels)
+        dist (np array): distances between labels (shape; n_labels x n_labels)
+        log (bool): average log-distances (for the geometric mean)
+    Returns:
+        1D np array (nan for rows with less than two nonzero labels)
+    """
+    dist = dist.astype(float).copy()
+    np.fill_diagonal(dist, np.nan)
+    is_valid = ~np.isnan(dist)
+    if log:
+        with np.errstate(divide='ignore'):
+            dist = np.log(dist)
+        # zero distances give a geometric mean of zero
+        is_zero = np.isneginf(dist)
+        dist[is_zero] = 0
+        has_zero = np.einsum('ij,ij->i', support @ is_zero, support) > 0
+    dist[~is_valid] = 0
+
+    sum_pairs = np.einsum('ij,ij->i', support @ dist, support)
+    num_pairs = np.einsum('ij,ij->i', support @ is_valid, support)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_dist = sum_pairs / num_pairs
+    if log:
+        mean_dist[has_zero] = -np.inf
+    return mean_dist
+
+def _pairwise_median(support, dist, chunk_size=None):
+    """Median of `dist` over all pairs of nonzero labels, for every row of `support`
+
+    Rows are processed in chunks, each as one (chunk x pairs) masked array.
+    Args:
+        support (np array): binary support (shape; n_cerebellar_regs (or voxels) x n_labels)
+        dist (np array): distances between labels (shape; n_labels x n_labels)
+        chunk_size (int or None): rows per chunk. default keeps chunks at ~64MB
+    Returns:
+        1D np array (nan for rows with less than two nonzero labels)
+    """
+    rows, cols = np.triu_indices_from(dist, k=1)
+    dist_pairs = dist[rows, cols].astype(float)
+    support = support.astype(bool)
+    if chunk_size is None:
+        chunk_size = max(1, (1 << 23) // max(len(dist_pairs), 1))
+
+    median_dist = np.full((support.shape[0],), np.nan)
+    for start in range(0, support.shape[0], chunk_size):
+        chunk = support[start:start + chunk_size]
+        pairs = np.where(chunk[:, rows] & chunk[:, cols], dist_pairs, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning) # all-nan rows
+            median_dist[start:start + chunk_size] = np.nanmedian(pairs, axis=1)
+    return median_dist
+
 def dispersion_cortex(roi_betas, cortex):
     """Caluclate spherical dispersion for the connectivity weights
 
@@ -582,62 +754,66 @@ def dispersion_cortex(roi_betas, cortex):
     Returns:
         dataframe (pd dataframe)
     """
-    # get data
-    num_roi, num_parcel = roi_betas.shape
+    df = dispersion_subjects(roi_betas[np.newaxis], cortex)
+    return df.drop(columns='subj')
 
-    roi_betas = np.nan_to_num(roi_betas)
+def dispersion_subjects(weights, cortex, subjs=None):
+    """Caluclate spherical dispersion for the connectivity weights of many subjects at once
 
-    hem_names = ['L', 'R']
+    For each cerebellar region (or voxel), the weights w_i are the connectivity weights
+    with negative weights set to zero, normalized to sum to 1 within each hemisphere.
+    With a unit vector v_i for each tessel, R is the length of the weighted average
+    vector sum(w_i*v_i), the spherical variance is 1-R and the spherical SD is sqrt(-2*log(R)).
+    The weighted averages for all subjects and both hemispheres are one matrix product.
 
-    # optionally threshold weights based on `threshold`
-    data = {}; roi_dist_all = []
-    dist,coord = cdata.get_distance_matrix(cortex)
+    Args:
+        weights (np array): shape n_subjs x n_cerebellar_regs (or voxels) x n_cortical_regs
+        cortex (str): cortex name e.g., 'tessels1002'
+        subjs (list of str or None): subject ids. default is 0, 1, ...
 
-    df = pd.DataFrame()
+    Returns:
+        dataframe (pd dataframe): one row per subject, hemisphere and region with
+        columns subj, Variance, Std, hem, roi, sum_w
+    """
+    num_subj, num_roi, num_parcel = weights.shape
+    if subjs is None:
+        subjs = np.arange(num_subj)
 
-    for h,hem in enumerate(hem_names):
+    hem_names = ['L', 'R']
+    num_hem = len(hem_names)
+    dist,coord = cdata.get_distance_matrix(cortex)
 
+    # Operator (num_parcel x 4*hem): unit vectors (x, y, z) and ones for the sum of weights, per hemisphere
+    operator = np.zeros((coord.shape[0], 4 * num_hem))
+    for h,hem in enumerate(hem_names):
         labels = get_labels_hemisphere(roi=cortex, hemisphere=hem)
-        # weights
 
-        # Calculate spherical STD as measure
         # Get coordinates and move back to 0,0,0 center
         coord_hem = coord[labels,:]
         coord_hem[:,0]=coord_hem[:,0]-(h*2-1)*500
-
-        # Now compute a weoghted spherical mean, variance, and STD
-        # For each tessel, the weigth w_i is the connectivity weights with negative weights set to zero
-        # also set the sum of weights to 1
-        w = roi_betas[:,labels]
-        w[w<0]=0
-        sum_w = w.sum(axis=1)
-        # print(sum_w.shape)
-        w = w /sum_w.reshape(-1,1)
-
-        # We then define a unit vector for each tessel, v_i:
-        v = coord_hem.copy().T
-        v=v / np.sqrt(np.sum(v**2,axis=0))
-
-        # Weighted average vector =sum(w_i*v_i)
-        # R is the length of this average vector
-
-        R = np.zeros((num_roi,))
-        for i in range(num_roi):
-
-            mean_v = np.sum(w[i,:] * v,axis=1)
-            R[i] = np.sqrt(np.sum(mean_v**2))
-
-            # Check with plot
-            # fig = plt.figure()
-            # ax = fig.add_subplot(projection='3d')
-            # ax.scatter(w[i,:]*v[0,:],w[i,:]*v[1,:],w[i,:]*v[2,:])
-            # ax.scatter(mean_v[0],mean_v[1],mean_v[2])
-            # pass
-
-        V = 1-R # This is the Spherical variance
-        Std = np.sqrt(-2*np.log(R)) # This is the spherical standard deviation
-        df1 = pd.DataFrame({'Variance':V,'Std':Std,'hem':h*np.ones((num_roi,)),'roi':np.arange(num_roi)+1,'sum_w':sum_w})
-        df = pd.concat([df,df1])
+        v = coord_hem / np.sqrt(np.sum(coord_hem**2,axis=1, keepdims=True))
+        operator[labels, 4*h:4*h+3] = v
+        operator[labels, 4*h+3] = 1
+
+    w = np.nan_to_num(weights)
+    w = np.where(w < 0, 0, w)
+    summed = (w @ operator).reshape(num_subj, num_roi, num_hem, 4)
+
+    # Weighted average vector =sum(w_i*v_i), R is the length of this average vector
+    sum_w = summed[..., 3]
+    mean_v = summed[..., :3] / sum_w[..., np.newaxis]
+    R = np.sqrt(np.sum(mean_v**2, axis=-1))
+
+    # order rows by subject, hemisphere, region
+    R = R.transpose(0, 2, 1).ravel()
+    sum_w = sum_w.transpose(0, 2, 1).ravel()
+    df = pd.DataFrame({'subj': np.repeat(subjs, num_hem * num_roi),
+                       'Variance': 1-R, # This is the Spherical variance
+                       'Std': np.sqrt(-2*np.log(R)), # This is the spherical standard deviation
+                       'hem': np.tile(np.repeat(np.arange(num_hem, dtype=float), num_roi), num_subj),
+                       'roi': np.tile(np.arange(num_roi)+1, num_subj * num_hem),
+                       'sum_w': sum_w},
+                       index=np.tile(np.arange(num_roi), num_subj * num_hem))
     return df
 
 def surface_cortex(roi_betas, weights = 'nonzero'):
@@ -677,19 +853,8 @@ def get_labels_hemisphere(
     Returns: 
         1D np array of labels
     """
-    dirs = const.Dirs(exp_name='sc1')
-    
-    gii_path = os.path.join(dirs.reg_dir, 'data', 'group', f'{roi}.{hemisphere}.label.gii')
-    labels = load_surf_data(gii_path)
-
-    # get min, max labels for each hem
-    min_label = np.nanmin(labels[labels!=0])
-    max_label = np.nanmax(labels[labels!=0])
-
-    # get labels per hemisphere
-    labels_hem = np.arange(min_label-1, max_label)
-    
-    return labels_hem
+    # labels per hemisphere (from min to max nonzero label) are cached with the parcel geometry
+    return cdata.get_cortex_geometry(roi)[f'labels_{hemisphere}'].copy()
 
 def best_weights(
     train_exp='sc1',
@@ -721,8 +886,8 @@ def best_weights(
                             save=False
                             )
         
-        # get group average weights
-        group_weights = np.nanmean(weights, axis=0)
+        # get group average weights (streamed over blocks of voxels)
+        group_weights = weights.nanmean()
 
         # save best weights to disk
         dirs = const.Dirs(exp_name=train_exp)
@@ -0,0 +1,43 @@
+import time
+import threading
+import numpy as np
+import pytest
+
+import connectivity.data as cdata
+
+def test_prefetch():
+    loaded = []
+    ahead = []
+
+    def load(key):
+        time.sleep(0.01)
+        loaded.append(key)
+        return np.full(3, key)
+
+    for depth in [0, 1, 2]:
+        loaded.clear()
+        for key, data in cdata.prefetch(load, range(6), depth=depth):
+            assert np.array_equal(data, np.full(3, key))
+            time.sleep(0.05)
+            # keys loaded ahead of the current one
+            ahead.append(len(loaded) - key - 1)
+        assert loaded == list(range(6))
+        assert max(ahead) == depth
+        ahead.clear()
+
+def test_prefetch_errors():
+    def load(key):
+        if key == 2:
+            raise FileNotFoundError(key)
+        return key
+
+    keys = []
+    with pytest.raises(FileNotFoundError):
+        for key, data in cdata.prefetch(load, range(5)):
+            keys.append(key)
+    assert keys == [0, 1]
+
+    # leaving the loop stops the loader
+    for key, data in cdata.prefetch(lambda key: key, range(100), depth=3):
+        break
+    assert not any(t.name.startswith("prefetch") for t in threading.enumerate())
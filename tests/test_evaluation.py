@@ -0,0 +1,52 @@
+import numpy as np
+from sklearn.metrics import mean_squared_error
+
+import connectivity.evaluation as ev
+
+def simulate_eval_data(N=20, P=50):
+    """
+        Make some artificial data with two sessions of N/2 conditions
+    """
+    sess = np.repeat([1, 2], N // 2)
+    Y = np.random.normal(0, 1, (N, P))
+    Y_pred = Y + np.random.normal(0, 1, (N, P))
+    return Y, Y_pred, sess
+
+def test_calculate_metrics():
+    Y, Y_pred, sess = simulate_eval_data()
+    metrics = ev.calculate_metrics(Y, Y_pred, Y_sess=sess, X_sess=sess, block_size=7)
+
+    R, R_vox = ev.calculate_R(Y, Y_pred)
+    R2, R2_vox = ev.calculate_R2(Y, Y_pred)
+    noise_Y = ev.calculate_reliability(Y, {"sess": sess})
+    noise_X = ev.calculate_reliability(Y_pred, {"sess": sess})
+
+    assert np.isclose(metrics["rmse"], mean_squared_error(Y, Y_pred, squared=False))
+    assert np.isclose(metrics["R_eval"], R)
+    assert np.allclose(metrics["R_vox"], R_vox)
+    assert np.isclose(metrics["R2"], R2)
+    assert np.allclose(metrics["R2_vox"], R2_vox)
+    for name, noise in [("noise_Y", noise_Y), ("noise_X", noise_X)]:
+        assert np.isclose(metrics[f"{name}_R"], noise[0])
+        assert np.allclose(metrics[f"{name}_R_vox"], noise[1])
+        assert np.isclose(metrics[f"{name}_R2"], noise[2])
+        assert np.allclose(metrics[f"{name}_R2_vox"], noise[3])
+
+def test_group_metrics():
+    from connectivity.model import L2regression
+
+    data = [simulate_eval_data() for s in range(3)]
+    Y = np.stack([d[0] for d in data])
+    X = np.stack([d[1][:, :10] for d in data])
+    sess = data[0][2]
+    models = [L2regression(alpha=1).fit(X[s], Y[s]) for s in range(3)]
+
+    metrics, group = ev.calculate_group_metrics(Y, X, models, Y_sess=sess, X_sess=sess)
+    for s, model in enumerate(models):
+        Y_pred = model.predict(X[s])
+        R, R_vox = ev.calculate_R(Y[s], Y_pred)
+        assert np.isclose(metrics["R_eval"][s], R)
+        assert np.allclose(metrics["R_vox"][s], R_vox)
+        assert np.isclose(metrics["noise_X_R"][s], ev.calculate_reliability(Y_pred, {"sess": sess})[0])
+    assert np.isclose(group["R_eval"], np.mean(metrics["R_eval"]))
+    assert np.allclose(ev.calculate_R2(Y, ev.predict(X, *ev.stack_models(models)))[0], metrics["R2"])
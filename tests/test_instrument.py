@@ -0,0 +1,46 @@
+import threading
+import numpy as np
+import pytest
+
+import connectivity.instrument as instrument
+
+@instrument.timed()
+def make_data(n):
+    return np.zeros((n, 3)), "info"
+
+def test_stages(tmp_path):
+    fname = str(tmp_path / "perf.jsonl")
+    instrument.configure(fname, profile="cprofile", profile_stages=["fit"])
+    try:
+        with instrument.context(model="ridge"):
+            with instrument.stage("fit", subj="s01") as record:
+                X, _ = make_data(10)
+                record["arrays"] = instrument.array_sizes(X=X)
+            with pytest.raises(ValueError):
+                with instrument.stage("save", subj="s01"):
+                    raise ValueError()
+            # contexts belong to the thread that opened them
+            thread = threading.Thread(target=make_data, args=(5,))
+            thread.start()
+            thread.join()
+    finally:
+        instrument.configure(None)
+
+    df = instrument.read_log(fname)
+    assert list(df["stage"]) == ["make_data", "fit", "save", "make_data"]
+    assert list(df["parent"].fillna("")) == ["fit", "", "", ""]
+    assert list(df["model"].fillna("")) == ["ridge", "ridge", "ridge", ""]
+    assert df["arrays"][0] == {"result0": {"shape": [10, 3], "mb": 240 / 2**20}}
+    assert df["error"][2] == "ValueError"
+    assert (df["wall_s"] >= 0).all() and "rss_peak_mb" in df
+    # only the fit stage is profiled
+    assert df["profile"][1].endswith(".prof") and df["profile"].isnull().sum() == 3
+
+    summary = instrument.report(fname, by=["stage"])
+    assert set(summary["stage"]) == {"make_data", "fit", "save"}
+    assert summary.set_index("stage").loc["make_data", "count"] == 2
+    assert (summary["share"] <= 1).all()
+
+    # records without a model are grouped, not dropped
+    summary = instrument.report(fname, by=["stage", "model"])
+    assert summary.set_index(["stage", "model"]).loc[("make_data", ""), "count"] == 1
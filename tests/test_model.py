@@ -0,0 +1,80 @@
+import numpy as np
+
+import connectivity.model as model
+
+def test_model_artifact(tmp_path):
+    X = np.random.normal(0, 1, (40, 12))
+    Y = np.random.normal(0, 1, (40, 30))
+    for new_model in [model.L2regression(alpha=2), model.WTA()]:
+        new_model.fit(X, Y)
+        new_model.rmse_train = np.float64(1.5)
+        fname = str(tmp_path / "model.h5")
+        model.save_model(fname, new_model, config_hash="abc", data_hash="def")
+
+        assert model.is_artifact(fname)
+        fitted_model = model.load_model(fname)
+        assert isinstance(fitted_model.coef_, np.memmap)
+        assert np.array_equal(fitted_model.coef_, new_model.coef_)
+        assert fitted_model.rmse_train == 1.5
+        assert fitted_model.config_hash_ == "abc"
+        assert fitted_model.params == new_model.get_params()
+        assert np.allclose(fitted_model.predict(X), new_model.predict(X))
+
+def test_fit_ridge_batched():
+    for P in [12, 80]:
+        X = np.random.normal(0, 1, (4, 40, P))
+        Y = np.random.normal(0, 1, (4, 40, 30))
+        models = model.fit_ridge_batched(X, Y, alpha=np.exp(2))
+        for s in range(4):
+            new_model = model.L2regression(alpha=np.exp(2)).fit(X[s], Y[s])
+            assert np.allclose(models[s].scale_, new_model.scale_)
+            assert np.allclose(models[s].coef_, new_model.coef_)
+            assert np.allclose(models[s].predict(X[s]), new_model.predict(X[s]))
+
+def test_incremental_ridge():
+    X = np.random.normal(0, 1, (5, 30, 20))
+    Y = np.random.normal(0, 1, (5, 30, 7))
+    incremental_model = model.IncrementalRidge(alpha=1)
+    for s in range(5):
+        incremental_model.partial_fit(X[s], Y[s])
+    for alpha in [1, 50]:
+        new_model = model.L2regression(alpha=alpha).fit(X.reshape(-1, 20), Y.reshape(-1, 7))
+        assert np.allclose(incremental_model.get_coef(alpha), new_model.coef_)
+        assert np.allclose(incremental_model.predict(X[0], alpha=alpha), new_model.predict(X[0]))
+
+    # leaving out the first subject
+    models = model.leave_one_subject_out(X, Y, alphas=[10])
+    new_model = model.L2regression(alpha=10).fit(X[1:].reshape(-1, 20), Y[1:].reshape(-1, 7))
+    assert np.allclose(models[10][0].scale_, new_model.scale_)
+    assert np.allclose(models[10][0].coef_, new_model.coef_)
+
+def test_reduced_rank_ridge(tmp_path):
+    X = np.random.normal(0, 1, (40, 12))
+    Y = np.random.normal(0, 1, (40, 30))
+    full_model = model.L2regression(alpha=2).fit(X, Y)
+    new_model = model.ReducedRankRidge(alpha=2, rank=12).fit(X, Y)
+    assert new_model.U_.shape == (30, 12) and new_model.V_.shape == (12, 12)
+    # full rank is the ridge solution
+    assert np.allclose(new_model.coef_, full_model.coef_)
+    assert np.allclose(new_model.predict(X), full_model.predict(X))
+
+    new_model = model.ReducedRankRidge(alpha=2, rank=3).fit(X, Y)
+    assert np.linalg.matrix_rank(new_model.coef_) == 3
+    fname = str(tmp_path / "model.h5")
+    model.save_model(fname, new_model)
+    assert model.is_factored(fname)
+    U, V = model.load_factors(fname)
+    assert np.allclose(U @ V.T, new_model.coef_)
+    assert np.allclose(model.load_coef(fname), new_model.coef_)
+    assert np.allclose(model.load_model(fname).predict(X), new_model.predict(X))
+
+def test_ridge_path():
+    X = np.random.normal(0, 1, (60, 200))
+    Y = np.random.normal(0, 1, (60, 30))
+    train, test = np.arange(45), np.arange(45, 60)
+    path = model.RidgePath(X[train], Y[train], X[test], Y[test])
+    for alpha in np.exp([-2, 2, 8]):
+        new_model = model.L2regression(alpha=alpha).fit(X[train], Y[train])
+        assert np.allclose(path.get_model(alpha).coef_, new_model.coef_)
+        assert np.allclose(path.predict_train(alpha), new_model.predict(X[train]))
+        assert np.allclose(path.predict_test(alpha), new_model.predict(X[test]))
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+import connectivity.model as model
+import connectivity.evaluation as ev
+import connectivity.permutation as cperm
+import connectivity.results as cres
+import connectivity.visualize as vis
+
+class RefitL2regression(model.L2regression):
+    """same model, but permuted via refitting (not linear shortcut)"""
+    pass
+
+def simulate_data(N=20, P=5, Q=30):
+    """
+        Make some artificial training and evaluation data
+    """
+    X = np.random.normal(0, 1, (N, P))
+    W = np.random.normal(0, 1, (P, Q))
+    X_eval = X + np.random.normal(0, 0.5, (N, P))
+    Y = X @ W + np.random.normal(0, 1, (N, Q))
+    Y_eval = X_eval @ W + np.random.normal(0, 1, (N, Q))
+    sess = np.repeat([1, 2], N // 2)
+    return X, Y, X_eval, Y_eval, sess
+
+def test_linear_permutation():
+    X, Y, X_eval, Y_eval, sess = simulate_data()
+    kwargs = {"Y_sess": sess, "X_sess": sess, "n_perm": 30, "batch_size": 8, "random_state": 1}
+    fast = cperm.permutation_test(model.L2regression(alpha=1), X, Y, X_eval, Y_eval, **kwargs)
+    slow = cperm.permutation_test(RefitL2regression(alpha=1), X, Y, X_eval, Y_eval, **kwargs)
+
+    assert np.isclose(fast["observed"]["R_eval"], slow["observed"]["R_eval"])
+    assert np.allclose(fast["null"]["R_eval"], slow["null"]["R_eval"])
+    assert np.allclose(fast["p"]["R_vox"], slow["p"]["R_vox"])
+    assert fast["null"]["R_eval"].shape == (30,)
+
+    # refits in worker processes on the shared data
+    pooled = cperm.permutation_test(RefitL2regression(alpha=1), X, Y, X_eval, Y_eval, workers=2, **kwargs)
+    assert np.allclose(pooled["null"]["R_eval"], slow["null"]["R_eval"])
+
+def test_noiseceiling(monkeypatch):
+    X, Y, X_eval, Y_eval, sess = simulate_data()
+    result = cperm.permutation_test(model.L2regression(alpha=1), X, Y, X_eval, Y_eval, Y_sess=sess, X_sess=sess, n_perm=2)
+
+    # the same model evaluated as in the eval summaries
+    Y_pred = model.L2regression(alpha=1).fit(X, Y).predict(X_eval)
+    metrics = ev.calculate_metrics(Y_eval, Y_pred, Y_sess=sess, X_sess=sess)
+    df = pd.DataFrame([{"X_data": "tessels0042", "name": "ridge_tessels0042_alpha_1", "splitby": "all",
+        "R_eval": metrics["R_eval"], "noise_Y_R": metrics["noise_Y_R"], "noise_X_R": metrics["noise_X_R"]}])
+    monkeypatch.setattr(cres, "query_results", lambda *args, **kwargs: df)
+    df = vis.get_summary("eval", "eval_summary")
+    assert np.isclose(result["observed"]["R_nc"], df["R_eval"][0] / df["noiseceiling_XY"][0])
+
+def test_bootstrap_ci():
+    values = np.random.normal(1, 1, (24, 10))
+    low, high = cperm.bootstrap_ci(values, n_boot=500, random_state=0)
+    assert np.all(low < values.mean(axis=0)) and np.all(high > values.mean(axis=0))
@@ -0,0 +1,44 @@
+import os
+import pandas as pd
+import pytest
+
+import connectivity.results as cres
+
+def make_store(tmp_path, monkeypatch):
+    """store under tmp_path, with a legacy csv file to import"""
+    monkeypatch.setattr(cres, "get_store_dir", lambda summary_type, summary_name, exp: str(tmp_path / "results" / summary_name))
+    legacy = pd.DataFrame({"name": ["ridge_tessels0162_alpha_2", "ridge_tessels0042_alpha_2"],
+                           "X_data": ["tessels0162", "tessels0042"],
+                           "subj_id": ["s01", "s02"],
+                           "R_eval": [0.3, 0.2]})
+    fname = str(tmp_path / "legacy.csv")
+    legacy.to_csv(fname, index=False)
+    return fname
+
+def test_import_and_query(tmp_path, monkeypatch):
+    legacy = make_store(tmp_path, monkeypatch)
+    calls = []
+
+    def import_csv(summary_type, summary_name, exp, store_dir=None):
+        calls.append(store_dir)
+        if len(calls) == 1:
+            raise RuntimeError("crashed import")
+        return cres._write_parts(pd.read_csv(legacy), store_dir)
+    monkeypatch.setattr(cres, "import_csv", import_csv)
+
+    # a crashed import leaves no store and is repeated
+    with pytest.raises(RuntimeError):
+        cres.query_results("eval", "ridge", "sc2")
+    assert os.listdir(tmp_path / "results") == []
+    df = cres.query_results("eval", "ridge", "sc2")
+    assert len(df) == 2 and len(calls) == 2
+    cres.query_results("eval", "ridge", "sc2")
+    assert len(calls) == 2
+
+    # scalars are not matched as substrings
+    assert len(cres.query_results("eval", "ridge", "sc2", cortex="tessels0162")) == 1
+    assert len(cres.query_results("eval", "ridge", "sc2", atlas="tessels", subj="s0")) == 0
+
+    # no match still has the columns of the store
+    df = cres.query_results("eval", "ridge", "sc2", cortex=["yeo7"])
+    assert df.empty and "X_data" in df.columns
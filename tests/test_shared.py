@@ -0,0 +1,41 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import connectivity.data as cdata
+import connectivity.shared as cshared
+
+def _sum_shared(registry):
+    data = cshared.attach(registry)
+    return data["X"].sum(), data["operator"].sum(axis=0), data["Y"].data.sum()
+
+def test_shared_arrays():
+    X = np.random.normal(0, 1, (30, 8))
+    operator = cdata.get_roi_operator(np.arange(20) % 3)[0]
+    dataset = cdata.Dataset("sc1", "glm7", "cerebellum_suit", "s02")
+    dataset.data = np.random.normal(0, 1, (12, 5))
+    dataset.TN = ["a", "b"]
+    with cshared.SharedArrays() as arrays:
+        assert np.array_equal(arrays.put("X", X), X)
+        assert np.array_equal(arrays.put_sparse("operator", operator).toarray(), operator.toarray())
+        assert arrays.put_dataset("Y", dataset).TN == ["a", "b"]
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = [f.result() for f in [executor.submit(_sum_shared, arrays.registry) for _ in range(3)]]
+        for X_sum, operator_sum, Y_sum in results:
+            assert np.isclose(X_sum, X.sum())
+            assert np.array_equal(operator_sum, operator.sum(axis=0))
+            assert np.isclose(Y_sum, dataset.data.sum())
+
+        # workers attach without copying, read-only
+        data = cshared.attach(arrays.registry)
+        assert not data["X"].flags.writeable
+        assert np.shares_memory(data["X"], cshared.attach(arrays.registry)["X"])
+        names = [spec["block"] for spec in [arrays.registry["X"]] + list(arrays.registry["Y"]["arrays"].values())]
+        cshared.detach()
+    # the blocks are unlinked on exit
+    assert arrays.registry == {}
+    for name in names:
+        try:
+            cshared._shared_memory().SharedMemory(name=name)
+            assert False
+        except FileNotFoundError:
+            pass
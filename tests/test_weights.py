@@ -0,0 +1,83 @@
+import numpy as np
+
+import connectivity.model as model
+import connectivity.weights as cweights
+
+def make_group_weights(tmp_path, monkeypatch, S=3, V=23, P=6):
+    """
+        Writes empty model files for S subjects and returns their weights
+    """
+    weights = np.random.normal(0, 1, (S, V, P))
+    weights[0, 2, :] = np.nan
+    subjs = [f"s{s:02d}" for s in range(S)]
+    fpath = tmp_path / "ridge_tessels_alpha_8"
+    fpath.mkdir()
+    models = {}
+    for subj, coef in zip(subjs, weights):
+        fname = str(fpath / f"ridge_tessels_alpha_8_{subj}.h5")
+        open(fname, "w").close()
+        models[fname] = coef
+    monkeypatch.setattr(model, "load_coef", lambda fname: models[fname])
+    monkeypatch.setattr(model, "is_factored", lambda fname: False)
+    return fpath, subjs, weights
+
+def test_group_weights(tmp_path, monkeypatch):
+    fpath, subjs, weights = make_group_weights(tmp_path, monkeypatch)
+    group_weights = cweights.GroupWeights(fpath, subjs=subjs, chunk_size=5)
+
+    assert np.array_equal(np.asarray(group_weights), weights, equal_nan=True)
+    assert np.allclose(group_weights.nanmean(), np.nanmean(weights, axis=0))
+    assert np.allclose(group_weights.voxel_means(), np.nanmean(weights, axis=2), equal_nan=True)
+    assert np.allclose(group_weights.cortex_means(), np.nanmean(weights, axis=1))
+
+    index = np.arange(weights.shape[1]) % 4
+    region_means, region_numbers = group_weights.region_means(index)
+    assert np.array_equal(region_numbers, np.arange(4))
+    for r in region_numbers:
+        assert np.allclose(region_means[:, r], np.nanmean(weights[:, index == r], axis=1))
+
+    # nan weights give a nan threshold (as np.mean)
+    thresholds = group_weights.thresholds()
+    assert np.isnan(thresholds[0])
+    assert np.allclose(thresholds[1:], weights[1:].mean(axis=(1, 2)) + weights[1:].std(axis=(1, 2)))
+
+def test_group_weights_batches(tmp_path, monkeypatch):
+    fpath, subjs, weights = make_group_weights(tmp_path, monkeypatch)
+    group_weights = cweights.GroupWeights(fpath, subjs=subjs)
+    # the tensor is only written once
+    mtime = (fpath / "group_weights.npy").stat().st_mtime_ns
+    group_weights = cweights.GroupWeights(fpath, subjs=subjs)
+    assert (fpath / "group_weights.npy").stat().st_mtime_ns == mtime
+
+    threshold = np.array([0, 0.5, 1])
+    batches = list(group_weights.iter_subjects(batch_size=2, threshold=threshold))
+    assert [b[0] for b in batches] == [subjs[:2], subjs[2:]]
+    thresholded = np.concatenate([b[1] for b in batches])
+    expected = np.where(weights < threshold.reshape(-1, 1, 1), np.nan, weights)
+    assert np.array_equal(thresholded, expected, equal_nan=True)
+
+def test_group_weights_partial(tmp_path, monkeypatch):
+    fpath, subjs, weights = make_group_weights(tmp_path, monkeypatch)
+    (fpath / f"ridge_tessels_alpha_8_{subjs[1]}.h5").unlink()
+    # all existing models, or the requested subjects that have a model
+    for group_weights in [cweights.GroupWeights(fpath), cweights.GroupWeights(fpath, subjs=subjs)]:
+        assert group_weights.subjs == [subjs[0], subjs[2]]
+        assert np.array_equal(np.asarray(group_weights), weights[[0, 2]], equal_nan=True)
+
+def test_group_weights_factors(tmp_path):
+    fpath = tmp_path / "rrr_tessels_alpha_8"
+    fpath.mkdir()
+    subjs = ["s01", "s02"]
+    models = []
+    for subj in subjs:
+        new_model = model.ReducedRankRidge(alpha=1, rank=2).fit(np.random.normal(0, 1, (20, 6)), np.random.normal(0, 1, (20, 15)))
+        model.save_model(str(fpath / f"rrr_tessels_alpha_8_{subj}.h5"), new_model)
+        models.append(new_model)
+    weights = np.stack([m.coef_ for m in models])
+
+    group_weights = cweights.GroupWeights(fpath, subjs=subjs)
+    assert group_weights.shape == weights.shape
+    assert np.allclose(group_weights.voxel_means(), weights.mean(axis=2))
+    assert np.allclose(group_weights.cortex_means(), weights.mean(axis=1))
+    assert not (fpath / "group_weights.npy").exists()
+    assert np.allclose(group_weights.nanmean(), weights.mean(axis=0))